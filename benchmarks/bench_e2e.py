@@ -0,0 +1,138 @@
+"""端到端基准: 适配器连接本地的假 IMAP/SMTP 服务器 (tests/fake_server.py)
+
+- ingest: 每个账号同时投递 N 封邮件, 统计 mails/s 及投递到处理器的 p50/p99 延迟
+- memory: 所有账号进入 IDLE 后的内存增量 (tracemalloc, 含假服务器的会话) / 账号数
+- send: 通过连接池批量发送, 统计 sends/s
+
+运行: python benchmarks/bench_e2e.py [--accounts 10] [--mails 200] [--sends 500]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import tracemalloc
+from pathlib import Path
+from email.message import EmailMessage
+
+import nonebot
+import nonebot.adapters
+import email_validator
+from nonebot.message import event_preprocessor
+
+ROOT = Path(__file__).parent.parent
+nonebot.adapters.__path__.append(str((ROOT / "nonebot" / "adapters").resolve()))  # type: ignore
+sys.path.insert(0, str(ROOT / "tests"))
+
+from fake_server import CERT_FILE, FakeIMAPServer, FakeSMTPServer, server_ssl_context  # noqa: E402
+
+# 离线运行, 不检查邮箱域名的 MX 记录
+email_validator.CHECK_DELIVERABILITY = False
+
+
+def make_mail(account: int, index: int) -> bytes:
+    mail = EmailMessage()
+    mail["From"] = f"Sender {index} <sender{index % 50}@example.com>"
+    mail["To"] = f"bot{account}@example.com"
+    mail["Subject"] = f"基准测试 {account}-{index}"
+    mail["Date"] = "Fri, 25 Aug 2023 02:53:48 +0000"
+    mail["Message-ID"] = f"<{account}.{index}@bench>"
+    mail.set_content("benchmark body " * 20)
+    return bytes(mail)
+
+
+def percentile(values: list[float], q: int) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else (values or [0])[0]
+
+
+async def wait_until(predicate, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.01)
+
+
+async def main(accounts: int, mails: int, sends: int):
+    imap, smtp = FakeIMAPServer(), FakeSMTPServer()
+    users = [f"bot{i}@example.com" for i in range(accounts)]
+    for user in users:
+        imap.add_account(user, "password")
+    imap_port = await imap.start(ssl_context=server_ssl_context())
+    smtp_port = await smtp.start()
+    os.environ["SSL_CERT_FILE"] = str(CERT_FILE)
+
+    nonebot.init(
+        driver="~none",
+        log_level="ERROR",
+        imap_host="127.0.0.1",
+        imap_port=imap_port,
+        smtp_host="127.0.0.1",
+        smtp_port=smtp_port,
+        smtp_use_tls=False,
+        email_accounts=[{"user": user, "password": "password"} for user in users],
+        checkpoint_store="memory",
+        smtp_spool="memory",
+        part_cache_path=None,
+        imap_max_concurrent_logins=accounts,
+    )
+    from nonebot.adapters.email import Adapter, Event, Message  # type: ignore
+
+    latencies: list[float] = []
+
+    @event_preprocessor
+    async def record(event: Event):
+        latencies.append(time.perf_counter() - imap.delivered_at[event.message_id])
+
+    driver = nonebot.get_driver()
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    driver.register_adapter(Adapter)
+    adapter = nonebot.get_adapter(Adapter)
+    await adapter.startup()
+    try:
+        await wait_until(lambda: sum(session.idling for session in imap.sessions) >= accounts, 30)
+        connected = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        memory = sum(stat.size_diff for stat in connected.compare_to(baseline, "filename"))
+        print(f"memory:  {memory / accounts / 1024:.1f} KiB/account ({accounts} accounts)")  # noqa: T201
+
+        total = accounts * mails
+        start = time.perf_counter()
+        for index in range(mails):
+            for account, user in enumerate(users):
+                imap.deliver(user, make_mail(account, index))
+        await wait_until(lambda: len(latencies) >= total, 120)
+        elapsed = time.perf_counter() - start
+        print(f"ingest:  {total / elapsed:.0f} mails/s ({total} mails in {elapsed:.2f}s)")  # noqa: T201
+        p50, p99 = percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+        print(f"latency: p50 {p50:.1f}ms, p99 {p99:.1f}ms")  # noqa: T201
+
+        bot = adapter.bots[users[0]]
+        messages = []
+        for index in range(sends):
+            message = Message()
+            message.to(f"rcpt{index}@example.com")
+            message.subject(f"send {index}")
+            message.set_content("benchmark")
+            messages.append(message)
+        start = time.perf_counter()
+        results = await bot.send_many(messages)  # type: ignore
+        elapsed = time.perf_counter() - start
+        ok = sum(result.ok for result in results)
+        rate = ok / elapsed
+        print(f"send:    {rate:.0f} sends/s ({ok}/{sends} ok, {smtp.connections} SMTP connections)")  # noqa: T201
+    finally:
+        await adapter.shutdown()
+        await imap.close()
+        await smtp.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--mails", type=int, default=200, help="mails per account")
+    parser.add_argument("--sends", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.accounts, args.mails, args.sends))
@@ -0,0 +1,56 @@
+"""对比新邮件头部的解析方式
+
+- legacy: BytesParser -> as_string() -> fast_mail_parser.parse_email (旧的 email_parser)
+- parse_headers: 直接解析 FETCH 返回的头部字节
+
+运行: python benchmarks/bench_header_parser.py [次数]
+"""
+import sys
+import timeit
+from pathlib import Path
+from email import parser
+from email.message import EmailMessage
+
+import nonebot.adapters
+from fast_mail_parser import parse_email
+
+nonebot.adapters.__path__.append(str((Path(__file__).parent.parent / "nonebot" / "adapters").resolve()))  # type: ignore
+
+from nonebot.adapters.email.utils import parse_headers  # noqa: E402
+
+
+def legacy_parser(raw: bytes):
+    raw_email = parser.BytesParser().parsebytes(raw)
+    return parse_email(raw_email.as_string())
+
+
+def sample_header() -> bytes:
+    message = EmailMessage()
+    message["Date"] = "Fri, 25 Aug 2023 02:53:48 +0000"
+    message["Subject"] = "测试邮件: quarterly report 季度报告 " * 3
+    message["From"] = '"张三" <zhang@example.com>'
+    message["To"] = ", ".join(f"收件人{i} <user{i}@example.com>" for i in range(5))
+    message["Cc"] = "bot <bot@none.bot>"
+    message["Message-ID"] = "<20230825025348.12345@example.com>"
+    message["In-Reply-To"] = "<20230824000000.1@example.com>"
+    message["References"] = " ".join(f"<{i}@example.com>" for i in range(10))
+    message["Content-Type"] = "multipart/mixed; boundary=xxxxxxxx"
+    return bytes(message).split(b"\n\n", 1)[0] + b"\n\n"
+
+
+def main() -> None:
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    raw = sample_header()
+    assert parse_headers(raw).subject == legacy_parser(raw).subject
+
+    results = {
+        "legacy": timeit.timeit(lambda: legacy_parser(raw), number=number),
+        "parse_headers": timeit.timeit(lambda: parse_headers(raw), number=number),
+    }
+    for name, seconds in results.items():
+        print(f"{name:>14}: {seconds / number * 1e6:8.2f} us/mail  ({number / seconds:10.0f} mails/s)")  # noqa: T201
+    print(f"{'speedup':>14}: {results['legacy'] / results['parse_headers']:.1f}x")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -2,3 +2,4 @@ from .bot import Bot as Bot
 from .event import Event as Event
 from .adapter import Adapter as Adapter
 from .message import Message as Message
+from .message import MessageTemplate as MessageTemplate
@@ -1,20 +1,52 @@
+import json
 import asyncio
+from email.utils import make_msgid
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import partial
 from typing import Any
-from aioimaplib import AioImapException, Command
+from collections.abc import Callable, Iterable
+from aioimaplib import STOP_WAIT_SERVER_PUSH, Abort, Command, CommandTimeout, quoted
+from aiosmtplib.email import extract_sender, extract_recipients
 from nonebot.typing import overrides
-from nonebot.drivers import Driver
+from nonebot.compat import model_dump
+from nonebot.drivers import URL, Driver, Request, Response, ASGIMixin, HTTPServerSetup
 
 from nonebot.adapters import Adapter as BaseAdapter
 from nonebot.utils import escape_tag
-from nonemail import EmailClient, ConnectReq, ImapResponse, SendReq
+from nonemail import EmailClient, ConnectReq, ImapResponse
 
-from .utils import email_parser
+from .utils import (
+    FetchedMail,
+    MailboxState,
+    ParsedHeaders,
+    backoff_delay,
+    parse_headers,
+    header_fetch_query,
+    parse_fetch_response,
+    format_uid_set,
+    parse_search_response,
+    parse_status,
+    parse_select_response,
+)
 
-from .log import log
+from .log import log, log_enabled, set_log_level
 from .bot import Bot
+from .smtp import SMTPPool, PoolKey, SendResult, flatten_email
+from .spool import Spool, SpoolStore, SpooledMail, TokenBucket, MemorySpoolStore, SQLiteSpoolStore
+from .executor import ParseExecutor
+from .store import CheckpointStore, MemoryCheckpointStore, SQLiteCheckpointStore
+from .dispatch import Dispatcher
+from .folders import SwitchingClient, notify_set, plan_folders
+from .dedup import DedupCache, LRUDedupCache, BloomDedupCache
+from .thread import ThreadIndex, SQLiteThreadStore
+from .cache import PartCache
+from .shard import LeaseStore, ShardCoordinator, default_worker_id
+from .prefilter import SearchCriteria, uid_search, compile_prefilter
+from .compress import enable_compress
+from .metrics import Gauge, Counter, Metrics
 from .event import Event
-from .message import Message
-from .config import Config, ADAPTER_NAME
+from .message import Message, RenderedEmail
+from .config import Config, AccountConfig, ADAPTER_NAME, DEFAULT_MAILBOX
 
 
 class Adapter(BaseAdapter):
@@ -22,10 +54,145 @@ class Adapter(BaseAdapter):
     def __init__(self, driver: Driver, **kwargs: Any):
         super().__init__(driver, **kwargs)
         self.adapter_config = Config(**self.config.dict())
+        self.accounts: dict[str, AccountConfig] = {account.user: account for account in self.adapter_config.accounts}
+        self.email_clients: dict[str, EmailClient] = {}
+        # (user, folder) -> 正在 IDLE 该文件夹的连接; user -> 用于其余文件夹的辅助连接
+        self.folder_clients: dict[tuple[str, str], EmailClient] = {}
+        self.aux_clients: dict[str, SwitchingClient] = {}
+        # user -> 编译后的预过滤条件, 登录后按服务器能力编译
+        self.prefilters: dict[str, SearchCriteria | None] = {}
+        # IMAP4 -> 等待 IDLE 让出连接的命令数
+        self.idle_blockers: dict[Any, int] = {}
+        self._idle_unblocked = asyncio.Condition()
+        # user -> 账号的主连接任务
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.shard = self._create_shard()
+        self.header_query = header_fetch_query(self.adapter_config.imap_fetch_headers)
+        self.parse_executor = ParseExecutor(
+            self.adapter_config.parse_executor,
+            self.adapter_config.parse_workers,
+            self.adapter_config.parse_queue_size,
+        )
+        self.smtp_pool = SMTPPool(
+            max_idle=self.adapter_config.smtp_pool_max_idle,
+            keepalive=self.adapter_config.smtp_pool_keepalive,
+            max_messages=self.adapter_config.smtp_pool_max_messages,
+            max_connections=self.adapter_config.smtp_pool_max_connections,
+        )
+        # SMTP host -> 限速令牌桶, None 表示不限速
+        self.rate_buckets: dict[str, TokenBucket | None] = {}
+        self.spool = self._create_spool()
+        # (user, mailbox) -> 已处理到的 UID, 重连后保留以便继续从断点获取
+        self.mailbox_states: dict[tuple[str, str], MailboxState] = {}
+        self.checkpoint_store: CheckpointStore = (
+            SQLiteCheckpointStore(self.adapter_config.checkpoint_path)
+            if self.adapter_config.checkpoint_store == "sqlite"
+            else MemoryCheckpointStore()
+        )
+        self.dedup = self._create_dedup()
+        self.part_cache = PartCache(
+            self.adapter_config.part_cache_memory,
+            self.adapter_config.part_cache_path,
+            self.adapter_config.part_cache_disk,
+            self.adapter_config.part_cache_spill_size,
+        )
+        self.thread_index = ThreadIndex(
+            self.adapter_config.thread_index_max_size,
+            SQLiteThreadStore(self.adapter_config.thread_index_path, self.adapter_config.thread_index_max_size)
+            if self.adapter_config.thread_index == "sqlite"
+            else None,
+        )
+        self.dispatcher = Dispatcher(self.adapter_config.dispatch_workers, self.adapter_config.dispatch_queue_size)
+        self.metrics = self._create_metrics()
+        # 导出指标的回调, 每 `metrics_export_interval` 秒以 `Metrics.snapshot()` 调用一次
+        self.metrics_exporters: list[Callable[[dict[str, Any]], Any]] = []
+        self._metrics_task: asyncio.Task | None = None
+        set_log_level(self.config.log_level)
         # setup adapter
         log("DEBUG", f"Adapter config: {self.adapter_config}")
         self.setup()
 
+    def _create_dedup(self) -> DedupCache | None:
+        config = self.adapter_config
+        match config.dedup:
+            case "lru":
+                return LRUDedupCache(config.dedup_max_size, config.dedup_ttl)
+            case "bloom":
+                return BloomDedupCache(config.dedup_bloom_capacity, config.dedup_bloom_error_rate)
+            case _:
+                return None
+
+    def _create_spool(self) -> Spool | None:
+        config = self.adapter_config
+        if config.smtp_spool == "none":
+            return None
+        store: SpoolStore = (
+            SQLiteSpoolStore(config.smtp_spool_path) if config.smtp_spool == "sqlite" else MemorySpoolStore()
+        )
+        return Spool(
+            store,
+            self._deliver_spooled,
+            self._rate_bucket,
+            config.smtp_spool_concurrency,
+            config.smtp_spool_max_attempts,
+            config.smtp_retry_base_delay,
+            config.smtp_retry_max_delay,
+            self._owns_account,
+        )
+
+    def _create_shard(self) -> ShardCoordinator | None:
+        config = self.adapter_config
+        if config.shard_lease_path is None:
+            return None
+        return ShardCoordinator(
+            # 等待写锁不超过一次心跳的间隔, 超时后下一轮重试
+            LeaseStore(config.shard_lease_path, config.shard_lease_ttl / 3),
+            config.shard_worker_id or default_worker_id(),
+            self.accounts,
+            config.shard_lease_ttl,
+            config.shard_replicas,
+            self._start_account,
+            self._stop_account,
+        )
+
+    def _owns_account(self, user: str) -> bool:
+        return self.shard is None or user in self.shard.owned
+
+    def _create_metrics(self) -> Metrics:
+        metrics = Metrics()
+        metrics.dispatch_queue_depth.function = lambda: self.dispatcher.pending
+        if self.dedup is not None:
+            dedup = self.dedup
+            metrics.register(Counter("email_dedup_hits_total", "duplicate events skipped", function=lambda: dedup.hits))
+            metrics.register(Counter("email_dedup_misses_total", "events passed dedup", function=lambda: dedup.misses))
+        if self.shard is not None:
+            shard = self.shard
+            metrics.register(Gauge("email_shard_accounts", "accounts watched by this worker", lambda: len(shard.owned)))
+        cache = self.part_cache
+        metrics.register(
+            Counter("email_part_cache_hits_total", "parts served from the local cache", function=lambda: cache.hits)
+        )
+        metrics.register(
+            Counter("email_part_cache_misses_total", "parts fetched from the server", function=lambda: cache.misses)
+        )
+        for name, documentation, function in (
+            ("email_part_cache_memory_bytes", "bytes of parts cached in memory", lambda: cache.memory_size),
+            ("email_part_cache_disk_bytes", "bytes of parts cached on disk", lambda: cache.disk_size),
+        ):
+            metrics.register(Gauge(name, documentation, function))
+        thread_index = self.thread_index
+        metrics.register(Gauge("email_thread_index_size", "messages in the thread index", lambda: len(thread_index)))
+        if self.spool is not None:
+            spool = self.spool
+            metrics.register(Gauge("email_spool_size", "mails waiting in the outbound spool", lambda: len(spool.store)))
+            metrics.register(
+                Counter("email_spool_retries_total", "transient failures retried", function=lambda: spool.retries)
+            )
+            metrics.register(
+                Counter("email_spool_dropped_total", "mails dropped after max attempts", function=lambda: spool.dropped)
+            )
+        return metrics
+
     @classmethod
     @overrides(BaseAdapter)
     def get_name(cls) -> str:
@@ -36,72 +203,373 @@ class Adapter(BaseAdapter):
         self.driver.on_startup(self.startup)
         # on NoneBot shutdown
         self.driver.on_shutdown(self.shutdown)
+        if path := self.adapter_config.metrics_path:
+            if isinstance(self.driver, ASGIMixin):
+                self.setup_http_server(HTTPServerSetup(URL(path), "GET", "email_metrics", self._handle_metrics))
+            else:
+                log("WARNING", f"Driver {self.driver.type} can not serve metrics at {path}")
 
-    async def startup(self) -> None:
-        connect_req = ConnectReq(
-            self.adapter_config.imap_host,
-            self.adapter_config.imap_port,
-            self.adapter_config.user,
-            self.adapter_config.password,
+    async def _handle_metrics(self, request: Request) -> Response:
+        return Response(
+            200,
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            content=self.metrics.render_prometheus(),
         )
-        log("INFO", f"Connecting to {connect_req.server}:{connect_req.port}...")
-        # TODO: 多账号支持(还没想好怎么安排账号和密码在配置里的对应问题)
-        self.tasks = [asyncio.create_task(self._start_imap(connect_req))]
 
-    async def _start_imap(self, req: ConnectReq) -> None:
+    async def _export_metrics(self) -> None:
+        while True:
+            await asyncio.sleep(self.adapter_config.metrics_export_interval)
+            if not self.metrics_exporters:
+                continue
+            snapshot = self.metrics.snapshot()
+            for exporter in self.metrics_exporters:
+                try:
+                    result = exporter(snapshot)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    log("ERROR", "Metrics exporter error", exception=e)
+
+    async def startup(self) -> None:
+        self.smtp_pool.start()
+        self.dispatcher.start()
+        if self.spool is not None:
+            self.spool.start()
+        self._metrics_task = asyncio.create_task(self._export_metrics())
+        # 限制同时进行中的登录数量, 避免大量账号同时重连
+        self._login_semaphore = asyncio.Semaphore(self.adapter_config.imap_max_concurrent_logins)
+        if self.shard is not None:
+            log("INFO", f"Shard worker {self.shard.worker_id} joining...")
+            self.shard.start()
+            return
+        for user in self.accounts:
+            self._start_account(user)
+        log("INFO", f"Starting {len(self.tasks)} IMAP session(s)...")
+
+    def _start_account(self, user: str) -> None:
+        self.tasks[user] = asyncio.create_task(self._start_imap(self.accounts[user]))
+        if self.spool is not None:
+            self.spool.wakeup()
+
+    async def _stop_account(self, user: str) -> None:
+        """停止监听账号, 之后可能由其他 worker 接手"""
+        if (task := self.tasks.pop(user, None)) is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        # 接手的 worker 会推进断点, 再次持有时需从断点库重新载入
+        for key in [key for key in self.mailbox_states if key[0] == user]:
+            del self.mailbox_states[key]
+
+    async def _start_imap(self, account: AccountConfig) -> None:
+        """账号的主连接: SELECT 第一个文件夹并 IDLE, 同时负责其余文件夹的监听"""
+        req = ConnectReq(account.imap_host, account.imap_port, account.user, account.password)
+        folders = account.folders or [DEFAULT_MAILBOX]
         bot: Bot | None = None
-        self.email_clients: dict[str, EmailClient] = {}
+        attempt = 0
         while True:
-            log("TRACE", "loop imap")
+            log("TRACE", f"loop imap {req.username}")
             try:
-                async with EmailClient(req) as client:
-                    log("TRACE", f"{req.username} pre connecting...")
-
-                    while True:
-                        if not bot:
-                            self.email_clients[req.username] = client
-                            bot = Bot(self, req.username)
-                            self.bot_connect(bot)
-                            log("SUCCESS", f"<blue>Bot {bot.self_id} connected</blue>")
-                        try:
-                            await client.idle_start(timeout=req.timeout)
-                            log("TRACE", "imap client idle start")
-                            resp = await client.receive(
-                                timeout=req.timeout + 5
-                            )  # FIXME: 时间不大于idle_start的timeout就会不进行循环
-                            log("TRACE", f"imap client received: {resp}")
-
-                            event = await self.convert_to_event(bot, resp)
-
-                            if event is None:
-                                log("TRACE", "event is None")
-                                log("TRACE", "will done idle")
-                                client.idle_done()
-                            else:
-                                log("DEBUG", f"event: {escape_tag(event.json(indent=4, ensure_ascii=False))}")
-                                asyncio.create_task(bot.handle_event(event))
-
-                            log("TRACE", "imap client wait for next loop...")
-                        except asyncio.TimeoutError:
-                            log("WARNING", "imap client timeout")
-                            client.idle_done()
-                            continue
-                        except AioImapException as e:
-                            log("ERROR", "IMAP4 Receive Error", exception=e)
-                            await asyncio.sleep(5)
-                            self._pop(bot)
-                            bot = None
-                            log("DEBUG", f"bot now is {bot}")
-                            break
+                async with AsyncExitStack() as stack:
+                    async with self._login_semaphore:
+                        log("INFO", f"Connecting {req.username} to {req.server}:{req.port}...")
+                        client = await self._connect(stack, req)
+                        log("TRACE", f"{req.username} pre connecting...")
+                        await self._sync_mailbox_state(client, req.username, folders[0])
+                    attempt = 0
+                    self.prefilters[req.username] = compile_prefilter(
+                        account.prefilter, client.impl.has_capability("X-GM-EXT-1")
+                    )
+
+                    self.email_clients[req.username] = client
+                    self.folder_clients[(req.username, folders[0])] = client
+                    stack.callback(self.folder_clients.pop, (req.username, folders[0]), None)
+                    bot = Bot(self, req.username)
+                    self.bot_connect(bot)
+                    log("SUCCESS", f"<blue>Bot {bot.self_id} connected</blue>")
+                    await self._watch_folders(stack, bot, account, client)
+                    if self.adapter_config.imap_catchup:
+                        await self.catch_up(bot, folders[0])
+                    await self._idle_loop(bot, client, req.timeout, folders[0])
 
             except Exception as e:
-                log("ERROR", "IMAP4 Error", exception=e)
-                await asyncio.sleep(10)
+                log("ERROR", f"IMAP4 Error ({req.username})", exception=e)
             finally:
                 self._pop(bot)
                 bot = None
                 log("DEBUG", f"Now bot is {bot}")
 
+            attempt = await self._reconnect_wait(req.username, attempt)
+
+    async def _connect(self, stack: AsyncExitStack, req: ConnectReq) -> EmailClient:
+        """登录, 服务器支持时启用 COMPRESS=DEFLATE; 连接随 `stack` 关闭"""
+        client = await stack.enter_async_context(EmailClient(req))
+        # 关闭时若仍在 IDLE, 先结束 IDLE, 否则 LOGOUT 要等到 IDLE 结束或超时
+        stack.callback(self._end_idle, client.impl)
+        if self.adapter_config.imap_compress and client.impl.has_capability("COMPRESS=DEFLATE"):
+            try:
+                enabled = await enable_compress(client)
+            except (Abort, CommandTimeout) as e:
+                log("WARNING", f"{req.username} COMPRESS=DEFLATE failed, continue without compression", exception=e)
+            else:
+                if enabled:
+                    log("DEBUG", f"{req.username} COMPRESS=DEFLATE enabled")
+                else:
+                    log("WARNING", f"{req.username} COMPRESS=DEFLATE failed, continue without compression")
+        return client
+
+    @staticmethod
+    def _end_idle(client_impl: Any) -> None:
+        if client_impl.protocol is not None and client_impl.has_pending_idle():
+            client_impl.idle_done()
+
+    async def _watch_folders(self, stack: AsyncExitStack, bot: Bot, account: AccountConfig, client: EmailClient):
+        """按服务器能力安排其余文件夹, 所有连接和任务都随主连接一起关闭"""
+        config = self.adapter_config
+        plan = plan_folders(
+            account.folders or [DEFAULT_MAILBOX],
+            account.poll_folders or [],
+            config.imap_use_notify and client.impl.has_capability("NOTIFY"),
+            config.imap_max_idle_connections,
+        )
+        log("DEBUG", f"{bot.self_id} folders: {plan}")
+        if plan.notify or plan.poll:
+            req = ConnectReq(account.imap_host, account.imap_port, account.user, account.password)
+            async with self._login_semaphore:
+                switching = SwitchingClient(await self._connect(stack, req))
+            self.aux_clients[bot.self_id] = switching
+            stack.callback(self.aux_clients.pop, bot.self_id, None)
+            for folder in plan.notify + plan.poll:
+                await self._sync_status_state(switching, bot.self_id, folder)
+        if plan.notify and not await notify_set(client, plan.notify):
+            log("WARNING", f"{bot.self_id} NOTIFY failed, poll {plan.notify} instead")
+            plan = plan._replace(notify=[], poll=plan.notify + plan.poll)
+        if config.imap_catchup:
+            for folder in plan.notify + plan.poll:
+                await self.catch_up(bot, folder)
+
+        tasks = [asyncio.create_task(self._watch_folder(bot, account, folder)) for folder in plan.idle]
+        if plan.poll:
+            tasks.append(asyncio.create_task(self._poll_folders(bot, plan.poll)))
+
+        async def cancel_tasks():
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        stack.push_async_callback(cancel_tasks)
+
+    async def _watch_folder(self, bot: Bot, account: AccountConfig, folder: str) -> None:
+        """服务器不支持 NOTIFY 时, 额外的文件夹各自用一条连接 IDLE"""
+        req = ConnectReq(account.imap_host, account.imap_port, account.user, account.password)
+        attempt = 0
+        while True:
+            try:
+                async with AsyncExitStack() as stack:
+                    async with self._login_semaphore:
+                        client = await self._connect(stack, req)
+                        await self._sync_mailbox_state(client, req.username, folder)
+                    attempt = 0
+                    self.folder_clients[(req.username, folder)] = client
+                    stack.callback(self.folder_clients.pop, (req.username, folder), None)
+                    if self.adapter_config.imap_catchup:
+                        await self.catch_up(bot, folder)
+                    await self._idle_loop(bot, client, req.timeout, folder)
+            except Exception as e:
+                log("ERROR", f"IMAP4 Error ({req.username}/{folder})", exception=e)
+            attempt = await self._reconnect_wait(f"{req.username}/{folder}", attempt)
+
+    async def _poll_folders(self, bot: Bot, folders: list[str]) -> None:
+        """低优先级的文件夹只定时 STATUS, UIDNEXT 变化时才获取"""
+        while True:
+            await asyncio.sleep(self.adapter_config.imap_poll_interval)
+            switching = self.aux_clients[bot.self_id]
+            for folder in folders:
+                try:
+                    resp = await switching.status(folder)
+                    for line in resp.lines[:-1]:
+                        if (status := parse_status(line)) and self._status_changed(bot.self_id, folder, status[1]):
+                            await self._dispatch(bot, await self.fetch_new_mails(bot, folder))
+                except Exception as e:
+                    log("ERROR", f"Poll {bot.self_id}/{folder} Error", exception=e)
+
+    async def _idle_loop(self, bot: Bot, client: EmailClient, timeout: int, mailbox: str) -> None:
+        """IDLE 状态机: idle -> draining -> command -> idle
+
+        - idle: 等待服务器推送; 在 `imap_idle_timeout` 到期前由 aioimaplib 推入 STOP, 以便按时重新 IDLE
+        - draining: 结束 IDLE 并等待其完成, 把这次唤醒中收到的所有响应合并成一批
+        - command: 连接空闲, 按这批响应获取新邮件; 其他协程等待中的命令也在此时执行
+        """
+        client_impl = client.impl
+        config = self.adapter_config
+        renew = max(config.imap_idle_timeout - config.imap_idle_renew_margin, 1)
+        while True:
+            async with self._idle_unblocked:
+                await self._idle_unblocked.wait_for(lambda: client_impl not in self.idle_blockers)
+            # 连接让出期间推入的 STOP 已经没有意义
+            while not client_impl.protocol.idle_queue.empty():
+                client_impl.protocol.idle_queue.get_nowait()
+            idle = await client_impl.idle_start(timeout=renew)
+            log("TRACE", f"{bot.self_id}/{mailbox} idle")
+            # STOP 最迟在 renew 秒后到达, 多等 timeout 秒仍无响应说明连接已失效
+            pushed = [await client_impl.wait_server_push(timeout=renew + timeout)]
+
+            if not idle.done():
+                client_impl.idle_done()
+            await asyncio.wait_for(idle, timeout)
+            # DONE 之前服务器发出的响应都已在 IDLE 完成前到达
+            while not client_impl.protocol.idle_queue.empty():
+                pushed.append(client_impl.protocol.idle_queue.get_nowait())
+
+            lines = [line for resp in pushed if resp != STOP_WAIT_SERVER_PUSH for line in resp]
+            self.metrics.idle_wakeups.inc(account=bot.self_id, folder=mailbox)
+            log("TRACE", f"{bot.self_id}/{mailbox} wakeup: {len(pushed)} push(es), {len(lines)} line(s)")
+            if lines:
+                await self._dispatch(bot, await self.convert_to_event(bot, lines, mailbox))
+
+    async def _reconnect_wait(self, name: str, attempt: int) -> int:
+        delay = backoff_delay(
+            attempt,
+            self.adapter_config.imap_reconnect_base_delay,
+            self.adapter_config.imap_reconnect_max_delay,
+        )
+        attempt += 1
+        self.metrics.reconnects.inc(account=name)
+        log("INFO", f"{name} reconnect in {delay:.1f}s (attempt {attempt})")
+        await asyncio.sleep(delay)
+        return attempt
+
+    async def _sync_mailbox_state(self, client: EmailClient, username: str, mailbox: str = DEFAULT_MAILBOX) -> None:
+        """选中文件夹并载入断点; 没有断点或 UIDVALIDITY 变化时从当前的 UIDNEXT 开始"""
+        resp = await client.impl.select(quoted(mailbox))
+        if resp.result != "OK":
+            raise RuntimeError(f"select {mailbox} failed: {resp.lines[-1:]}")
+        uidvalidity, uidnext = parse_select_response(resp)
+        if self._resume_state(username, mailbox, uidvalidity):
+            return
+        if uidnext is None:
+            # 服务器未在 SELECT 中给出 UIDNEXT 时, 以当前最大的 UID 为准
+            last = parse_fetch_response(await client.impl.uid("fetch", "*", "(UID)"))
+            uidnext = last[-1].uid + 1 if last else 1
+        self._update_state(username, mailbox, MailboxState(uidvalidity, uidnext - 1))
+        log("DEBUG", f"{username}/{mailbox} state: {self.mailbox_states[(username, mailbox)]}")
+
+    async def _sync_status_state(self, switching: SwitchingClient, username: str, mailbox: str) -> None:
+        """同 `_sync_mailbox_state`, 但用 STATUS 获取, 不改变辅助连接选中的文件夹"""
+        resp = await switching.status(mailbox)
+        items = next((status[1] for line in resp.lines[:-1] if (status := parse_status(line))), {})
+        if not self._resume_state(username, mailbox, items.get("UIDVALIDITY")):
+            self._update_state(username, mailbox, MailboxState(items.get("UIDVALIDITY"), items.get("UIDNEXT", 1) - 1))
+
+    def _resume_state(self, username: str, mailbox: str, uidvalidity: int | None) -> bool:
+        state = self.mailbox_states.get((username, mailbox))
+        if state is None and self.adapter_config.imap_catchup:
+            state = self.checkpoint_store.load(username, mailbox)
+        if state and state.uidvalidity == uidvalidity:
+            log("DEBUG", f"{username}/{mailbox} resume from uid {state.last_uid}")
+            self.mailbox_states[(username, mailbox)] = state
+            return True
+        if state:
+            log("WARNING", f"{username}/{mailbox} UIDVALIDITY changed ({state.uidvalidity} -> {uidvalidity})")
+        return False
+
+    def _status_changed(self, username: str, mailbox: str, items: dict[str, int]) -> bool:
+        """根据 STATUS 判断文件夹是否有新邮件, UIDVALIDITY 变化时重置断点"""
+        state = self.mailbox_states.get((username, mailbox), MailboxState(None, 0))
+        if "UIDVALIDITY" in items and items["UIDVALIDITY"] != state.uidvalidity:
+            if not self._resume_state(username, mailbox, items["UIDVALIDITY"]):
+                self._update_state(username, mailbox, MailboxState(items["UIDVALIDITY"], items.get("UIDNEXT", 1) - 1))
+            return False
+        return "UIDNEXT" in items and items["UIDNEXT"] - 1 > state.last_uid
+
+    @asynccontextmanager
+    async def _folder_client(self, username: str, mailbox: str):
+        """取得已选中 `mailbox` 的连接: IDLE 该文件夹的连接, 或切换到该文件夹的辅助连接"""
+        if client := self.folder_clients.get((username, mailbox)):
+            yield client.impl
+        elif switching := self.aux_clients.get(username):
+            async with switching.folder(mailbox) as client_impl:
+                yield client_impl
+        else:
+            raise KeyError(f"{username} is not watching {mailbox}")
+
+    def _update_state(self, username: str, mailbox: str, state: MailboxState) -> None:
+        self.mailbox_states[(username, mailbox)] = state
+        self.checkpoint_store.save(username, mailbox, state)
+
+    async def catch_up(self, bot: Bot, mailbox: str = DEFAULT_MAILBOX) -> None:
+        """补发断点之后到达的邮件: 先 UID SEARCH 得到缺失的 UID, 再分批 FETCH 并分发"""
+        if (bot.self_id, mailbox) not in self.mailbox_states:
+            return
+        uids, matched = await self._search_new(bot, mailbox)
+        if not uids:
+            return
+        log("INFO", f"{bot.self_id}/{mailbox} catching up {len(matched)} of {len(uids)} mail(s)")
+        batch = self.adapter_config.imap_catchup_batch
+        for i in range(0, len(matched), batch):
+            events = await self.fetch_mails(bot, format_uid_set(matched[i : i + batch]), mailbox)
+            await self._dispatch(bot, events)
+        self._skip_unmatched(bot.self_id, mailbox, uids, matched)
+
+    async def _search_new(self, bot: Bot, mailbox: str) -> tuple[list[int], list[int]]:
+        """UID SEARCH 断点之后的邮件, 返回 (所有新邮件, 其中命中预过滤的邮件)"""
+        state = self.mailbox_states.get((bot.self_id, mailbox), MailboxState(None, 0))
+        prefilter = self.prefilters.get(bot.self_id)
+        async with self._folder_client(bot.self_id, mailbox) as client_impl:
+            resp = await client_impl.uid_search(f"UID {state.last_uid + 1}:*", charset=None)
+            uids = sorted(uid for uid in parse_search_response(resp) if uid > state.last_uid)
+            if not uids or prefilter is None:
+                return uids, uids
+            # 限定在已知的新 UID 内, 搜索期间到达的邮件留给下一次唤醒
+            resp = await uid_search(client_impl, format_uid_set(uids), prefilter)
+        if resp.result != "OK":
+            log("WARNING", f"{bot.self_id}/{mailbox} prefilter search failed, fetch all: {resp.lines[-1:]}")
+            return uids, uids
+        found = set(parse_search_response(resp))
+        return uids, [uid for uid in uids if uid in found]
+
+    def _skip_unmatched(self, username: str, mailbox: str, uids: list[int], matched: list[int]) -> None:
+        """未命中预过滤的邮件不获取, 直接把断点推进到最后一封新邮件"""
+        if skipped := len(uids) - len(matched):
+            self.metrics.prefilter_skipped.inc(skipped, account=username, folder=mailbox)
+            log("DEBUG", f"{username}/{mailbox} prefilter skipped {skipped} mail(s)")
+        state = self.mailbox_states.get((username, mailbox))
+        if state is not None and uids and uids[-1] > state.last_uid:
+            self._update_state(username, mailbox, state._replace(last_uid=uids[-1]))
+
+    async def _dispatch(self, bot: Bot, events: list[Event]) -> None:
+        for event in events:
+            if self._is_duplicate(event):
+                log("DEBUG", f"skip duplicate event: uid {event.uid} {escape_tag(event.message_id)}")
+                continue
+            if log_enabled("DEBUG"):
+                self._log_event(event)
+            session = f"{bot.self_id}:{event.get_session_id()}"
+            await self.dispatcher.submit(session, partial(self._handle_event, bot, event))
+
+    @staticmethod
+    def _log_event(event: Event) -> None:
+        """事件已记录去重且断点已推进, 格式化失败也不能影响分发"""
+        try:
+            dumped = json.dumps(model_dump(event), indent=4, ensure_ascii=False, default=str)
+        except Exception as e:
+            log("WARNING", f"Can not format event (uid {event.uid})", exception=e)
+            return
+        log("DEBUG", f"event: {escape_tag(dumped)}")
+
+    async def _handle_event(self, bot: Bot, event: Event) -> None:
+        with self.metrics.handler_seconds.time():
+            await bot.handle_event(event)
+
+    def _is_duplicate(self, event: Event) -> bool:
+        if self.dedup is None:
+            return False
+        keys: list[tuple[str, ...]] = []
+        if event.uid is not None:
+            keys.append((event.self_id, event.folder, str(event.uidvalidity), str(event.uid)))
+        if self.adapter_config.dedup_by_message_id and event.message_id:
+            keys.append(("message-id", event.message_id))
+        return bool(keys) and self.dedup.seen(keys)
+
     def _pop(self, bot: Bot | None):
         if not bot:
             return
@@ -111,10 +579,25 @@ class Adapter(BaseAdapter):
 
     async def shutdown(self) -> None:
         """关闭IMAP4连接"""
-        for task in self.tasks:
-            if not task.done():
+        if self.shard is not None:
+            # 先释放租约, 其他 worker 可以在本进程退出前接手
+            await self.shard.close()
+            self.shard.store.close()
+        for task in [*self.tasks.values(), self._metrics_task]:
+            if task is not None and not task.done():
                 task.cancel()
-        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        # 处理中的事件可能还要发信, 先等它们结束再关闭连接池
+        await self.dispatcher.close(self.adapter_config.dispatch_drain_timeout)
+        if self.spool is not None:
+            # 未发送的邮件留在队列中, 下次启动后继续发送
+            await self.spool.close(self.adapter_config.dispatch_drain_timeout)
+            self.spool.store.close()
+        await self.smtp_pool.close()
+        self.parse_executor.shutdown()
+        self.checkpoint_store.close()
+        self.thread_index.close()
+        self.part_cache.close()
 
     @overrides(BaseAdapter)
     async def _call_api(self, bot: Bot, api: str, *data: str) -> ImapResponse | None:
@@ -122,70 +605,257 @@ class Adapter(BaseAdapter):
         if impl_procotol := self.email_clients[bot.self_id].impl.protocol:
             return await impl_procotol.execute(Command(api, *data))
 
+    async def uid_fetch(self, bot: Bot, uid_set: str, query: str, mailbox: str = DEFAULT_MAILBOX) -> ImapResponse:
+        """在选中了 `mailbox` 的连接上执行 UID FETCH
+
+        若该连接正在 IDLE, 先让 IDLE 循环结束当前的 IDLE (它随后会自动重新 IDLE), 否则命令会一直等待 IDLE 结束
+        """
+        async with self._folder_client(bot.self_id, mailbox) as client_impl:
+            # 命令完成前 IDLE 循环不会重新 IDLE, 否则它可能抢在命令之前再次进入 IDLE
+            self.idle_blockers[client_impl] = self.idle_blockers.get(client_impl, 0) + 1
+            try:
+                await client_impl.stop_wait_server_push()
+                return await client_impl.uid("fetch", uid_set, query)
+            finally:
+                if not (blockers := self.idle_blockers.pop(client_impl) - 1):
+                    async with self._idle_unblocked:
+                        self._idle_unblocked.notify_all()
+                else:
+                    self.idle_blockers[client_impl] = blockers
+
+    def fill_reply_headers(self, event: Event, message: Message) -> None:
+        """回复 `event` 时补全 In-Reply-To/References, 并记录这封回复所在的会话
+
+        已经设置了 In-Reply-To 的邮件不做修改; 没有 Message-ID 时生成一个, 以便对方的回复能归入同一会话
+        """
+        email = message.email
+        static = email.template.static if isinstance(email, RenderedEmail) else set()
+        if not event.message_id or "In-Reply-To" in email or "in-reply-to" in static:
+            return
+        headers = self.thread_index.reply_headers(event.message_id)
+        if headers is None:
+            # 会话索引中的记录已被淘汰
+            self.thread_index.add(event.message_id, event.headers.get("In-Reply-To"), event.headers.get("References"))
+            headers = self.thread_index.reply_headers(event.message_id)
+            assert headers is not None
+        in_reply_to, references = headers
+        email["In-Reply-To"] = in_reply_to
+        if "References" not in email and "references" not in static:
+            email["References"] = references
+        if (message_id := email.get("Message-ID")) is None and "message-id" not in static:
+            message_id = email["Message-ID"] = make_msgid(domain=event.self_id.rpartition("@")[2] or None)
+        if message_id:
+            self.thread_index.add(message_id, in_reply_to, references)
+
     def mailbox_operate(self, bot: Bot):
         """获取EmailClient实例, 用于调用其封装好的方法"""
         return self.email_clients[bot.self_id].impl
 
-    async def send_to(self, bot_id: str, message: Message, **kwargs: Any) -> None:
-        email_client = self.email_clients.get(bot_id, None)
-        if email_client is None:
-            log("ERROR", f"<red>Bot {bot_id}'s email client not found</red>")
-            return
-        return await self._send(email_client, message, **kwargs)
+    async def send_to(self, bot_id: str, message: Message, **kwargs: Any) -> Any:
+        """启用发件队列时入队后立即返回队列中的 id, 否则直接发送并返回 (收件人, 被拒收的收件人)
 
-    async def _send(self, email_client: EmailClient, message: Message, **kwargs: Any):
-        log(
-            "TRACE",
-            f"send:\n{message.email}\n\nserver: {self.adapter_config.smtp_host}:{self.adapter_config.smtp_port}",
-        )
-        # FIXME: 没有显式指定用户名
-        send_req = SendReq(
-            server=self.adapter_config.smtp_host,
-            port=self.adapter_config.smtp_port,
-            message=message.email,
-            password=self.adapter_config.password,
-            use_tls=self.adapter_config.smtp_use_tls,
-            **kwargs,
-        )
-        return await email_client.send(send_req)
+        指定了 `username`/`password` 的邮件不入队; 入队时只支持 `sender`/`recipients` 参数
+        """
+        account = self.accounts.get(bot_id)
+        if account is None:
+            raise ValueError(f"Bot {bot_id} has no email account")
+        if self.spool is None or "username" in kwargs or "password" in kwargs:
+            return await self._send(account, message, **kwargs)
+        if unsupported := sorted(set(kwargs) - {"sender", "recipients"}):
+            raise ValueError(
+                f"Unsupported arguments for spooled mail: {', '.join(unsupported)}; "
+                "only sender and recipients are supported, set SMTP_SPOOL=none to send directly"
+            )
+        return await self._enqueue(account, message, **kwargs)
 
-    async def convert_to_event(self, bot: Bot, resp: Any):
-        if not resp:
+    async def _enqueue(
+        self, account: AccountConfig, message: Message, sender: str | None = None, recipients: list[str] | None = None
+    ) -> int:
+        assert self.spool is not None
+        email = message.email
+        sender = sender or extract_sender(email)
+        recipients = recipients or extract_recipients(email)
+        if sender is None:
+            raise ValueError("No From header provided in message")
+        if not recipients:
+            raise ValueError("No recipient headers provided in message")
+        utf8 = not (sender + "".join(recipients)).isascii()
+        id = await self.spool.put(account.user, sender, recipients, flatten_email(email, "8bit", utf8), utf8)
+        log("DEBUG", f"Mail {id} to {recipients} queued")
+        return id
+
+    async def _deliver_spooled(self, mail: SpooledMail):
+        account = self.accounts[mail.account]
+        key = PoolKey(account.smtp_host, account.smtp_port, account.user)
+        with self.metrics.smtp_send_seconds.time(account=account.user):
+            return await self.smtp_pool.send_raw(
+                key, account.password, account.smtp_use_tls, mail.sender, mail.recipients, mail.data, mail.utf8
+            )
+
+    def _rate_bucket(self, user: str) -> TokenBucket | None:
+        """同一 SMTP 服务器 (服务商) 的所有账号共用一个令牌桶"""
+        if (account := self.accounts.get(user)) is None or account.smtp_host is None:
             return None
+        host = account.smtp_host
+        if host not in self.rate_buckets:
+            config = self.adapter_config
+            rate = config.smtp_rate_limits.get(host, config.smtp_rate_limit)
+            self.rate_buckets[host] = TokenBucket(rate, config.smtp_rate_burst) if rate else None
+        return self.rate_buckets[host]
 
-        log("TRACE", f"convert_to_event: {resp}")
-        assert isinstance(resp, list)
-        match resp[0].lower():
-            case b"stop_wait_server_push":
-                log("DEBUG", "resp is stop_wait_server_push, ignore")
-                return None
-            case exists if exists.endswith(b"exists"):
-                msg_id, _ = exists.decode("utf-8").split()
-                log("DEBUG", f"new mail: {msg_id}")
+    async def _wait_rate_limit(self, user: str) -> None:
+        if (bucket := self._rate_bucket(user)) is not None:
+            while wait := bucket.take():
+                await asyncio.sleep(wait)
+
+    async def _send(self, account: AccountConfig, message: Message, **kwargs: Any):
+        if log_enabled("TRACE"):
+            log(
+                "TRACE",
+                f"send:\n{message.email}\n\nserver: {account.smtp_host}:{account.smtp_port}",
+            )
+        # 同一 (host, port, user) 的发送复用连接池中的连接, 避免每封邮件都重新握手和登录
+        key = PoolKey(account.smtp_host, account.smtp_port, kwargs.pop("username", account.user))
+        password = kwargs.pop("password", account.password)
+        with self.metrics.smtp_send_seconds.time(account=account.user):
+            return await self.smtp_pool.send(key, password, account.smtp_use_tls, message.email, **kwargs)
+
+    async def send_batch(
+        self, bot_id: str, messages: Iterable[Message], concurrency: int | None = None
+    ) -> list[SendResult]:
+        """通过连接池并发发送多封邮件, 按输入顺序返回每封邮件的结果
+
+        失败不会中断其余邮件, 可以只重试 `not result.ok` 的部分; 与发件队列共用 SMTP 服务器的限速
+        """
+        account = self.accounts[bot_id]
+        key = PoolKey(account.smtp_host, account.smtp_port, account.user)
+        limit = asyncio.Semaphore(concurrency or self.adapter_config.smtp_pool_max_connections)
+
+        async def send_one(message: Message) -> SendResult:
+            async with limit:
+                await self._wait_rate_limit(account.user)
                 try:
-                    client_impl = self.mailbox_operate(bot)
-                    # FIXME:对邮箱进行操作前需要idle_done, 这潜在的会导致外面那个循环重复idle_done
-                    # 不结束idle会一直卡在fetch
-                    client_impl.idle_done()
-
-                    raw_mail_header = await client_impl.fetch(msg_id, "BODY[HEADER]")
-                    log("DEBUG", f"Fetch result: {raw_mail_header.result}")
-                    log("TRACE", f"{escape_tag(str(raw_mail_header.lines))}")
-                    parsed_mail = email_parser(raw_mail_header)
-                    event = Event(
-                        self_id=bot.self_id,
-                        date=parsed_mail.date,
-                        subject=parsed_mail.subject,
-                        mail_id=msg_id,
-                        headers=parsed_mail.headers,
-                        mime_types=[part.mimetype for part in parsed_mail.attachments],
-                    )
-                    log("DEBUG", "<green><b>new mail</b></green>\n" + escape_tag(str(event)))
+                    with self.metrics.smtp_send_seconds.time(account=account.user):
+                        recipients, refused = await self.smtp_pool.send(
+                            key, account.password, account.smtp_use_tls, message.email
+                        )
                 except Exception as e:
-                    log("ERROR", "Parse Mail Error", exception=e)
-                    return None
-                else:
-                    return event
-            case unknown:
-                log("WARNING", f"unknown resp: {unknown}")
-                return None
+                    log("WARNING", f"send to {message.email.get('To')} failed: {e!r}")
+                    return SendResult(message, [], {}, e)
+                return SendResult(message, recipients, refused)
+
+        results = await asyncio.gather(*(send_one(message) for message in messages))
+        log("INFO", f"Bot {bot_id} sent {sum(result.ok for result in results)}/{len(results)} mails")
+        return results
+
+    async def convert_to_event(self, bot: Bot, resp: Any, mailbox: str = DEFAULT_MAILBOX) -> list[Event]:
+        """根据一次唤醒中合并的响应行获取新邮件, 调用时连接不能处于 IDLE"""
+        if not resp:
+            return []
+
+        if log_enabled("TRACE"):
+            log("TRACE", f"convert_to_event: {resp}")
+        assert isinstance(resp, list)
+        # NOTIFY 以 STATUS 推送其他文件夹的变化
+        changed = [
+            status[0]
+            for line in resp
+            if line[:7].upper() == b"STATUS " and (status := parse_status(line))
+            if status[0] != mailbox and self._status_changed(bot.self_id, *status)
+        ]
+        exists = any(line.lower().endswith(b"exists") for line in resp)
+        if not changed and not exists:
+            # EXPUNGE, FETCH (FLAGS) 等与新邮件无关
+            if log_enabled("TRACE"):
+                log("TRACE", f"ignore resp: {resp}")
+            return []
+
+        # 一次唤醒中可能有多条 EXISTS, 统一用一次 UID FETCH 获取所有新邮件
+        log("DEBUG", f"new mail: {resp}")
+        events: list[Event] = []
+        for folder in [mailbox] * exists + list(dict.fromkeys(changed)):
+            try:
+                events += await self.fetch_new_mails(bot, folder)
+            except Exception as e:
+                log("ERROR", f"Fetch Mail Error ({folder})", exception=e)
+        return events
+
+    async def fetch_new_mails(self, bot: Bot, mailbox: str = DEFAULT_MAILBOX) -> list[Event]:
+        """先 UID SEARCH 得到上次之后到达的邮件, 再按 `imap_fetch_batch` 分批 UID FETCH 头部
+
+        每批不超过 `parse_queue_size`, 一批解析完成后才获取下一批;
+        配置了预过滤时只获取命中的邮件
+        """
+        uids, matched = await self._search_new(bot, mailbox)
+        batch = max(min(self.adapter_config.imap_fetch_batch, self.adapter_config.parse_queue_size), 1)
+        events: list[Event] = []
+        for i in range(0, len(matched), batch):
+            events += await self.fetch_mails(bot, format_uid_set(matched[i : i + batch]), mailbox)
+        self._skip_unmatched(bot.self_id, mailbox, uids, matched)
+        return events
+
+    async def fetch_mails(self, bot: Bot, uid_set: str, mailbox: str = DEFAULT_MAILBOX) -> list[Event]:
+        """获取 uid_set 中比断点新的邮件并构造事件, 同时推进断点"""
+        state = self.mailbox_states.get((bot.self_id, mailbox), MailboxState(None, 0))
+        async with self._folder_client(bot.self_id, mailbox) as client_impl:
+            with self.metrics.fetch_seconds.time(account=bot.self_id, folder=mailbox):
+                raw_mail_headers = await client_impl.uid("fetch", uid_set, self.header_query)
+        log("DEBUG", f"Fetch result: {raw_mail_headers.result}")
+        if log_enabled("TRACE"):
+            log("TRACE", f"{escape_tag(str(raw_mail_headers.lines))}")
+
+        # `n:*` 在没有更新的邮件时也会返回最后一封, 需要按 UID 过滤
+        mails = [mail for mail in parse_fetch_response(raw_mail_headers) if mail.uid > state.last_uid]
+        if mails:
+            state = state._replace(last_uid=max(mail.uid for mail in mails))
+        # 解析交给 parse_executor, 本账号在解析完成前不会再次获取
+        parsed_mails = await asyncio.gather(
+            *(self._parse_headers(mail.literal) for mail in mails),
+            return_exceptions=True,
+        )
+
+        events: list[Event] = []
+        for mail, parsed_mail in zip(mails, parsed_mails):
+            try:
+                if isinstance(parsed_mail, BaseException):
+                    raise parsed_mail
+                events.append(self._build_event(bot, mail, parsed_mail, mailbox))
+            except Exception as e:
+                log("ERROR", f"Parse Mail Error (uid {mail.uid})", exception=e)
+
+        if mails:
+            self._update_state(bot.self_id, mailbox, state)
+        return events
+
+    async def _parse_headers(self, raw: bytes) -> ParsedHeaders:
+        with self.metrics.parse_seconds.time():
+            return await self.parse_executor.submit(parse_headers, raw)
+
+    def _thread_id(self, headers: dict[str, str]) -> str:
+        if not (message_id := headers.get("Message-ID", "").strip()):
+            return ""
+        return self.thread_index.add(message_id, headers.get("In-Reply-To"), headers.get("References"))
+
+    def _build_event(self, bot: Bot, mail: FetchedMail, parsed_mail: ParsedHeaders, mailbox: str) -> Event:
+        event = Event(
+            self_id=bot.self_id,
+            folder=mailbox,
+            uidvalidity=state.uidvalidity if (state := self.mailbox_states.get((bot.self_id, mailbox))) else None,
+            date=parsed_mail.date,
+            subject=parsed_mail.subject,
+            mail_id=mail.seq,
+            uid=mail.uid,
+            flags=mail.flags,
+            size=mail.size,
+            headers=parsed_mail.headers,
+            thread_id=self._thread_id(parsed_mail.headers),
+            mime_types=(
+                [part.mimetype for part in mail.bodystructure.walk() if not part.is_multipart]
+                if mail.bodystructure
+                else []
+            ),
+        )
+        event._bodystructure = mail.bodystructure
+        if log_enabled("DEBUG"):
+            log("DEBUG", "<green><b>new mail</b></green>\n" + escape_tag(str(event)))
+        return event
@@ -0,0 +1,176 @@
+import re
+import binascii
+from email.header import decode_header, make_header
+from urllib.parse import unquote
+from collections.abc import Iterator
+from typing import Any, NamedTuple
+
+# 流式下载时每次 partial fetch 的字节数
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+_token_pattern = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\r?\n?|([^\s()"]+))')
+
+
+class BodyPart(NamedTuple):
+    """BODYSTRUCTURE 中的一个部分, `section` 可直接用于 BODY.PEEK[<section>]"""
+    section: str
+    mimetype: str
+    params: dict[str, str]
+    encoding: str
+    size: int
+    disposition: str | None
+    filename: str | None
+    children: list["BodyPart"]
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.mimetype.startswith("multipart/")
+
+    @property
+    def charset(self) -> str | None:
+        return self.params.get("charset")
+
+    @property
+    def is_attachment(self) -> bool:
+        if self.is_multipart:
+            return False
+        return self.disposition == "attachment" or (self.filename is not None and self.disposition != "inline")
+
+    def walk(self) -> Iterator["BodyPart"]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def _parse_sexp(data: bytes, pos: int = 0) -> tuple[list[Any], int]:
+    """解析 IMAP 的括号表达式, 字符串为 bytes, NIL 为 None"""
+    stack: list[list[Any]] = [[]]
+    while pos < len(data):
+        token = _token_pattern.match(data, pos)
+        if token is None:
+            break
+        pos = token.end()
+        if token.group(1):
+            stack.append([])
+        elif token.group(2):
+            item = stack.pop()
+            if not stack:
+                raise ValueError("unbalanced parenthesis")
+            stack[-1].append(item)
+            if len(stack) == 1:
+                return item, pos
+        elif token.group(3) is not None:
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", token.group(3)))
+        elif token.group(4):
+            size = int(token.group(4))
+            stack[-1].append(data[pos : pos + size])
+            pos += size
+        else:
+            atom = token.group(5)
+            stack[-1].append(None if atom.upper() == b"NIL" else atom)
+    raise ValueError("unbalanced parenthesis")
+
+
+def _str(value: Any) -> str:
+    if not isinstance(value, bytes):
+        return ""
+    return value.decode("utf-8", errors="replace")
+
+
+def _params(value: Any) -> dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    params: dict[str, str] = {}
+    for key, val in zip(value[::2], value[1::2]):
+        key, val = _str(key).lower(), _str(val)
+        if key.endswith("*"):
+            # RFC 2231: filename*=utf-8''%E6%B5%8B%E8%AF%95.txt
+            charset, _, encoded = val.split("'", 2) if val.count("'") >= 2 else ("", "", val)
+            key, val = key[:-1], unquote(encoded, encoding=charset or "utf-8", errors="replace")
+        params[key] = val
+    return params
+
+
+def _decode_filename(value: str | None) -> str | None:
+    if not value:
+        return None
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def _build(node: list[Any], section: str) -> BodyPart:
+    if node and isinstance(node[0], list):
+        children = []
+        while node and isinstance(node[0], list):
+            index = len(children) + 1
+            children.append(_build(node.pop(0), f"{section}.{index}" if section else str(index)))
+        subtype = _str(node[0]).lower() if node else "mixed"
+        params = _params(node[1]) if len(node) > 1 else {}
+        return BodyPart(section, f"multipart/{subtype}", params, "", 0, None, None, children)
+
+    section = section or "1"
+    maintype, subtype = _str(node[0]).lower(), _str(node[1]).lower()
+    params = _params(node[2])
+    encoding = _str(node[5]).lower() if len(node) > 5 else ""
+    size = int(node[6]) if len(node) > 6 and node[6] else 0
+    # text 多一个行数字段, message/rfc822 多 envelope, body, 行数三个字段, 之后才是 md5 和 disposition
+    extension = {"text": 8, "message": 10 if subtype == "rfc822" else 7}.get(maintype, 7)
+    disposition = node[extension + 1] if len(node) > extension + 1 else None
+    disposition_type, disposition_params = None, {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _str(disposition[0]).lower()
+        disposition_params = _params(disposition[1]) if len(disposition) > 1 else {}
+    filename = _decode_filename(disposition_params.get("filename") or params.get("name"))
+    return BodyPart(section, f"{maintype}/{subtype}", params, encoding, size, disposition_type, filename, [])
+
+
+def parse_bodystructure(data: bytes) -> BodyPart:
+    """解析 `BODYSTRUCTURE (...)` 中括号部分"""
+    start = data.index(b"(")
+    node, _ = _parse_sexp(data, start)
+    return _build(node, "")
+
+
+def decode_transfer_encoding(data: bytes, encoding: str) -> bytes:
+    match encoding.lower():
+        case "base64":
+            return binascii.a2b_base64(data)
+        case "quoted-printable":
+            return binascii.a2b_qp(data)
+        case _:
+            return data
+
+
+class TransferDecoder:
+    """增量解码 Content-Transfer-Encoding, 每次只保留不足以解码的尾部字节"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding.lower()
+        self._pending = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._pending + data
+        match self.encoding:
+            case "base64":
+                data = b"".join(data.split())
+                cut = len(data) - len(data) % 4
+            case "quoted-printable":
+                # 软换行和 =XX 不会跨行, 只解码到最后一个完整行
+                cut = data.rfind(b"\n") + 1
+            case _:
+                return data
+        self._pending = data[cut:]
+        return decode_transfer_encoding(data[:cut], self.encoding)
+
+    def flush(self) -> bytes:
+        data, self._pending = self._pending, b""
+        return decode_transfer_encoding(data, self.encoding) if data else b""
+
+
+def decode_text(data: bytes, charset: str | None) -> str:
+    try:
+        return data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
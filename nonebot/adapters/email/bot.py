@@ -1,8 +1,10 @@
+from collections.abc import Iterable
 from nonebot.typing import overrides
 
 from nonebot.adapters import Bot as BaseBot
 from nonebot.message import handle_event
 from .event import Event
+from .smtp import SendResult
 from .message import Message
 
 
@@ -14,9 +16,14 @@ class Bot(BaseBot):
         message: Message,
         **kwargs,
     ):
-        """发送消息"""
+        """发送消息, 启用发件队列 (默认) 时入队后立即返回队列中的 id
+
+        未设置 In-Reply-To 时按会话索引补全 In-Reply-To/References, 使回复显示在原邮件的会话中
+        """
         if not message.email.get("From", None):
             message.from_(self.self_id)
+        if self.adapter.adapter_config.thread_reply_headers:  # type: ignore
+            self.adapter.fill_reply_headers(event, message)  # type: ignore
         return await self.adapter.send_to(event.self_id, message, **kwargs) # type: ignore
 
     async def send_by(
@@ -27,6 +34,18 @@ class Bot(BaseBot):
     ):
         return await self.adapter.send_to(bot_id, message, **kwargs) # type: ignore
 
+    async def send_many(
+        self,
+        messages: Iterable[Message],
+        concurrency: int | None = None,
+    ) -> list[SendResult]:
+        """批量发送邮件, 返回每封邮件的发送结果"""
+        messages = list(messages)
+        for message in messages:
+            if not message.email.get("From", None):
+                message.from_(self.self_id)
+        return await self.adapter.send_batch(self.self_id, messages, concurrency) # type: ignore
+
     async def handle_event(self, event: Event) -> None:
         """处理事件"""
         await handle_event(self, event)
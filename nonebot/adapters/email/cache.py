@@ -0,0 +1,236 @@
+import mmap
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Iterator
+
+from .log import log
+
+# (账号, 文件夹, UIDVALIDITY, UID, section)
+PartKey = tuple[str, str, int | None, int, str]
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class _Spilled:
+    """落盘的内容, 以只读 mmap 访问, 读取时只复制用到的部分
+
+    流式读取期间被淘汰时, 等最后一个读取者结束后才关闭并删除文件
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.size = path.stat().st_size
+        self.readers = 0
+        self.evicted = False
+        self._file = path.open("rb")
+        # 空文件不能 mmap
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def read(self, start: int = 0, end: int | None = None) -> bytes:
+        return self._mmap[start:end] if self._mmap is not None else b""
+
+    def unpin(self) -> None:
+        self.readers -= 1
+        if self.evicted and not self.readers:
+            self._close()
+
+    def close(self) -> None:
+        self.evicted = True
+        if not self.readers:
+            self._close()
+
+    def _close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class _SpilledChunks:
+    """分块读取落盘的内容, 创建时即占用 `spilled`, 读完或 `close` 后释放"""
+
+    def __init__(self, spilled: _Spilled, chunk_size: int):
+        spilled.readers += 1
+        self._spilled: _Spilled | None = spilled
+        self._chunk_size = chunk_size
+        self._offset = 0
+
+    def __iter__(self) -> "_SpilledChunks":
+        return self
+
+    def __next__(self) -> bytes:
+        if self._spilled is None or self._offset >= self._spilled.size:
+            self.close()
+            raise StopIteration
+        data = self._spilled.read(self._offset, self._offset + self._chunk_size)
+        self._offset += len(data)
+        return data
+
+    def close(self) -> None:
+        if self._spilled is not None:
+            self._spilled.unpin()
+            self._spilled = None
+
+    def __del__(self) -> None:
+        self.close()
+
+
+class SpillWriter:
+    """边获取边写入临时文件, 全部写完后 `commit` 才加入缓存, 中途失败则 `abort`"""
+
+    def __init__(self, cache: "PartCache", key: PartKey, directory: Path):
+        self.cache = cache
+        self.key = key
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._file = tempfile.NamedTemporaryFile(dir=directory, suffix=".part", delete=False)
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self) -> None:
+        self._file.close()
+        self.cache._add_file(self.key, self._hash.hexdigest(), Path(self._file.name))
+
+    def abort(self) -> None:
+        self._file.close()
+        Path(self._file.name).unlink(missing_ok=True)
+
+
+class PartCache:
+    """邮件各部分解码后内容的本地缓存, 多个处理器 (以及同一封邮件的多个事件) 共用
+
+    内容按摘要存放, 相同的附件只保存一份. 小于 `spill_size` 的内容放在内存中 (LRU, 共 `max_memory` 字节),
+    被淘汰后落盘; 较大的内容直接写入 `directory` 下的文件并以 mmap 读取 (LRU, 共 `max_disk` 字节).
+    `directory` 为 None 时只使用内存
+    """
+
+    # key -> 摘要 的映射最多保留的条数
+    MAX_KEYS = 100_000
+
+    def __init__(self, max_memory: int, directory: str | Path | None, max_disk: int, spill_size: int):
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.spill_size = spill_size
+        self.hits = 0
+        self.misses = 0
+        self.memory_size = 0
+        self.disk_size = 0
+        self._keys: OrderedDict[PartKey, str] = OrderedDict()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._disk: OrderedDict[str, _Spilled] = OrderedDict()
+        self.directory: Path | None = None
+        if directory is not None and max_disk > 0:
+            # 每个进程使用单独的目录, 分片时多个 worker 可以共用同一个 `directory`
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self.directory = Path(tempfile.mkdtemp(prefix="parts-", dir=directory))
+            log("DEBUG", f"Part cache: {self.directory}")
+
+    def __contains__(self, key: PartKey) -> bool:
+        digest = self._keys.get(key)
+        return digest is not None and (digest in self._memory or digest in self._disk)
+
+    def _lookup(self, key: PartKey) -> bytes | _Spilled | None:
+        if (digest := self._keys.get(key)) is None:
+            self.misses += 1
+            return None
+        if (data := self._memory.get(digest)) is not None:
+            self._memory.move_to_end(digest)
+        elif (spilled := self._disk.get(digest)) is not None:
+            self._disk.move_to_end(digest)
+            data = spilled
+        else:
+            # 内容已被淘汰
+            del self._keys[key]
+            self.misses += 1
+            return None
+        self._keys.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def get(self, key: PartKey) -> bytes | None:
+        data = self._lookup(key)
+        return data.read() if isinstance(data, _Spilled) else data
+
+    def iter_chunks(self, key: PartKey, chunk_size: int) -> Iterator[bytes] | None:
+        """按块读取缓存的内容, 落盘的内容不会整个读入内存; 未缓存时返回 None
+
+        读取期间内容被淘汰也能读完; 不再读取时应调用返回值的 `close` (若有)
+        """
+        data = self._lookup(key)
+        if data is None:
+            return None
+        if isinstance(data, bytes):
+            return (data[i : i + chunk_size] for i in range(0, len(data), chunk_size))
+        return _SpilledChunks(data, chunk_size)
+
+    def put(self, key: PartKey, data: bytes) -> None:
+        digest = _digest(data)
+        if digest in self._memory or digest in self._disk:
+            self._set_key(key, digest)
+        elif len(data) < self.spill_size and len(data) <= self.max_memory:
+            self._memory[digest] = data
+            self.memory_size += len(data)
+            self._set_key(key, digest)
+            self._evict_memory()
+        elif self.directory is not None and len(data) <= self.max_disk:
+            self._spill(digest, data)
+            self._set_key(key, digest)
+
+    def spill_writer(self, key: PartKey, size: int | None = None) -> SpillWriter | None:
+        """流式获取时使用, 不落盘或 `size` 超过 `max_disk` 时返回 None"""
+        if self.directory is None or (size is not None and size > self.max_disk):
+            return None
+        return SpillWriter(self, key, self.directory)
+
+    def _set_key(self, key: PartKey, digest: str) -> None:
+        self._keys[key] = digest
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.MAX_KEYS:
+            self._keys.popitem(last=False)
+
+    def _spill(self, digest: str, data: bytes) -> None:
+        # 文件名不用摘要: 被淘汰但仍在读取的文件可能还在, 不能覆盖
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False) as f:
+            f.write(data)
+        self._add_spilled(digest, Path(f.name))
+
+    def _add_file(self, key: PartKey, digest: str, path: Path) -> None:
+        if digest in self._memory or digest in self._disk or path.stat().st_size > self.max_disk:
+            path.unlink(missing_ok=True)
+        else:
+            self._add_spilled(digest, path)
+        if digest in self._memory or digest in self._disk:
+            self._set_key(key, digest)
+
+    def _add_spilled(self, digest: str, path: Path) -> None:
+        spilled = self._disk[digest] = _Spilled(path)
+        self.disk_size += spilled.size
+        while self.disk_size > self.max_disk and len(self._disk) > 1:
+            _, evicted = self._disk.popitem(last=False)
+            self.disk_size -= evicted.size
+            evicted.close()
+
+    def _evict_memory(self) -> None:
+        while self.memory_size > self.max_memory:
+            digest, data = self._memory.popitem(last=False)
+            self.memory_size -= len(data)
+            if self.directory is not None and len(data) <= self.max_disk:
+                self._spill(digest, data)
+
+    def close(self) -> None:
+        for spilled in self._disk.values():
+            spilled.close()
+        self._disk.clear()
+        self._memory.clear()
+        self._keys.clear()
+        self.memory_size = self.disk_size = 0
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
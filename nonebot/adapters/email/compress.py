@@ -0,0 +1,90 @@
+import zlib
+from collections.abc import Callable
+from typing import Any
+
+from aioimaplib import AUTH, SELECTED, Cmd, Exec, Command, Commands
+from nonemail import EmailClient
+
+# aioimaplib 只允许在 AUTH 状态下 COMPRESS, 但 EmailClient 登录后即已 SELECT;
+# COMPRESS (RFC 4978) 属于 RFC 3501 的 command-auth, 选中文件夹后同样有效
+Commands["COMPRESS"] = Cmd("COMPRESS", (AUTH, SELECTED), Exec.is_sync)
+
+
+class _DeflateTransport:
+    """写入的数据压缩后交给原 transport, 每次写入都 SYNC_FLUSH 以免命令滞留在压缩器中
+
+    客户端发送的只有简短的命令, 使用小窗口和低 memLevel, 每条连接的压缩器只占几 KB
+    """
+
+    def __init__(self, transport: Any):
+        self._transport = transport
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -10, 1)
+
+    def write(self, data: bytes) -> None:
+        self._transport.write(self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._transport, name)
+
+
+class _Inflater:
+    """替换协议的 data_received: COMPRESS 的 tagged OK 之后的数据先解压再交给原协议
+
+    服务器在 OK 之后立即开始压缩, 同一次读取中 OK 后面的数据可能已是压缩数据,
+    因此在收到的原始数据中查找 OK 行, 而不是等命令返回后再切换
+    """
+
+    def __init__(self, data_received: Callable[[bytes], None], tag: str):
+        self.data_received = data_received
+        self.tag = tag.encode() + b" "
+        self.decompressor: Any = None
+        self.done = False
+        self._partial = b""
+
+    def __call__(self, data: bytes) -> None:
+        if self.decompressor is not None:
+            self.data_received(self.decompressor.decompress(data))
+            return
+        if self.done:
+            self.data_received(data)
+            return
+        buffer = self._partial + data
+        start = 0
+        while (end := buffer.find(b"\r\n", start)) != -1:
+            line, start = buffer[start:end], end + 2
+            if not line.startswith(self.tag):
+                continue
+            self.done = True
+            if line[len(self.tag) :].upper().startswith(b"OK"):
+                self.decompressor = zlib.decompressobj(-15)
+                split = start - len(self._partial)
+                self.data_received(data[:split])
+                if rest := data[split:]:
+                    self.data_received(self.decompressor.decompress(rest))
+                return
+            break
+        self._partial = buffer[start:]
+        self.data_received(data)
+
+
+async def enable_compress(client: EmailClient) -> bool:
+    """登录后协商 COMPRESS=DEFLATE, 之后双向数据都经过 deflate 压缩
+
+    必须在连接上没有其他命令时调用; 命令失败 (包括 Abort 和 CommandTimeout) 时恢复原来的 data_received
+    """
+    protocol = client.impl.protocol
+    tag = protocol.new_tag()
+    inflater = _Inflater(protocol.data_received, tag)
+    protocol.data_received = inflater
+    enabled = False
+    try:
+        resp = await protocol.execute(
+            Command("COMPRESS", tag, "DEFLATE", loop=protocol.loop, timeout=client.impl.timeout)
+        )
+        enabled = resp.result == "OK" and inflater.decompressor is not None
+    finally:
+        if not enabled:
+            del protocol.data_received
+    if enabled:
+        protocol.transport = _DeflateTransport(protocol.transport)
+    return enabled
@@ -1,34 +1,175 @@
+from typing import Literal
+from pathlib import Path
 from pydantic import Field, BaseModel, validator, Extra
 from nonebot.compat import PYDANTIC_V2, ConfigDict
 from email_validator import validate_email, EmailNotValidError
 from aioimaplib import IMAP4, TWENTY_NINE_MINUTES
 
 ADAPTER_NAME = "email"
+DEFAULT_MAILBOX = "INBOX"
+# 新邮件默认只获取这些头部, 完整头部可通过 Event.get_full_headers 按需获取
+FETCH_HEADER_FIELDS = (
+    "Date",
+    "Subject",
+    "From",
+    "To",
+    "Cc",
+    "Message-ID",
+    "In-Reply-To",
+    "References",
+    "Content-Type",
+)
 
 
-class Config(BaseModel):
-    # 收发共用部分
+def _validate_user(v: str | None) -> str | None:
+    if v is None:
+        return v
+    try:
+        validate_email(v)
+    except EmailNotValidError as e:
+        raise ValueError(f"invalid email address: {v}") from e
+    return v
+
+
+class PrefilterConfig(BaseModel):
+    """服务器端预过滤, 编译为 UID SEARCH 条件; 各项之间为 AND, 同一项的多个值之间为 OR"""
+    from_addrs: list[str] = Field(default_factory=list, description="FROM contains any of these")
+    to_addrs: list[str] = Field(default_factory=list, description="TO contains any of these")
+    subjects: list[str] = Field(default_factory=list, description="SUBJECT contains any of these")
+    headers: dict[str, str] = Field(default_factory=dict, description="every HEADER field contains the value")
+    larger: int | None = Field(None, description="RFC822.SIZE larger than this")
+    exclude_from: list[str] = Field(default_factory=list, description="FROM contains none of these")
+    exclude_subjects: list[str] = Field(default_factory=list, description="SUBJECT contains none of these")
+    gmail_raw: str | None = Field(None, description="X-GM-RAW query, used only if the server is Gmail")
+
+
+class AccountConfig(BaseModel):
+    """单个邮箱账号, 未填写的服务器配置沿用全局配置"""
     user: str = Field(..., description="email user")
     password: str = Field(..., description="email password or credential")
+    smtp_host: str | None = Field(None, description="SMTP server host")
+    smtp_port: int | None = Field(None, description="SMTP server port")
+    smtp_use_tls: bool | None = Field(None, description="use TLS for SMTP connection")
+    imap_host: str | None = Field(None, description="IMAP server host")
+    imap_port: int | None = Field(None, description="IMAP server port")
+    folders: list[str] | None = Field(None, description="folders to watch, the first one is selected")
+    poll_folders: list[str] | None = Field(None, description="low priority folders checked by polling")
+    prefilter: PrefilterConfig | None = Field(None, description="only fetch mails matching this filter")
+
+    _user_validator = validator("user", allow_reuse=True)(_validate_user)
+
+
+class Config(BaseModel):
+    # 收发共用部分
+    user: str | None = Field(None, description="email user")
+    password: str | None = Field(None, description="email password or credential")
+    # 多账号, 例如: EMAIL_ACCOUNTS='[{"user": "a@example.com", "password": "xxx"}]'
+    email_accounts: list[AccountConfig] = Field(default_factory=list, description="extra email accounts")
     # SMTP
     smtp_host: str = Field(..., description="SMTP server host")
     smtp_port: int | None = Field(None, description="SMTP server port")
     smtp_use_tls: bool = Field(True, description="use TLS for SMTP connection")
+    smtp_pool_max_idle: float = Field(300, description="close pooled SMTP connections idle longer than this")
+    smtp_pool_keepalive: float = Field(60, description="NOOP pooled SMTP connections idle longer than this")
+    smtp_pool_max_messages: int = Field(100, description="recycle a pooled SMTP connection after this many mails")
+    smtp_pool_max_connections: int = Field(4, description="max SMTP connections per (host, port, user)")
+    # 发件队列: Bot.send 入队后立即返回, 后台按服务商限速发送, 临时错误 (4xx) 退避重试
+    # 持久化需显式开启, 默认不在当前目录下创建 SQLite 文件
+    smtp_spool: Literal["sqlite", "memory", "none"] = Field("memory", description="outbound spool, none sends inline")
+    smtp_spool_path: Path = Field(Path("data/email/spool.db"), description="sqlite spool file")
+    smtp_spool_concurrency: int = Field(8, description="spooled mails being delivered at the same time")
+    smtp_spool_max_attempts: int = Field(10, description="give up a spooled mail after this many attempts")
+    smtp_retry_base_delay: float = Field(30, description="first retry delay in seconds")
+    smtp_retry_max_delay: float = Field(3600, description="max retry delay in seconds")
+    smtp_rate_limit: float | None = Field(None, description="mails per second per SMTP host, None for unlimited")
+    smtp_rate_limits: dict[str, float] = Field(default_factory=dict, description="mails per second by SMTP host")
+    smtp_rate_burst: float = Field(10, description="mails sent at once before the rate limit applies")
     # IMAP
     imap_host: str = Field(..., description="IMAP server host")
     imap_port: int = Field(993, description="IMAP server port")
     imap_login_timeout: int = Field(IMAP4.TIMEOUT_SECONDS, description="IMAP server connection timeout")
     imap_idle_timeout: int = Field(TWENTY_NINE_MINUTES, description="IMAP server idle timeout")
+    imap_idle_renew_margin: float = Field(30, description="re-issue IDLE this many seconds before the timeout")
     imap_use_tls: bool = Field(True, description="use TLS for IMAP connection")
+    imap_compress: bool = Field(True, description="use COMPRESS=DEFLATE (RFC 4978) if the server supports it")
+    imap_fetch_headers: list[str] = Field(
+        list(FETCH_HEADER_FIELDS), description="header fields fetched for new mails, empty for the whole header"
+    )
+    imap_fetch_batch: int = Field(100, description="max new mails per UID FETCH, also capped by parse_queue_size")
+    # 多文件夹: 支持 NOTIFY 时共用一条连接, 否则每个文件夹一条 IDLE 连接, 超出的改为轮询
+    imap_folders: list[str] = Field([DEFAULT_MAILBOX], description="folders to watch, the first one is selected")
+    imap_poll_folders: list[str] = Field(default_factory=list, description="low priority folders checked by polling")
+    imap_poll_interval: float = Field(300, description="seconds between STATUS polls")
+    imap_use_notify: bool = Field(True, description="use NOTIFY (RFC 5465) if the server supports it")
+    imap_max_idle_connections: int = Field(5, description="max IDLE connections per account")
+    # 服务器端预过滤: 只获取 UID SEARCH 命中的新邮件, 其余直接跳过
+    imap_prefilter: PrefilterConfig | None = Field(None, description="only fetch mails matching this filter")
+    # 断线/重启后补发: 记录每个邮箱已处理到的 UID
+    checkpoint_store: Literal["sqlite", "memory"] = Field("memory", description="where to keep UID checkpoints")
+    checkpoint_path: Path = Field(Path("data/email/checkpoint.db"), description="sqlite checkpoint file")
+    imap_catchup: bool = Field(True, description="replay mails arrived while disconnected")
+    imap_catchup_batch: int = Field(200, description="mails per FETCH when catching up")
+    # 事件去重: 同一封邮件只分发一次, bloom 内存固定但有误判
+    dedup: Literal["lru", "bloom", "none"] = Field("lru", description="event dedup cache")
+    dedup_max_size: int = Field(10000, description="max keys kept by the lru dedup cache")
+    dedup_ttl: float | None = Field(86400, description="seconds a key stays in the lru dedup cache")
+    dedup_bloom_capacity: int = Field(1_000_000, description="keys per bloom filter generation")
+    dedup_bloom_error_rate: float = Field(0.001, description="bloom filter false positive rate")
+    dedup_by_message_id: bool = Field(True, description="also dedup by Message-ID across accounts")
+    # 会话索引: 按 References/In-Reply-To 把邮件归入会话, 用作事件的 session id, 回复时自动填写这两个头部
+    thread_index: Literal["sqlite", "memory"] = Field("memory", description="where to keep the thread index")
+    thread_index_path: Path = Field(Path("data/email/threads.db"), description="sqlite thread index file")
+    thread_index_max_size: int = Field(100_000, description="max messages kept by the thread index")
+    thread_reply_headers: bool = Field(True, description="fill In-Reply-To/References when replying to an event")
+    # 事件分发, 同一会话的事件按顺序处理
+    dispatch_workers: int = Field(16, description="concurrent event handlers")
+    dispatch_queue_size: int = Field(1000, description="max events waiting to be handled")
+    dispatch_drain_timeout: float = Field(30, description="seconds to wait for pending events on shutdown")
+    # 指标: 设置 metrics_path 后在驱动器上提供 Prometheus 文本格式的接口
+    metrics_path: str | None = Field(None, description="serve Prometheus metrics at this path, e.g. /email/metrics")
+    metrics_export_interval: float = Field(60, description="seconds between calls to metrics exporters")
+    # 邮件解析, process 可以利用多核, none 则直接在事件循环中解析
+    parse_executor: Literal["thread", "process", "none"] = Field("thread", description="where to parse mails")
+    parse_workers: int | None = Field(None, description="parse executor workers, default by executor")
+    parse_queue_size: int = Field(256, description="max mails being parsed at the same time")
+    # 正文/附件缓存: 按 (账号, 文件夹, UIDVALIDITY, UID, section) 缓存解码后的内容, 多个处理器共用
+    part_cache_memory: int = Field(64 << 20, description="bytes of parts kept in memory, 0 sends every part to disk")
+    part_cache_path: Path | None = Field(None, description="spill directory, None (default) for memory only")
+    part_cache_disk: int = Field(1 << 30, description="bytes of parts kept on disk")
+    part_cache_spill_size: int = Field(1 << 20, description="parts at least this large go to disk and are mmapped")
+    # 多账号连接管理
+    imap_max_concurrent_logins: int = Field(10, description="max IMAP logins in progress at the same time")
+    imap_reconnect_base_delay: float = Field(5, description="first reconnect delay in seconds")
+    imap_reconnect_max_delay: float = Field(300, description="max reconnect delay in seconds")
+    # 分片: 多个进程/节点共用一个租约库, 按一致性哈希分配账号, 每个账号只由一个 worker 监听
+    shard_lease_path: Path | None = Field(None, description="sqlite lease file shared by all workers, None to disable")
+    shard_worker_id: str | None = Field(None, description="unique worker id, default hostname:pid")
+    shard_lease_ttl: float = Field(30, description="seconds before a dead worker's accounts are taken over")
+    shard_replicas: int = Field(64, description="virtual nodes per worker on the hash ring")
 
+    _user_validator = validator("user", allow_reuse=True)(_validate_user)
 
-    @validator("user")
-    def user_validator(cls, v):
-        try:
-            validate_email(v)
-        except EmailNotValidError as e:
-            raise ValueError(f"invalid email address: {v}") from e
-        return v
+    @property
+    def accounts(self) -> list[AccountConfig]:
+        """所有账号, 服务器配置已用全局配置补全"""
+        accounts = list(self.email_accounts)
+        if self.user and self.password:
+            accounts.insert(0, AccountConfig(user=self.user, password=self.password))
+        return [
+            AccountConfig(
+                user=account.user,
+                password=account.password,
+                smtp_host=account.smtp_host or self.smtp_host,
+                smtp_port=account.smtp_port or self.smtp_port,
+                smtp_use_tls=self.smtp_use_tls if account.smtp_use_tls is None else account.smtp_use_tls,
+                imap_host=account.imap_host or self.imap_host,
+                imap_port=account.imap_port or self.imap_port,
+                folders=account.folders or self.imap_folders,
+                poll_folders=self.imap_poll_folders if account.poll_folders is None else account.poll_folders,
+                prefilter=account.prefilter or self.imap_prefilter,
+            )
+            for account in accounts
+        ]
 
     if PYDANTIC_V2:
         model_config = ConfigDict(extra="ignore")
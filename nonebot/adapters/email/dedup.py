@@ -0,0 +1,109 @@
+import math
+import time
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+
+
+class DedupCache(ABC):
+    """判断事件是否已经分发过, 任意一个 key 命中即视为重复"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def _contains(self, key: Hashable) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _add(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def seen(self, keys: Iterable[Hashable]) -> bool:
+        """检查并记录, 返回 True 表示重复"""
+        keys = list(keys)
+        if any(self._contains(key) for key in keys):
+            self.hits += 1
+            # 补全其余 key, 比如同一封邮件在另一个账号中的 UID
+            for key in keys:
+                self._add(key)
+            return True
+        self.misses += 1
+        for key in keys:
+            self._add(key)
+        return False
+
+
+class LRUDedupCache(DedupCache):
+    """最多保存 `max_size` 个 key, 超过 `ttl` 秒的 key 失效"""
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._keys: OrderedDict[Hashable, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _contains(self, key: Hashable) -> bool:
+        added = self._keys.get(key)
+        if added is None:
+            return False
+        if self.ttl is not None and time.monotonic() - added > self.ttl:
+            del self._keys[key]
+            return False
+        return True
+
+    def _add(self, key: Hashable) -> None:
+        self._keys[key] = time.monotonic()
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+
+class _BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, key: Hashable) -> Iterable[int]:
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def add(self, key: Hashable) -> None:
+        for i in self._indexes(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+
+class BloomDedupCache(DedupCache):
+    """适用于海量邮件: 内存固定, 有 `error_rate` 的误判 (把新邮件当作重复)
+
+    写满 `capacity` 个 key 后换一个新的过滤器, 并保留上一个, 因此最近的 key 总能被查到
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        super().__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._current = _BloomFilter(capacity, error_rate)
+        self._previous: _BloomFilter | None = None
+
+    def _contains(self, key: Hashable) -> bool:
+        return key in self._current or (self._previous is not None and key in self._previous)
+
+    def _add(self, key: Hashable) -> None:
+        if key in self._current:
+            return
+        if self._current.count >= self.capacity:
+            self._previous, self._current = self._current, _BloomFilter(self.capacity, self.error_rate)
+        self._current.add(key)
@@ -0,0 +1,76 @@
+import asyncio
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from .log import log
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class Dispatcher:
+    """固定数量的 worker 处理事件, 同一个 session 的事件按提交顺序串行处理
+
+    已提交但未处理完的事件最多 `queue_size` 个, 满了之后提交方会等待,
+    邮件风暴时压力传回 IMAP 一侧, 而不是无限创建处理任务
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._slots = asyncio.Semaphore(queue_size)
+        # session -> 待处理的任务, 队首为正在处理的任务
+        self._sessions: dict[str, deque[Job]] = {}
+        self._ready: asyncio.Queue[str] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._closing = False
+
+    @property
+    def pending(self) -> int:
+        return sum(len(jobs) for jobs in self._sessions.values())
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._closing = False
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, session: str, job: Job) -> None:
+        if self._closing:
+            raise RuntimeError("dispatcher is closing")
+        await self._slots.acquire()
+        jobs = self._sessions.get(session)
+        if jobs is None:
+            self._sessions[session] = deque([job])
+            self._ready.put_nowait(session)
+        else:
+            # 该 session 已在队列中或正在处理, 由处理它的 worker 依次取出
+            jobs.append(job)
+
+    async def _worker(self) -> None:
+        while True:
+            session = await self._ready.get()
+            jobs = self._sessions[session]
+            try:
+                await jobs[0]()
+            except Exception as e:
+                log("ERROR", f"Error when handling event of {session}", exception=e)
+            finally:
+                jobs.popleft()
+                self._slots.release()
+                if jobs:
+                    # 放回队尾, 避免一个 session 长时间占用 worker
+                    self._ready.put_nowait(session)
+                else:
+                    del self._sessions[session]
+                self._ready.task_done()
+
+    async def close(self, timeout: float | None = None) -> None:
+        """不再接受新事件, 等待已提交的事件处理完 (最多 `timeout` 秒) 后停止 worker"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            log("WARNING", f"Dispatcher drain timeout, {self.pending} event(s) dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,18 +1,66 @@
 from typing import NamedTuple
-import re
 from datetime import datetime
+from email.utils import getaddresses
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from email.policy import default as default_policy
+import asyncio
+from pathlib import Path
+from collections.abc import Callable, Awaitable, AsyncIterator
 from typing_extensions import override
+from pydantic import PrivateAttr
+from nonebot import get_bot
 from nonebot.utils import escape_tag
 from nonebot.adapters import Event as BaseEvent
 
 from .message import Message
+from .cache import PartCache, PartKey
+from .config import DEFAULT_MAILBOX
+from .utils import parse_fetch_response
+from .bodystructure import (
+    DEFAULT_CHUNK_SIZE,
+    BodyPart,
+    TransferDecoder,
+    decode_text,
+    decode_transfer_encoding,
+)
 
 class Emailer(NamedTuple):
     name: str
     addr: str
 
     def __str__(self) -> str:
-        return f"{self.name} <{self.addr}>"
+        return f"{self.name} <{self.addr}>" if self.name else self.addr
+
+
+class Addresses(NamedTuple):
+    """From/To/Cc 的解析结果, `*_addrs` 为小写地址集合, 用于 O(1) 判断"""
+    sender: Emailer
+    recipients: tuple[Emailer, ...]
+    cc: tuple[Emailer, ...]
+    recipient_addrs: frozenset[str]
+    cc_addrs: frozenset[str]
+
+    @classmethod
+    def parse(cls, headers: dict[str, str]) -> "Addresses":
+        senders = _parse_address_list(headers.get("From", ""))
+        recipients = _parse_address_list(headers.get("To", ""))
+        cc = _parse_address_list(headers.get("Cc", ""))
+        return cls(
+            senders[0] if senders else Emailer("", ""),
+            recipients,
+            cc,
+            frozenset(r.addr.lower() for r in recipients),
+            frozenset(c.addr.lower() for c in cc),
+        )
+
+
+def _parse_address_list(value: str) -> tuple[Emailer, ...]:
+    """按 RFC 5322 解析地址列表, 支持带引号的名称和不带名称的地址"""
+    if not value:
+        return ()
+    return tuple(Emailer(name, addr) for name, addr in getaddresses([value]) if addr)
+
 
 class Event(BaseEvent):
     """考虑到MIME部分可能会过大，因此仅获取邮件头部"""
@@ -20,46 +68,171 @@ class Event(BaseEvent):
     date: str
     subject: str
     mail_id: str
+    uid: int | None = None
+    flags: list[str] = []
+    size: int | None = None
+    folder: str = DEFAULT_MAILBOX
+    uidvalidity: int | None = None
     headers: dict[str, str]
     mime_types: list[str]
+    # 会话第一封邮件的 Message-ID, 由适配器的会话索引填写
+    thread_id: str = ""
 
+    # 按需获取的邮件结构, 获取一次后缓存在事件上; 各部分的内容缓存在适配器的 part_cache 中
+    _bodystructure: BodyPart | None = PrivateAttr(None)
+    _addresses: Addresses | None = PrivateAttr(None)
+    _full_headers: EmailMessage | None = PrivateAttr(None)
 
     @property
     def datetime(self) -> datetime:
         return datetime.strptime(self.date, "%a, %d %b %Y %H:%M:%S %z")
 
+    @property
+    def addresses(self) -> Addresses:
+        """首次访问时解析 From/To/Cc 并缓存"""
+        if self._addresses is None:
+            self._addresses = Addresses.parse(self.headers)
+        return self._addresses
+
     @property
     def sender(self) -> Emailer:
         """sender 一般在 From 字段中， 格式为: 'xxx' <xxx@xxx.xxx>"""
-        sender_pattern = re.compile(r"(.+) <(.+)>")
-        sender = sender_pattern.match(self.headers.get("From", ""))
-        if sender:
-            return Emailer(sender.group(1), sender.group(2))
-
-        return Emailer("", "")
+        return self.addresses.sender
 
     @property
     def recipients(self) -> list[Emailer]:
         """recipients 一般在 To 字段中， 格式为: 'xxx' <xxx@xxx.xxx>, 'xxx' <xxx@xxx.xxx>, ..."""
-        recipients_pattern = re.compile(r"(.+) <(.+)>")
-        recipients = recipients_pattern.findall(self.headers.get("To", ""))
-        if recipients:
-            return [Emailer(recipient[0], recipient[1]) for recipient in recipients]
-        return []
+        return list(self.addresses.recipients)
 
     @property
     def cc(self) -> list[Emailer]:
         """cc 一般在 Cc 字段中， 格式为: 'xxx' <xxx@xxx.xxx>, ..."""
-        cc_pattern = re.compile(r"(.+) <(.+)>")
-        cc = cc_pattern.findall(self.headers.get("Cc", ""))
-        if cc:
-            return [Emailer(c[0], c[1]) for c in cc]
-        return []
+        return list(self.addresses.cc)
 
     @property
     def message_id(self) -> str:
         return self.headers.get("Message-ID", "")
 
+    async def _uid_fetch(self, query: str):
+        if self.uid is None:
+            raise ValueError("This event has no uid, can not fetch from server.")
+        bot = get_bot(self.self_id)
+        resp = await bot.adapter.uid_fetch(bot, str(self.uid), query, self.folder)  # type: ignore
+        mails = [mail for mail in parse_fetch_response(resp) if mail.uid == self.uid]
+        if not mails:
+            raise ValueError(f"Mail {self.uid} not found: {resp.result}")
+        return mails[0]
+
+    async def get_full_headers(self) -> EmailMessage:
+        """完整的邮件头部 (包括 Received, DKIM-Signature 等及同名头部), 只含头部的 EmailMessage
+
+        `headers` 只包含 `imap_fetch_headers` 中的字段, 需要其他字段时再调用
+        """
+        if self._full_headers is None:
+            mail = await self._uid_fetch("(UID BODY.PEEK[HEADER])")
+            self._full_headers = BytesHeaderParser(policy=default_policy).parsebytes(mail.literal)  # type: ignore
+        return self._full_headers
+
+    async def get_bodystructure(self) -> BodyPart:
+        """邮件的 MIME 结构, 不包含任何正文内容"""
+        if self._bodystructure is None:
+            mail = await self._uid_fetch("(UID BODYSTRUCTURE)")
+            if mail.bodystructure is None:
+                raise ValueError(f"Mail {self.uid} has no BODYSTRUCTURE")
+            self._bodystructure = mail.bodystructure
+        return self._bodystructure
+
+    def _part_cache(self, section: str) -> tuple[PartCache, PartKey]:
+        if self.uid is None:
+            raise ValueError("This event has no uid, can not fetch from server.")
+        cache = get_bot(self.self_id).adapter.part_cache  # type: ignore
+        return cache, (self.self_id, self.folder, self.uidvalidity, self.uid, section)
+
+    async def fetch_part(self, section: str) -> bytes:
+        """只获取指定部分 (如 "1.2") 的内容, 已按 Content-Transfer-Encoding 解码
+
+        内容缓存在本地, 其他处理器再次获取时不会访问服务器
+        """
+        cache, key = self._part_cache(section)
+        if (data := cache.get(key)) is None:
+            part = next((p for p in (await self.get_bodystructure()).walk() if p.section == section), None)
+            mail = await self._uid_fetch(f"(UID BODY.PEEK[{section}])")
+            data = decode_transfer_encoding(mail.literal, part.encoding if part else "")
+            cache.put(key, data)
+        return data
+
+    async def stream_part(self, section: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """以 `BODY.PEEK[<section>]<offset.length>` 分块获取并解码, 内存占用只与 chunk_size 有关
+
+        已缓存的内容直接从本地分块读取; 否则边获取边写入缓存, 完整获取后才可用
+        """
+        cache, key = self._part_cache(section)
+        if (chunks := cache.iter_chunks(key, chunk_size)) is not None:
+            try:
+                for data in chunks:
+                    yield data
+            finally:
+                # 调用方提前结束迭代时, 立即释放落盘的内容
+                chunks.close()  # type: ignore
+            return
+        part = next((p for p in (await self.get_bodystructure()).walk() if p.section == section), None)
+        writer = cache.spill_writer(key, part.size if part else None)
+        decoder = TransferDecoder(part.encoding if part else "")
+        offset = 0
+        try:
+            while True:
+                mail = await self._uid_fetch(f"(UID BODY.PEEK[{section}]<{offset}.{chunk_size}>)")
+                if data := decoder.feed(mail.literal):
+                    if writer is not None:
+                        writer.write(data)
+                    yield data
+                offset += len(mail.literal)
+                if len(mail.literal) < chunk_size or (part and part.size and offset >= part.size):
+                    break
+            if data := decoder.flush():
+                if writer is not None:
+                    writer.write(data)
+                yield data
+        except BaseException:
+            # 包括调用方提前结束迭代 (GeneratorExit)
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.commit()
+
+    async def save_part(
+        self,
+        section: str,
+        sink: str | Path | Callable[[bytes], Awaitable[None]],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> int:
+        """把指定部分流式写入文件或异步回调, 返回写入的字节数"""
+        written = 0
+        if callable(sink):
+            async for data in self.stream_part(section, chunk_size):
+                await sink(data)
+                written += len(data)
+            return written
+        with Path(sink).open("wb") as f:
+            async for data in self.stream_part(section, chunk_size):
+                await asyncio.to_thread(f.write, data)
+                written += len(data)
+        return written
+
+    async def get_body_text(self, subtype: str = "plain") -> str:
+        """获取正文 (默认 text/plain), 不会下载附件"""
+        for part in (await self.get_bodystructure()).walk():
+            if part.mimetype == f"text/{subtype}" and not part.is_attachment:
+                return decode_text(await self.fetch_part(part.section), part.charset)
+        return ""
+
+    async def iter_attachments(self) -> AsyncIterator[BodyPart]:
+        """遍历附件的描述信息, 需要内容时再调用 `fetch_part(part.section)`"""
+        for part in (await self.get_bodystructure()).walk():
+            if part.is_attachment:
+                yield part
+
     @override
     def get_type(self) -> str:
         return "message"
@@ -77,32 +250,28 @@ class Event(BaseEvent):
         raise ValueError("This event does not have a message.")
 
     def get_user_id(self) -> str:
-        if not self.sender:
-            return ""
         return self.sender.addr
 
     def get_session_id(self) -> str:
-        if not self.sender:
-            return ""
-        return self.sender.addr
+        """同一会话 (References/In-Reply-To 链) 中的邮件共用一个 session, 无法判断会话时按发件人区分"""
+        return self.thread_id or self.sender.addr
 
     def is_tome(self) -> bool:
-        return self.self_id in self.recipients
+        return self.self_id.lower() in self.addresses.recipient_addrs
 
     def is_ccme(self) -> bool:
         """当邮件抄送给机器人时返回 True"""
-        if self.cc is None:
-            return False
-        return any(cc.addr == self.self_id for cc in self.cc)
+        return self.self_id.lower() in self.addresses.cc_addrs
 
     def __str__(self) -> str:
+        addresses = self.addresses
         return (
             f"Subject: {self.subject}\n"
-            + f"From: {self.sender.name} <{self.sender.addr}>\n"
-            + "To:" + ", ".join([str(r) for r in self.recipients]) + "\n"
+            + f"From: {addresses.sender}\n"
+            + "To:" + ", ".join([str(r) for r in addresses.recipients]) + "\n"
             + (
-                ("Cc:" + ", ".join([str(c) for c in self.cc]) + "\n")
-                if self.cc
+                ("Cc:" + ", ".join([str(c) for c in addresses.cc]) + "\n")
+                if addresses.cc
                 else ""
             )
             + f"Date: {self.date}\n"
@@ -0,0 +1,38 @@
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Literal, TypeVar
+
+from .log import log
+
+T = TypeVar("T")
+
+ExecutorKind = Literal["thread", "process", "none"]
+
+
+class ParseExecutor:
+    """在线程池或进程池中执行 CPU 密集的解析, 避免阻塞 IDLE 循环
+
+    同时进行中的任务数量受 `queue_size` 限制, 满了之后提交方会等待,
+    从而把压力传回获取邮件的一侧, 而不是无限堆积已获取但未解析的邮件
+    """
+
+    def __init__(self, kind: ExecutorKind, workers: int | None, queue_size: int):
+        self.kind = kind
+        self._executor: Executor | None = None
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="email-parser")
+        elif kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._slots = asyncio.Semaphore(queue_size)
+        log("DEBUG", f"Parse executor: {kind}, workers: {workers or 'default'}, queue size: {queue_size}")
+
+    async def submit(self, func: Callable[..., T], *args: Any) -> T:
+        async with self._slots:
+            if self._executor is None:
+                return func(*args)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,77 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+
+from aioimaplib import AUTH, SELECTED, Cmd, Exec, Command, quoted
+from nonemail import EmailClient
+
+from .utils import register_command
+
+# aioimaplib 不认识 NOTIFY (RFC 5465), 登记后才能通过 execute 发送
+register_command(Cmd("NOTIFY", (AUTH, SELECTED), Exec.is_sync))
+
+
+class FolderPlan(NamedTuple):
+    """一个账号的文件夹如何监听
+
+    - primary: 主连接 SELECT 并 IDLE 的文件夹
+    - idle: 各自占用一条连接 IDLE 的文件夹
+    - notify: 由主连接的 NOTIFY 推送 STATUS 的文件夹
+    - poll: 定时 STATUS 轮询的文件夹
+    """
+    primary: str
+    idle: list[str]
+    notify: list[str]
+    poll: list[str]
+
+
+def plan_folders(folders: list[str], poll_folders: list[str], has_notify: bool, max_idle: int) -> FolderPlan:
+    """服务器支持 NOTIFY 时一条连接即可覆盖所有文件夹, 否则最多 `max_idle` 条 IDLE 连接, 其余改为轮询"""
+    primary, others = folders[0], [folder for folder in dict.fromkeys(folders[1:]) if folder != folders[0]]
+    poll = [folder for folder in dict.fromkeys(poll_folders) if folder != primary and folder not in others]
+    if has_notify:
+        return FolderPlan(primary, [], others, poll)
+    slots = max(max_idle - 1, 0)
+    return FolderPlan(primary, others[:slots], [], others[slots:] + poll)
+
+
+async def notify_set(client: EmailClient, folders: list[str]) -> bool:
+    """让服务器推送所选文件夹及 `folders` 的新邮件, 未选中的文件夹以 STATUS 响应推送"""
+    protocol = client.impl.protocol
+    mailboxes = " ".join(quoted(folder) for folder in folders)
+    resp = await protocol.execute(
+        Command(
+            "NOTIFY",
+            protocol.new_tag(),
+            "SET",
+            "(SELECTED (MessageNew MessageExpunge))",
+            f"(MAILBOXES ({mailboxes}) (MessageNew MessageExpunge))",
+            loop=protocol.loop,
+        )
+    )
+    return resp.result == "OK"
+
+
+class SwitchingClient:
+    """不 IDLE 的辅助连接, 按需切换文件夹, 用于 NOTIFY 和轮询的文件夹的获取与 STATUS"""
+
+    def __init__(self, client: EmailClient):
+        self.client = client
+        self.selected: str | None = None
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def folder(self, mailbox: str):
+        """独占连接并确保 `mailbox` 已被选中"""
+        async with self._lock:
+            if self.selected != mailbox:
+                self.selected = None
+                resp = await self.client.impl.select(quoted(mailbox))
+                if resp.result != "OK":
+                    raise RuntimeError(f"select {mailbox} failed: {resp.lines[-1:]}")
+                self.selected = mailbox
+            yield self.client.impl
+
+    async def status(self, mailbox: str):
+        async with self._lock:
+            return await self.client.impl.status(quoted(mailbox), "(UIDVALIDITY UIDNEXT)")
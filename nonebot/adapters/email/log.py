@@ -1,5 +1,18 @@
+from nonebot.log import logger
 from nonebot.utils import logger_wrapper
 
 from .config import ADAPTER_NAME
 
 log = logger_wrapper(ADAPTER_NAME)
+
+_log_level = 0
+
+
+def set_log_level(level: str | int) -> None:
+    global _log_level
+    _log_level = logger.level(level).no if isinstance(level, str) else level
+
+
+def log_enabled(level: str) -> bool:
+    """用于跳过开销较大的日志格式化, 如序列化整个事件"""
+    return logger.level(level).no >= _log_level
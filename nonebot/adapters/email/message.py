@@ -28,16 +28,47 @@
 
 # TODO: 毙了，先用 python 自带的email库
 
+import io
+import copy
+from functools import lru_cache
+from collections.abc import Iterable
 from email.contentmanager import ContentManager
+from email.generator import BytesGenerator
 from email.message import EmailMessage
+from email.policy import SMTP, SMTPUTF8
 from typing import Any
 from email_validator import validate_email, EmailNotValidError
 from .log import log
 
+# 模板中总是按每封邮件编码的头部
+ADDRESS_HEADERS = ("From", "Sender", "Reply-To", "To", "Cc", "Bcc")
+
+
+@lru_cache(maxsize=4096)
+def is_valid_address(address: str) -> bool:
+    """validate_email 较慢 (可能查询 DNS), 结果按地址缓存"""
+    try:
+        validate_email(address)
+    except EmailNotValidError:
+        return False
+    return True
+
+
+def _valid_addresses(addresses: str | list[str]) -> str:
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    valid = []
+    for address in addresses:
+        if is_valid_address(address):
+            valid.append(address)
+        else:
+            log("ERROR", f"Invalid email address: {address}")
+    return ", ".join(valid)
+
 
 class Message:
-    def __init__(self):
-        self._email = EmailMessage()
+    def __init__(self, email: EmailMessage | None = None):
+        self._email = EmailMessage() if email is None else email
 
     def __str__(self) -> str:
         return self._email.as_string()
@@ -50,46 +81,13 @@ class Message:
         self._email["Subject"] = subject
 
     def to(self, to: str | list[str]) -> None:
-        if isinstance(to, str):
-            to = [to]
-        valid_tos = []
-        for t in to:
-            try:
-                validate_email(t)
-            except EmailNotValidError:
-                log("ERROR", f"Invalid email address: {t}")
-                continue
-            else:
-                valid_tos.append(t)
-        self._email["To"] = ", ".join(valid_tos)
+        self._email["To"] = _valid_addresses(to)
 
     def cc(self, cc: str | list[str]) -> None:
-        if isinstance(cc, str):
-            cc = [cc]
-        valid_ccs = []
-        for c in cc:
-            try:
-                validate_email(c)
-            except EmailNotValidError:
-                log("ERROR", f"Invalid email address: {c}")
-                continue
-            else:
-                valid_ccs.append(c)
-        self._email["Cc"] = ", ".join(valid_ccs)
+        self._email["Cc"] = _valid_addresses(cc)
 
     def bcc(self, bcc: str | list[str]) -> None:
-        if isinstance(bcc, str):
-            bcc = [bcc]
-        valid_bccs = []
-        for b in bcc:
-            try:
-                validate_email(b)
-            except EmailNotValidError:
-                log("ERROR", f"Invalid email address: {b}")
-                continue
-            else:
-                valid_bccs.append(b)
-        self._email["Bcc"] = ", ".join(valid_bccs)
+        self._email["Bcc"] = _valid_addresses(bcc)
 
     def from_(self, from_: str) -> None:
         self._email["From"] = from_
@@ -100,3 +98,79 @@ class Message:
             content_manager=content_manager,
             **kw
         )
+
+
+class RenderedEmail(EmailMessage):
+    """由模板生成的邮件, 自身只保存动态头部, 其余部分使用模板预先序列化的字节"""
+
+    def __init__(self, template: "MessageTemplate"):
+        super().__init__()
+        self.template = template
+
+    def flatten(self, cte_type: str = "8bit", utf8: bool = False) -> bytes:
+        """与 aiosmtplib 的 flatten_message 相同, 去掉 Bcc 后序列化"""
+        policy = SMTPUTF8 if utf8 else SMTP
+        headers = b"".join(
+            policy.fold_binary(name, value)
+            for name, value in self.raw_items()
+            if name.lower() not in ("bcc", "resent-bcc")
+        )
+        static_headers, body = self.template.compile(cte_type)
+        return headers + static_headers + b"\r\n" + body
+
+    def as_bytes(self, unixfrom: bool = False, policy: Any = None) -> bytes:
+        return self.flatten()
+
+    def as_string(self, unixfrom: bool = False, maxheaderlen: int = 0, policy: Any = None) -> str:
+        return self.flatten().decode("utf-8", "surrogateescape")
+
+
+class MessageTemplate:
+    """预编译的邮件模板, 用于只有收件人和少数头部不同的大量邮件 (如自动回复)
+
+    正文, 附件和静态头部只序列化一次, `render` 时只编码地址头部和 `dynamic` 中的头部;
+    模板中的 Message-ID 会出现在每封邮件中, 应改为在 `render` 时传入
+    """
+
+    def __init__(self, message: Message, dynamic: Iterable[str] = ("Subject",)):
+        base = copy.deepcopy(message.email)
+        self.dynamic = {name.lower() for name in (*ADDRESS_HEADERS, *dynamic)}
+        self.defaults = [(name, value) for name, value in base.raw_items() if name.lower() in self.dynamic]
+        for name in self.dynamic:
+            del base[name]
+        self.static = {name.lower() for name in base.keys()}
+        self._base = base
+        # cte_type -> (静态头部, 正文)
+        self._compiled: dict[str, tuple[bytes, bytes]] = {}
+
+    def compile(self, cte_type: str = "8bit") -> tuple[bytes, bytes]:
+        if (compiled := self._compiled.get(cte_type)) is None:
+            with io.BytesIO() as buffer:
+                BytesGenerator(buffer, policy=SMTP.clone(cte_type=cte_type)).flatten(self._base)
+                raw = buffer.getvalue()
+            if raw.startswith(b"\r\n"):
+                compiled = (b"", raw[2:])
+            else:
+                head, _, body = raw.partition(b"\r\n\r\n")
+                compiled = (head + b"\r\n", body)
+            self._compiled[cte_type] = compiled
+        return compiled
+
+    def render(self, to: str | list[str] | None = None, **headers: str) -> Message:
+        """生成一封邮件, `headers` 的键中的 `_` 视为 `-`, 例如 in_reply_to="<id>" -> In-Reply-To
+
+        未传入的动态头部沿用模板中的值
+        """
+        values = {"-".join(part.capitalize() for part in key.split("_")): value for key, value in headers.items()}
+        if to is not None:
+            values["To"] = _valid_addresses(to)
+        email = RenderedEmail(self)
+        overridden = {name.lower() for name in values}
+        for name, value in self.defaults:
+            if name.lower() not in overridden:
+                email[name] = value
+        for name, value in values.items():
+            if name.lower() in self.static:
+                raise ValueError(f"{name} is a static header of the template, add it to `dynamic`")
+            email[name] = value
+        return Message(email)
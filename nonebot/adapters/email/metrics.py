@@ -0,0 +1,173 @@
+import time
+import bisect
+from contextlib import contextmanager
+from collections.abc import Callable, Iterator
+from typing import Any
+
+# 与 Prometheus 客户端的默认值相同, 单位为秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        """(后缀, 标签值, 额外标签, 值)"""
+        raise NotImplementedError
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """可以调用 `inc` 累加, 也可以在采集时调用 `function` 取值 (须只增不减), 后者在热路径上没有开销"""
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        function: Callable[[], float] | None = None,
+    ):
+        super().__init__(name, documentation, labels)
+        self.function = function
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _collect(self) -> dict[LabelValues, float]:
+        if self.function is not None:
+            self._values[()] = self.function()
+        return self._values
+
+    def samples(self):
+        for key, value in self._collect().items():
+            yield "", key, "", value
+
+    def snapshot(self):
+        return [{"labels": dict(zip(self.labels, key)), "value": value} for key, value in self._collect().items()]
+
+
+class Gauge(Counter):
+    """可增可减的值, 可以直接设置, 也可以在采集时调用 `function` 取值"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] | None = None):
+        super().__init__(name, documentation, function=function)
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数 (非累计), 总和, 次数]
+        self._values: dict[LabelValues, list[Any]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        if (data := self._values.get(key)) is None:
+            data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                yield "_bucket", key, f'le="{le}"', cumulative
+            yield "_sum", key, "", total
+            yield "_count", key, "", count
+
+    def snapshot(self):
+        return [
+            {"labels": dict(zip(self.labels, key)), "count": count, "sum": total}
+            for key, (_, total, count) in self._values.items()
+        ]
+
+
+class Metrics:
+    """适配器各热路径的指标, 可渲染为 Prometheus 文本格式, 或定时交给回调导出"""
+
+    def __init__(self):
+        self.idle_wakeups = Counter("email_idle_wakeups_total", "IDLE wakeups", ("account", "folder"))
+        self.prefilter_skipped = Counter(
+            "email_prefilter_skipped_total", "new mails skipped by the server side prefilter", ("account", "folder")
+        )
+        self.reconnects = Counter("email_reconnects_total", "IMAP reconnects", ("account",))
+        self.fetch_seconds = Histogram("email_fetch_seconds", "UID FETCH latency", ("account", "folder"))
+        self.parse_seconds = Histogram("email_parse_seconds", "header parse time, including executor queueing")
+        self.handler_seconds = Histogram("email_handler_seconds", "event handler latency")
+        self.smtp_send_seconds = Histogram("email_smtp_send_seconds", "SMTP send latency", ("account",))
+        self.dispatch_queue_depth = Gauge("email_dispatch_queue_depth", "events waiting to be handled")
+        self._metrics: list[_Metric] = [
+            value for value in vars(self).values() if isinstance(value, _Metric)
+        ]
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render_prometheus(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(metric.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
@@ -0,0 +1,96 @@
+import re
+import asyncio
+from typing import Any, NamedTuple
+
+from aioimaplib import IMAP4, SELECTED, Cmd, Exec, Command, Response, quoted
+
+from .utils import register_command
+from .config import PrefilterConfig
+
+# aioimaplib 的 SEARCH 是异步命令, 收不到 "+"; 含字面量的 UID SEARCH 以单独的同步命令发送,
+# 逐段发送的逻辑在 _LiteralSearchCommand 中, 不改动 SEARCH 本身
+register_command(Cmd("UID SEARCH", (SELECTED,), Exec.is_sync))
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n")
+
+
+class SearchCriteria(NamedTuple):
+    criteria: str
+    charset: str | None
+
+
+def _string(value: str) -> str:
+    """ASCII 用带引号的字符串; 8 位数据只能用字面量 (RFC 3501 4.3), 以 `{字节数}\\r\\n内容` 写在条件中"""
+    if value.isascii() and "\r" not in value and "\n" not in value:
+        return quoted(value)
+    return f"{{{len(value.encode())}}}\r\n{value}"
+
+
+def _any(keys: list[str]) -> str:
+    """IMAP 的 OR 只接受两个参数, 多个条件需要嵌套: OR a OR b c"""
+    result = keys[-1]
+    for key in reversed(keys[:-1]):
+        result = f"OR {key} {result}"
+    return result
+
+
+def compile_prefilter(prefilter: PrefilterConfig | None, gmail: bool = False) -> SearchCriteria | None:
+    """把预过滤配置编译为 UID SEARCH 条件, 没有任何条件时返回 None
+
+    `gmail` 为 False 时忽略 `gmail_raw`, 其余条件均为 RFC 3501 的标准条件
+    """
+    if prefilter is None:
+        return None
+    keys: list[str] = []
+    for name, values in (("FROM", prefilter.from_addrs), ("TO", prefilter.to_addrs), ("SUBJECT", prefilter.subjects)):
+        if values:
+            keys.append(_any([f"{name} {_string(value)}" for value in values]))
+    keys += [f"HEADER {_string(name)} {_string(value)}" for name, value in prefilter.headers.items()]
+    if prefilter.larger is not None:
+        keys.append(f"LARGER {prefilter.larger}")
+    keys += [f"NOT FROM {_string(value)}" for value in prefilter.exclude_from]
+    keys += [f"NOT SUBJECT {_string(value)}" for value in prefilter.exclude_subjects]
+    if gmail and prefilter.gmail_raw:
+        keys.append(f"X-GM-RAW {_string(prefilter.gmail_raw)}")
+    if not keys:
+        return None
+    criteria = " ".join(keys)
+    # 只有包含非 ASCII 字符时才需要声明 CHARSET, 部分服务器不支持该参数
+    return SearchCriteria(criteria, None if criteria.isascii() else "UTF-8")
+
+
+class _LiteralSearchCommand(Command):
+    """含同步字面量的 UID SEARCH: 先发送到第一个 `{n}` 为止, 每收到一次 "+" 再发送字面量及其后到下一个 `{n}` 的部分"""
+
+    def __init__(self, tag: str, protocol: Any, data: bytes):
+        self.protocol = protocol
+        self.pieces: list[bytes] = []
+        start = 0
+        for match in _LITERAL_RE.finditer(data):
+            if match.start() < start:
+                # 字面量的内容中恰好出现了 {n}\r\n
+                continue
+            self.pieces.append(data[start : match.start() + len(match.group()) - 2])
+            start = match.end() + int(match.group(1))
+            self.pieces.append(data[match.end() : start])
+        self.pieces.append(data[start:])
+        first = self.pieces.pop(0).decode()
+        super().__init__("UID SEARCH", tag, first, untagged_resp_name="SEARCH", loop=protocol.loop)
+
+    def append_to_resp(self, line: bytes, result: str = "Pending") -> None:
+        if result == "Pending" and line.startswith(b"+") and self.pieces:
+            literal, following = self.pieces.pop(0), self.pieces.pop(0)
+            self.protocol.transport.write(literal + following + b"\r\n")
+            return
+        super().append_to_resp(line, result)
+
+
+async def uid_search(imap: IMAP4, uid_set: str, search: SearchCriteria) -> Response:
+    """在 `uid_set` 内按预过滤条件 UID SEARCH"""
+    if "\r\n" not in search.criteria:
+        return await imap.uid_search(f"UID {uid_set}", search.criteria, charset=search.charset)
+    charset = f"CHARSET {search.charset} " if search.charset else ""
+    data = f"{charset}UID {uid_set} {search.criteria}".encode()
+    protocol = imap.protocol
+    command = _LiteralSearchCommand(protocol.new_tag(), protocol, data)
+    return await asyncio.wait_for(protocol.execute(command), imap.timeout)
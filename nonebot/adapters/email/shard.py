@@ -0,0 +1,194 @@
+import os
+import time
+import bisect
+import socket
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from collections.abc import Awaitable, Callable, Iterable
+
+from .log import log
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """一致性哈希: 每个 worker 在环上有 `replicas` 个虚拟节点, 增减 worker 时只有约 1/N 的账号换主"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64):
+        self._ring = sorted((_hash(f"{node}#{i}"), node) for node in set(nodes) for i in range(replicas))
+        self._keys = [key for key, _ in self._ring]
+
+    def owner(self, key: str) -> str | None:
+        if not self._ring:
+            return None
+        return self._ring[bisect.bisect(self._keys, _hash(key)) % len(self._ring)][1]
+
+
+class LeaseStore:
+    """worker 心跳和账号租约, 多个进程 (或挂载同一文件系统的多个节点) 共用一个 SQLite 文件
+
+    租约的获取和续期是一条 upsert 语句, 由 SQLite 的写锁保证同一时刻只有一个 worker 持有.
+    ShardCoordinator 在线程中调用, 等待写锁超过 `timeout` 秒时抛出异常, 下一轮重试
+    """
+
+    def __init__(self, path: str | Path, timeout: float = 10):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None, timeout=timeout, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " account TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        log("DEBUG", f"Lease store: {path}")
+
+    def heartbeat(self, worker: str, expires: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO workers (id, expires) VALUES (?, ?)"
+                " ON CONFLICT (id) DO UPDATE SET expires = excluded.expires",
+                (worker, expires),
+            )
+
+    def workers(self, now: float) -> list[str]:
+        """心跳未过期的 worker, 同时清理一小时前就已停止心跳的记录"""
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE expires < ?", (now - 3600,))
+            return [row[0] for row in self._conn.execute("SELECT id FROM workers WHERE expires >= ?", (now,))]
+
+    def acquire(self, account: str, worker: str, expires: float, now: float) -> bool:
+        """获取或续期租约, 其他 worker 的租约未过期时失败"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO leases (account, owner, expires) VALUES (?, ?, ?)"
+                " ON CONFLICT (account) DO UPDATE SET owner = excluded.owner, expires = excluded.expires"
+                " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (account, worker, expires, now),
+            )
+            return cursor.rowcount > 0
+
+    def release(self, account: str, worker: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE account = ? AND owner = ?", (account, worker))
+
+    def leave(self, worker: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE owner = ?", (worker,))
+            self._conn.execute("DELETE FROM workers WHERE id = ?", (worker,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ShardCoordinator:
+    """按一致性哈希把账号分给存活的 worker, 只监听持有租约的账号
+
+    每 `ttl / 3` 秒心跳并续期; worker 退出时主动释放租约, 异常退出时其心跳和租约在 `ttl` 秒后过期,
+    其余 worker 随后接手. 新 worker 加入时原 worker 先停止监听并释放, 新 worker 才能取得租约;
+    停止 (如 LOGOUT) 可能较慢, 在后台进行, 期间继续续期, 完成后才释放.
+    租约存储的调用在线程中进行, 不阻塞事件循环
+    """
+
+    def __init__(
+        self,
+        store: LeaseStore,
+        worker_id: str,
+        accounts: Iterable[str],
+        ttl: float,
+        replicas: int,
+        start: Callable[[str], None],
+        stop: Callable[[str], Awaitable[None]],
+    ):
+        self.store = store
+        self.worker_id = worker_id
+        self.accounts = list(accounts)
+        self.ttl = ttl
+        self.replicas = replicas
+        self.start_account = start
+        self.stop_account = stop
+        self.owned: set[str] = set()
+        # 正在停止的账号 -> 停止任务
+        self._releasing: dict[str, asyncio.Task] = {}
+        # 续期和释放不交错, 避免刚释放的租约又被续期
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """停止监听所有账号并释放租约, 其他 worker 可以立即接手"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for account in list(self.owned):
+            self._start_release(account)
+        await asyncio.gather(*self._releasing.values(), return_exceptions=True)
+        await asyncio.to_thread(self.store.leave, self.worker_id)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                log("ERROR", f"Shard {self.worker_id} rebalance error", exception=e)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def rebalance(self) -> None:
+        async with self._lock:
+            now = time.time()
+            expires = now + self.ttl
+            ring = HashRing(await asyncio.to_thread(self._heartbeat, expires, now), self.replicas)
+            # 正在停止的账号继续续期, 归本 worker 的账号获取或续期
+            wanted = [
+                account
+                for account in self.accounts
+                if account in self._releasing or ring.owner(account) == self.worker_id
+            ]
+            held = await asyncio.to_thread(self._acquire, wanted, expires, now)
+            for account in self.accounts:
+                if account in self._releasing:
+                    continue
+                if account in self.owned:
+                    # 不再归本 worker, 或租约已被接手 (本 worker 长时间未续期)
+                    if account not in held:
+                        self._start_release(account)
+                elif account in held:
+                    self.owned.add(account)
+                    log("INFO", f"Shard {self.worker_id} acquired {account}")
+                    self.start_account(account)
+
+    def _heartbeat(self, expires: float, now: float) -> list[str]:
+        self.store.heartbeat(self.worker_id, expires)
+        return self.store.workers(now)
+
+    def _acquire(self, accounts: list[str], expires: float, now: float) -> set[str]:
+        return {account for account in accounts if self.store.acquire(account, self.worker_id, expires, now)}
+
+    def _start_release(self, account: str) -> None:
+        self.owned.discard(account)
+        self._releasing[account] = asyncio.create_task(self._release(account))
+
+    async def _release(self, account: str) -> None:
+        try:
+            await self.stop_account(account)
+        finally:
+            async with self._lock:
+                await asyncio.to_thread(self.store.release, account, self.worker_id)
+                del self._releasing[account]
+            log("INFO", f"Shard {self.worker_id} released {account}")
@@ -0,0 +1,313 @@
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from typing import Any, NamedTuple
+
+from aiosmtplib import (
+    SMTP,
+    SMTPException,
+    SMTPResponse,
+    SMTPStatus,
+    SMTPTimeoutError,
+    SMTPConnectError,
+    SMTPSenderRefused,
+    SMTPRecipientRefused,
+    SMTPRecipientsRefused,
+    SMTPServerDisconnected,
+    SMTPConnectTimeoutError,
+    SMTPConnectResponseError,
+)
+from aiosmtplib.email import quote_address, extract_sender, flatten_message, extract_recipients
+from aiosmtplib.protocol import SMTPProtocol
+
+from .log import log
+from .message import Message, RenderedEmail
+
+
+class PoolKey(NamedTuple):
+    host: str
+    port: int | None
+    user: str
+
+
+class SendResult(NamedTuple):
+    """批量发送中单封邮件的结果, `refused` 为被拒收的收件人及服务器响应"""
+    message: Message
+    recipients: list[str]
+    refused: dict[str, SMTPResponse]
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.refused
+
+
+def flatten_email(message: EmailMessage, cte_type: str = "8bit", utf8: bool = False) -> bytes:
+    """去掉 Bcc 后序列化, 模板生成的邮件直接使用预先序列化的字节"""
+    if isinstance(message, RenderedEmail):
+        return message.flatten(cte_type, utf8)
+    return flatten_message(message, utf8=utf8, cte_type=cte_type)
+
+
+class PipeliningSMTPProtocol(SMTPProtocol):
+    """aiosmtplib 每次 data_received 只解析一条响应, 且在上一条响应未被取走时丢弃新数据,
+    这里改为先缓存, 读取时优先从缓冲区取, 使流水线命令的多条响应能按顺序读出
+
+    用到了 aiosmtplib 2.0 的内部属性, pyproject 中固定了其版本
+    """
+
+    def data_received(self, data: bytes) -> None:
+        if self._response_waiter is not None and self._response_waiter.done():
+            self._buffer.extend(data)
+            return
+        super().data_received(data)
+
+    async def read_response(self, timeout: float | None = None) -> SMTPResponse:
+        if self._response_waiter is not None and not self._response_waiter.done():
+            if (response := self._read_response_from_buffer()) is not None:
+                return response
+        return await super().read_response(timeout)
+
+
+class PipeliningSMTP(SMTP):
+    """建立连接时即使用 PipeliningSMTPProtocol, 服务器未声明 PIPELINING 时其行为与原协议相同
+
+    aiosmtplib 没有指定协议类的参数, 这里按其 `_create_connection` 重写, 只支持主机名和端口连接
+    """
+
+    async def _create_connection(self) -> SMTPResponse:
+        if self.loop is None:
+            raise RuntimeError("No event loop set")
+        if self.hostname is None or self.port is None:
+            raise RuntimeError("No hostname or port provided")
+        protocol = PipeliningSMTPProtocol(loop=self.loop, connection_lost_callback=self._connection_lost)
+        connect = self.loop.create_connection(
+            lambda: protocol,
+            host=self.hostname,
+            port=self.port,
+            ssl=self._get_tls_context() if self.use_tls else None,
+            ssl_handshake_timeout=self.timeout if self.use_tls else None,
+            local_addr=self.source_address,
+        )
+        try:
+            transport, _ = await asyncio.wait_for(connect, timeout=self.timeout)
+        except (TimeoutError, asyncio.TimeoutError) as e:
+            raise SMTPConnectTimeoutError(f"Timed out connecting to {self.hostname} on port {self.port}") from e
+        except OSError as e:
+            raise SMTPConnectError(f"Error connecting to {self.hostname} on port {self.port}: {e}") from e
+        self.protocol = protocol
+        self.transport = transport
+
+        try:
+            response = await protocol.read_response(timeout=self.timeout)
+        except SMTPServerDisconnected as e:
+            raise SMTPConnectError(f"Error connecting to {self.hostname} on port {self.port}: {e}") from e
+        except SMTPTimeoutError as e:
+            raise SMTPConnectTimeoutError("Timed out waiting for server ready message") from e
+        if response.code != SMTPStatus.ready:
+            raise SMTPConnectResponseError(response.code, response.message)
+        return response
+
+
+class PooledSMTP:
+    """连接池中的一条 SMTP 连接"""
+
+    def __init__(self, key: PoolKey, password: str, use_tls: bool):
+        self.key = key
+        self.client = PipeliningSMTP(
+            hostname=key.host,
+            port=key.port,
+            username=key.user or None,
+            password=password or None,
+            use_tls=use_tls,
+        )
+        self.sent = 0
+        self.last_used = self.last_checked = time.monotonic()
+
+    @property
+    def idle_time(self) -> float:
+        return time.monotonic() - self.last_used
+
+    @property
+    def unchecked_time(self) -> float:
+        return time.monotonic() - max(self.last_used, self.last_checked)
+
+    async def connect(self) -> None:
+        await self.client.connect()
+        log("DEBUG", f"SMTP connected: {self.key.user}@{self.key.host}:{self.key.port}")
+
+    async def is_alive(self) -> bool:
+        if not self.client.is_connected:
+            return False
+        try:
+            await self.client.noop()
+        except SMTPException:
+            return False
+        self.last_checked = time.monotonic()
+        return True
+
+    async def send_message(
+        self, message: EmailMessage, sender: str | None = None, recipients: list[str] | None = None
+    ) -> tuple[list[str], dict[str, SMTPResponse]]:
+        """发送一封邮件, 返回 (收件人, 被拒收的收件人)"""
+        sender = sender or extract_sender(message)
+        recipients = recipients or extract_recipients(message)
+        if sender is None:
+            raise ValueError("No From header provided in message")
+        if not recipients:
+            raise ValueError("No recipient headers provided in message")
+        utf8 = not (sender + "".join(recipients)).isascii()
+        cte_type = "8bit" if self.client.supports_extension("8bitmime") else "7bit"
+        return await self.send_raw(sender, recipients, flatten_email(message, cte_type, utf8), utf8)
+
+    async def send_raw(
+        self, sender: str, recipients: list[str], data: bytes, utf8: bool = False
+    ) -> tuple[list[str], dict[str, SMTPResponse]]:
+        """发送已序列化的邮件, 返回 (收件人, 被拒收的收件人)
+
+        服务器声明 PIPELINING (RFC 2920) 时, MAIL FROM 与所有 RCPT TO 合并为一次写入,
+        收件人再多也只需一次往返
+        """
+        client = self.client
+        eight_bit = client.supports_extension("8bitmime")
+        if not eight_bit and not data.isascii():
+            # 入队时按 8bit 序列化, 服务器不支持 8BITMIME 时重新编码
+            data = flatten_message(message_from_bytes(data, policy=policy.SMTP), utf8=utf8, cte_type="7bit")
+        if utf8 or not client.supports_extension("pipelining") or client.protocol is None:
+            refused, _ = await client.sendmail(
+                sender,
+                recipients,
+                data,
+                mail_options=["SMTPUTF8"] * utf8 + ["BODY=8BITMIME"] * eight_bit,
+            )
+            return recipients, refused
+
+        mail_options = b" BODY=8BITMIME" if eight_bit else b""
+        commands = [b"MAIL FROM:" + quote_address(sender).encode() + mail_options]
+        commands += [b"RCPT TO:" + quote_address(recipient).encode() for recipient in recipients]
+        client.protocol.write(b"".join(command + b"\r\n" for command in commands))
+        # 每条命令都必须读取一次响应, 即使 MAIL FROM 已失败
+        mail_resp = await client.protocol.read_response(timeout=client.timeout)
+        rcpt_resps = [await client.protocol.read_response(timeout=client.timeout) for _ in recipients]
+
+        if mail_resp.code != SMTPStatus.completed:
+            await client.rset()
+            raise SMTPSenderRefused(mail_resp.code, mail_resp.message, sender)
+        refused = {
+            recipient: resp
+            for recipient, resp in zip(recipients, rcpt_resps)
+            if resp.code not in (SMTPStatus.completed, SMTPStatus.will_forward)
+        }
+        if len(refused) == len(recipients):
+            await client.rset()
+            raise SMTPRecipientsRefused(
+                [SMTPRecipientRefused(resp.code, resp.message, recipient) for recipient, resp in refused.items()]
+            )
+
+        await client.data(data)
+        return recipients, refused
+
+    async def close(self) -> None:
+        if not self.client.is_connected:
+            return
+        try:
+            await self.client.quit()
+        except SMTPException:
+            self.client.close()
+
+
+class SMTPPool:
+    """按 (host, port, user) 复用的 SMTP 连接池
+
+    - 空闲超过 `keepalive` 秒的连接在复用前先 NOOP 检查
+    - 空闲超过 `max_idle` 秒的连接直接关闭
+    - 每条连接最多发送 `max_messages` 封邮件后重建
+    - 每个 key 最多同时持有 `max_connections` 条连接
+    """
+
+    def __init__(self, max_idle: float, keepalive: float, max_messages: int, max_connections: int):
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.max_messages = max_messages
+        self.max_connections = max_connections
+        self._idle: dict[PoolKey, list[PooledSMTP]] = defaultdict(list)
+        self._limits: dict[PoolKey, asyncio.Semaphore] = {}
+        self._reaper: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        connections = [conn for idle in self._idle.values() for conn in idle]
+        self._idle.clear()
+        await asyncio.gather(*(conn.close() for conn in connections), return_exceptions=True)
+
+    @asynccontextmanager
+    async def connection(self, key: PoolKey, password: str, use_tls: bool):
+        """取出一条可用连接, 用完后归还; 发生异常的连接不会被归还"""
+        limit = self._limits.setdefault(key, asyncio.Semaphore(self.max_connections))
+        async with limit:
+            conn = await self._acquire(key, password, use_tls)
+            try:
+                yield conn
+            except BaseException:
+                # 连接状态未知, 直接断开而不是 QUIT
+                conn.client.close()
+                raise
+            else:
+                conn.sent += 1
+                conn.last_used = time.monotonic()
+                if conn.sent >= self.max_messages:
+                    log("DEBUG", f"SMTP connection of {key.user} reached {conn.sent} messages, recycle")
+                    await conn.close()
+                else:
+                    self._idle[key].append(conn)
+
+    async def send(self, key: PoolKey, password: str, use_tls: bool, message: EmailMessage, **kwargs: Any):
+        async with self.connection(key, password, use_tls) as conn:
+            return await conn.send_message(message, **kwargs)
+
+    async def send_raw(
+        self, key: PoolKey, password: str, use_tls: bool, sender: str, recipients: list[str], data: bytes, utf8: bool
+    ):
+        async with self.connection(key, password, use_tls) as conn:
+            return await conn.send_raw(sender, recipients, data, utf8)
+
+    async def _acquire(self, key: PoolKey, password: str, use_tls: bool) -> PooledSMTP:
+        idle = self._idle[key]
+        while idle:
+            # 优先使用最近归还的连接, 它们最可能仍然存活
+            conn = idle.pop()
+            if conn.idle_time > self.max_idle:
+                await conn.close()
+                continue
+            if conn.unchecked_time > self.keepalive and not await conn.is_alive():
+                await conn.close()
+                continue
+            return conn
+        conn = PooledSMTP(key, password, use_tls)
+        await conn.connect()
+        return conn
+
+    async def _reap(self) -> None:
+        """定期关闭过期连接, 并对其余空闲连接发送 NOOP 保活"""
+        while True:
+            await asyncio.sleep(self.keepalive)
+            for key in list(self._idle):
+                # 先整体取出, 避免检查期间同一连接被并发取用
+                idle, self._idle[key] = self._idle[key], []
+                alive = []
+                for conn in idle:
+                    if conn.idle_time > self.max_idle or not await conn.is_alive():
+                        await conn.close()
+                    else:
+                        alive.append(conn)
+                self._idle[key].extend(alive)
@@ -0,0 +1,349 @@
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from collections.abc import Awaitable, Callable, Collection
+from typing import Any, TypeVar, NamedTuple
+
+from aiosmtplib import SMTPException, SMTPResponse, SMTPResponseException, SMTPRecipientsRefused
+
+from .log import log
+from .utils import backoff_delay
+
+T = TypeVar("T")
+
+
+class SpooledMail(NamedTuple):
+    """已入队的邮件, `data` 为去掉 Bcc 后按 8bit 序列化的内容"""
+    id: int
+    account: str
+    sender: str
+    recipients: list[str]
+    data: bytes
+    utf8: bool
+    attempts: int
+    next_attempt: float
+
+
+class SpoolStore(ABC):
+    """发件队列的存储, 邮件在发送成功或永久失败前一直保留"""
+
+    # 为 True 时 Spool 在线程中调用存储, 不阻塞事件循环
+    blocking = False
+
+    @abstractmethod
+    def put(self, account: str, sender: str, recipients: list[str], data: bytes, utf8: bool) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def due(
+        self, now: float, limit: int, skip_accounts: Collection[str] = (), skip_ids: Collection[int] = ()
+    ) -> list[SpooledMail]:
+        """到期的邮件, 按到期时间排序"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def next_due(self, skip_accounts: Collection[str] = (), skip_ids: Collection[int] = ()) -> float | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def retry(self, id: int, recipients: list[str], attempts: int, next_attempt: float) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySpoolStore(SpoolStore):
+    """只在进程内保存, 重启后未发送的邮件丢失"""
+
+    def __init__(self):
+        self._mails: dict[int, SpooledMail] = {}
+        self._next_id = 1
+
+    def put(self, account: str, sender: str, recipients: list[str], data: bytes, utf8: bool) -> int:
+        id, self._next_id = self._next_id, self._next_id + 1
+        self._mails[id] = SpooledMail(id, account, sender, recipients, data, utf8, 0, time.time())
+        return id
+
+    def _pending(self, skip_accounts: Collection[str], skip_ids: Collection[int]) -> list[SpooledMail]:
+        return [mail for mail in self._mails.values() if mail.account not in skip_accounts and mail.id not in skip_ids]
+
+    def due(self, now, limit, skip_accounts=(), skip_ids=()):
+        mails = [mail for mail in self._pending(skip_accounts, skip_ids) if mail.next_attempt <= now]
+        return sorted(mails, key=lambda mail: (mail.next_attempt, mail.id))[:limit]
+
+    def next_due(self, skip_accounts=(), skip_ids=()):
+        return min((mail.next_attempt for mail in self._pending(skip_accounts, skip_ids)), default=None)
+
+    def retry(self, id: int, recipients: list[str], attempts: int, next_attempt: float) -> None:
+        self._mails[id] = self._mails[id]._replace(recipients=recipients, attempts=attempts, next_attempt=next_attempt)
+
+    def remove(self, id: int) -> None:
+        self._mails.pop(id, None)
+
+    def __len__(self) -> int:
+        return len(self._mails)
+
+
+class SQLiteSpoolStore(SpoolStore):
+    """在线程中访问, 用锁保证同一时刻只有一个线程使用连接"""
+
+    blocking = True
+
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " account TEXT NOT NULL,"
+            " sender TEXT NOT NULL,"
+            " recipients TEXT NOT NULL,"
+            " data BLOB NOT NULL,"
+            " utf8 INTEGER NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS spool_next_attempt ON spool (next_attempt)")
+        log("DEBUG", f"Spool store: {path}")
+
+    @staticmethod
+    def _row(row: tuple) -> SpooledMail:
+        id, account, sender, recipients, data, utf8, attempts, next_attempt = row
+        return SpooledMail(id, account, sender, json.loads(recipients), data, bool(utf8), attempts, next_attempt)
+
+    @staticmethod
+    def _skip(skip_accounts: Collection[str], skip_ids: Collection[int]) -> tuple[str, list]:
+        accounts, ids = list(skip_accounts), list(skip_ids)
+        clause = f" AND account NOT IN ({', '.join('?' * len(accounts))})" if accounts else ""
+        clause += f" AND id NOT IN ({', '.join('?' * len(ids))})" if ids else ""
+        return clause, [*accounts, *ids]
+
+    def put(self, account: str, sender: str, recipients: list[str], data: bytes, utf8: bool) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO spool (account, sender, recipients, data, utf8, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                (account, sender, json.dumps(recipients), data, utf8, time.time()),
+            )
+        return cursor.lastrowid  # type: ignore
+
+    def due(self, now, limit, skip_accounts=(), skip_ids=()):
+        clause, params = self._skip(skip_accounts, skip_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, account, sender, recipients, data, utf8, attempts, next_attempt FROM spool"
+                f" WHERE next_attempt <= ?{clause} ORDER BY next_attempt, id LIMIT ?",
+                (now, *params, limit),
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def next_due(self, skip_accounts=(), skip_ids=()):
+        clause, params = self._skip(skip_accounts, skip_ids)
+        with self._lock:
+            return self._conn.execute(f"SELECT MIN(next_attempt) FROM spool WHERE 1{clause}", params).fetchone()[0]
+
+    def retry(self, id: int, recipients: list[str], attempts: int, next_attempt: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE spool SET recipients = ?, attempts = ?, next_attempt = ? WHERE id = ?",
+                (json.dumps(recipients), attempts, next_attempt, id),
+            )
+
+    def remove(self, id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM spool WHERE id = ?", (id,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class TokenBucket:
+    """每秒补充 `rate` 个令牌, 最多积累 `burst` 个"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def take(self) -> float:
+        """取一个令牌, 成功返回 0, 否则返回还需等待的秒数"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+Deliver = Callable[[SpooledMail], Awaitable[tuple[list[str], dict[str, SMTPResponse]]]]
+
+
+def _is_transient(code: int) -> bool:
+    return 400 <= code < 500
+
+
+class Spool:
+    """发件队列: 入队即返回, 后台按服务商限速发送
+
+    4xx 响应和连接错误视为临时错误, 按指数退避重试, 超过 `max_attempts` 次后放弃;
+    部分收件人被临时拒收时只重试这些收件人. 进程退出时正在发送的邮件下次启动会再发一次
+    """
+
+    def __init__(
+        self,
+        store: SpoolStore,
+        deliver: Deliver,
+        bucket: Callable[[str], TokenBucket | None],
+        concurrency: int,
+        max_attempts: int,
+        retry_base_delay: float,
+        retry_max_delay: float,
+        owns: Callable[[str], bool] | None = None,
+    ):
+        self.store = store
+        self.deliver = deliver
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        # 多个 worker 共用队列时, 只发送本 worker 负责的账号的邮件
+        self.owns = owns
+        self.retries = 0
+        self.dropped = 0
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def put(self, account: str, sender: str, recipients: list[str], data: bytes, utf8: bool) -> int:
+        id = await self._call(self.store.put, account, sender, recipients, data, utf8)
+        self.wakeup()
+        return id
+
+    async def _call(self, func: Callable[..., T], *args: Any) -> T:
+        if self.store.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def wakeup(self) -> None:
+        """立即重新检查队列, 例如负责的账号发生变化后"""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float | None = None) -> None:
+        """停止取新邮件, 等待正在发送的邮件 (最多 `timeout` 秒), 未发送的留在队列中"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if tasks := list(self._inflight.values()):
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            timeout = await self._schedule()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _schedule(self) -> float | None:
+        """发出所有现在可以发送的邮件, 返回最多等待多久后再检查, None 表示等待唤醒"""
+        now = time.time()
+        # 令牌用完的账号 -> 还需等待的秒数
+        throttled: dict[str, float] = {}
+        foreign: set[str] = set()
+        while len(self._inflight) < self.concurrency:
+            mails = await self._call(
+                self.store.due, now, self.concurrency - len(self._inflight), [*throttled, *foreign], [*self._inflight]
+            )
+            if not mails:
+                break
+            for mail in mails:
+                if mail.account in throttled or mail.account in foreign:
+                    continue
+                if self.owns is not None and not self.owns(mail.account):
+                    foreign.add(mail.account)
+                    continue
+                if (bucket := self.bucket(mail.account)) and (wait := bucket.take()):
+                    throttled[mail.account] = wait
+                    continue
+                task = asyncio.create_task(self._deliver(mail))
+                self._inflight[mail.id] = task
+        if len(self._inflight) >= self.concurrency:
+            return None
+        delays = list(throttled.values())
+        if (next_due := await self._call(self.store.next_due, [*throttled, *foreign], [*self._inflight])) is not None:
+            delays.append(max(next_due - now, 0))
+        return min(delays, default=None)
+
+    async def _deliver(self, mail: SpooledMail) -> None:
+        # 存储更新后才移出 _inflight, 避免这封邮件在删除前被再次取出
+        try:
+            await self._settle(mail, await self._attempt(mail))
+        finally:
+            del self._inflight[mail.id]
+            self._wakeup.set()
+
+    async def _attempt(self, mail: SpooledMail) -> dict[str, SMTPResponse]:
+        """发送一次, 返回被拒收的收件人"""
+        try:
+            _, refused = await self.deliver(mail)
+        except SMTPRecipientsRefused as e:
+            refused = {error.recipient: SMTPResponse(error.code, error.message) for error in e.recipients}
+        except SMTPResponseException as e:
+            refused = {recipient: SMTPResponse(e.code, e.message) for recipient in mail.recipients}
+        except (SMTPException, OSError, asyncio.TimeoutError) as e:
+            # 连接失败或断开, 整封邮件稍后重试
+            refused = {recipient: SMTPResponse(421, repr(e)) for recipient in mail.recipients}
+        except Exception as e:
+            log("ERROR", f"Spooled mail {mail.id} of {mail.account} can not be sent", exception=e)
+            refused = {}
+        return refused
+
+    async def _settle(self, mail: SpooledMail, refused: dict[str, SMTPResponse]) -> None:
+        retry = [recipient for recipient, resp in refused.items() if _is_transient(resp.code)]
+        for recipient, resp in refused.items():
+            if not _is_transient(resp.code):
+                log("WARNING", f"Mail {mail.id} to {recipient} refused: {resp.code} {resp.message}")
+        if not retry:
+            await self._call(self.store.remove, mail.id)
+            return
+        attempts = mail.attempts + 1
+        if attempts >= self.max_attempts:
+            self.dropped += 1
+            log("ERROR", f"Mail {mail.id} to {retry} dropped after {attempts} attempts: {refused[retry[0]].message}")
+            await self._call(self.store.remove, mail.id)
+            return
+        delay = backoff_delay(attempts - 1, self.retry_base_delay, self.retry_max_delay)
+        self.retries += 1
+        log("INFO", f"Mail {mail.id} to {retry} retry in {delay:.0f}s: {refused[retry[0]].code}")
+        await self._call(self.store.retry, mail.id, retry, attempts, time.time() + delay)
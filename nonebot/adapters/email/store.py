@@ -0,0 +1,68 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from .log import log
+from .utils import MailboxState
+
+
+class CheckpointStore(ABC):
+    """记录每个 (账号, 邮箱) 的 UIDVALIDITY 和已处理到的 UID, 用于重启后补发断线期间的邮件"""
+
+    @abstractmethod
+    def load(self, account: str, mailbox: str) -> MailboxState | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, account: str, mailbox: str, state: MailboxState) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    """只在进程内保存, 重启后从当前 UIDNEXT 开始"""
+
+    def __init__(self):
+        self._states: dict[tuple[str, str], MailboxState] = {}
+
+    def load(self, account: str, mailbox: str) -> MailboxState | None:
+        return self._states.get((account, mailbox))
+
+    def save(self, account: str, mailbox: str, state: MailboxState) -> None:
+        self._states[(account, mailbox)] = state
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " account TEXT NOT NULL,"
+            " mailbox TEXT NOT NULL,"
+            " uidvalidity INTEGER,"
+            " last_uid INTEGER NOT NULL,"
+            " PRIMARY KEY (account, mailbox))"
+        )
+        log("DEBUG", f"Checkpoint store: {path}")
+
+    def load(self, account: str, mailbox: str) -> MailboxState | None:
+        row = self._conn.execute(
+            "SELECT uidvalidity, last_uid FROM checkpoints WHERE account = ? AND mailbox = ?",
+            (account, mailbox),
+        ).fetchone()
+        return MailboxState(*row) if row else None
+
+    def save(self, account: str, mailbox: str, state: MailboxState) -> None:
+        self._conn.execute(
+            "INSERT INTO checkpoints (account, mailbox, uidvalidity, last_uid) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (account, mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity,"
+            " last_uid = excluded.last_uid",
+            (account, mailbox, state.uidvalidity, state.last_uid),
+        )
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,147 @@
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+from collections import OrderedDict
+from typing import NamedTuple
+
+from .log import log
+
+_msg_id_pattern = re.compile(r"<[^<>\s]+>")
+# 回复时 References 最多保留的 id 数, 保留第一个 (根) 和最近的几个, 与常见邮件客户端的做法相同
+MAX_REFERENCES = 10
+
+
+def parse_msg_ids(value: str | None) -> list[str]:
+    """提取 References/In-Reply-To 中的 `<id>`, 忽略其间的注释和折行"""
+    return _msg_id_pattern.findall(value) if value else []
+
+
+def _trim_references(references: list[str]) -> tuple[str, ...]:
+    if len(references) <= MAX_REFERENCES:
+        return tuple(references)
+    return (references[0], *references[-(MAX_REFERENCES - 1) :])
+
+
+class ThreadEntry(NamedTuple):
+    """`root` 为会话第一封邮件的 Message-ID, `references` 为回复这封邮件时使用的 References"""
+    root: str
+    references: tuple[str, ...]
+
+
+class ThreadStore(ABC):
+    """会话索引的持久化, 重启后仍能把回复归入原来的会话"""
+
+    @abstractmethod
+    def load(self, message_id: str) -> ThreadEntry | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, message_id: str, entry: ThreadEntry) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteThreadStore(ThreadStore):
+    """最多保留 `max_rows` 条, 超出时删除最早写入的"""
+
+    def __init__(self, path: str | Path, max_rows: int):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_rows = max_rows
+        self._saved = 0
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " message_id TEXT NOT NULL UNIQUE,"
+            " root TEXT NOT NULL,"
+            " refs TEXT NOT NULL)"
+        )
+        log("DEBUG", f"Thread store: {path}")
+
+    def load(self, message_id: str) -> ThreadEntry | None:
+        row = self._conn.execute("SELECT root, refs FROM threads WHERE message_id = ?", (message_id,)).fetchone()
+        return ThreadEntry(row[0], tuple(row[1].split())) if row else None
+
+    def save(self, message_id: str, entry: ThreadEntry) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO threads (message_id, root, refs) VALUES (?, ?, ?)",
+            (message_id, entry.root, " ".join(entry.references)),
+        )
+        self._saved += 1
+        # 每写入 max_rows / 10 条清理一次, 表的大小不超过 1.1 * max_rows
+        if self._saved >= max(self.max_rows // 10, 1):
+            self._saved = 0
+            self._conn.execute(
+                "DELETE FROM threads WHERE id <= (SELECT MAX(id) FROM threads) - ?", (self.max_rows,)
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class ThreadIndex:
+    """Message-ID -> 会话, 按 References/In-Reply-To 归并, 内存中最多保留 `max_size` 条 (LRU)
+
+    内存中查不到时再查 `store`, 查找和插入都是 O(1)
+    """
+
+    def __init__(self, max_size: int, store: ThreadStore | None = None):
+        self.max_size = max_size
+        self.store = store
+        self._entries: OrderedDict[str, ThreadEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message_id: str) -> ThreadEntry | None:
+        entry = self._entries.get(message_id)
+        if entry is not None:
+            self._entries.move_to_end(message_id)
+            return entry
+        if self.store is not None and (entry := self.store.load(message_id)) is not None:
+            self._put(message_id, entry)
+        return entry
+
+    def _put(self, message_id: str, entry: ThreadEntry) -> None:
+        self._entries[message_id] = entry
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def add(self, message_id: str, in_reply_to: str | None = None, references: str | None = None) -> str:
+        """记录一封邮件并返回其会话的根
+
+        References 的第一个 id 即为根; 缺少 References 时 (部分客户端只写 In-Reply-To) 沿用父邮件所在的会话
+        """
+        if (entry := self.get(message_id)) is not None:
+            return entry.root
+        ids = parse_msg_ids(references)
+        parents = parse_msg_ids(in_reply_to)
+        if parents and parents[-1] not in ids:
+            ids.append(parents[-1])
+        root = message_id
+        if ids:
+            known = next((entry for id in (ids[0], ids[-1]) if (entry := self.get(id)) is not None), None)
+            root = known.root if known else ids[0]
+            # 父邮件的 References 比这封邮件的更完整时以父邮件为准
+            if len(ids) == 1 and known and known.references:
+                ids = [*known.references[:-1], ids[0]]
+        entry = ThreadEntry(root, _trim_references([*ids, message_id]))
+        self._put(message_id, entry)
+        if self.store is not None:
+            self.store.save(message_id, entry)
+        return root
+
+    def reply_headers(self, message_id: str) -> tuple[str, str] | None:
+        """回复 `message_id` 时的 (In-Reply-To, References), 不认识这封邮件时返回 None"""
+        if (entry := self.get(message_id)) is None:
+            return None
+        return message_id, " ".join(entry.references)
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
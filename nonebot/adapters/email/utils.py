@@ -1,12 +1,259 @@
-from aioimaplib import Response
-from email import parser
-from fast_mail_parser import parse_email
+import re
+import base64
+import codecs
+import random
+import binascii
+from collections.abc import Sequence
+from typing import NamedTuple
+from aioimaplib import Cmd, Response, Commands
+
+from .bodystructure import BodyPart, parse_bodystructure
+from .config import FETCH_HEADER_FIELDS
+
+_fetch_start_pattern = re.compile(rb"^(\d+) FETCH \(")
+_fetch_uid_pattern = re.compile(rb"\bUID (\d+)")
+_fetch_size_pattern = re.compile(rb"\bRFC822\.SIZE (\d+)")
+_fetch_flags_pattern = re.compile(rb"\bFLAGS \(([^)]*)\)")
+_section_literal_pattern = re.compile(rb"\bBODY\[[^\]]*\](?:<\d+>)? \{\d+\}$", re.IGNORECASE)
+_uidnext_pattern = re.compile(rb"\[UIDNEXT (\d+)\]")
+_uidvalidity_pattern = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+_status_pattern = re.compile(rb'^(?:STATUS )?("(?:[^"\\]|\\.)*"|[^\s(]+) \(([^)]*)\)', re.IGNORECASE)
+_encoded_word_pattern = re.compile(r"=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?=")
+# 头部名称大小写不统一 (如 Message-Id), 统一成常用写法便于查找
+_canonical_header_names = {name.lower(): name for name in FETCH_HEADER_FIELDS}
+
+
+class FetchedMail(NamedTuple):
+    seq: str
+    uid: int
+    flags: list[str]
+    size: int
+    literal: bytes
+    bodystructure: BodyPart | None = None
+
+
+class ParsedHeaders(NamedTuple):
+    date: str
+    subject: str
+    headers: dict[str, str]
+
+
+class MailboxState(NamedTuple):
+    uidvalidity: int | None
+    last_uid: int
+
+
+def register_command(cmd: Cmd) -> None:
+    """在 aioimaplib 的命令表中登记它不认识的命令, 之后才能通过 execute 发送
+
+    命令表是进程内全局的: 已有同名命令时不覆盖, 只检查其兼容 (同为同步或异步, 且包含所需的状态)
+    """
+    existing = Commands.setdefault(cmd.name, cmd)
+    if existing.exec != cmd.exec or not set(cmd.valid_states) <= set(existing.valid_states):
+        raise RuntimeError(f"aioimaplib command {existing} is incompatible with {cmd}")
+
 
 def bytes_json_serializer(obj):
     if isinstance(obj, bytes):
         return obj.decode("utf-8")
 
-def email_parser(resp: Response):
-    str_parser = parser.BytesParser()
-    raw_email = str_parser.parsebytes(resp.lines[1])
-    return parse_email(raw_email.as_string())
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """带抖动的指数退避, 结果落在 [d/2, d] 内, d = min(cap, base * 2^attempt)"""
+    delay = min(cap, base * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _decode_raw(data: bytes, charset: str = "utf-8") -> str:
+    """解码头部字节, 兼容未按 RFC 2047 编码而直接使用 GBK 等编码的头部"""
+    try:
+        return data.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        pass
+    try:
+        return data.decode("gb18030")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+def _decode_word(encoding: str, text: str) -> bytes:
+    if encoding in "bB":
+        return base64.b64decode(text + "=" * (-len(text) % 4))
+    return binascii.a2b_qp(text.encode("ascii"), header=True)
+
+def decode_encoded_words(value: str) -> str:
+    """解码 RFC 2047 encoded-word; 相邻的 encoded-word 之间的空白被忽略,
+    同一字符集的相邻片段先拼接再解码, 以免被拆开的多字节字符乱码"""
+    if "=?" not in value:
+        return value
+    parts: list[str] = []
+    pending, pending_charset, pos = b"", "", 0
+    for match in _encoded_word_pattern.finditer(value):
+        gap = value[pos : match.start()]
+        charset, encoding, text = match.groups()
+        charset = charset.split("*", 1)[0].lower()
+        try:
+            codecs.lookup(charset)
+            data = _decode_word(encoding, text)
+        except (LookupError, binascii.Error, ValueError, UnicodeEncodeError):
+            # 无法解码的按原文保留
+            data = None
+        if pending and (data is None or gap.strip() or charset != pending_charset):
+            parts.append(_decode_raw(pending, pending_charset))
+            pending = b""
+            if data is None or gap.strip():
+                parts.append(gap)
+        elif not pending:
+            parts.append(gap)
+        if data is None:
+            parts.append(match.group(0))
+        else:
+            pending += data
+            pending_charset = charset
+        pos = match.end()
+    if pending:
+        parts.append(_decode_raw(pending, pending_charset))
+    parts.append(value[pos:])
+    return "".join(parts)
+
+def _canonical_header_name(name: str) -> str:
+    return _canonical_header_names.get(name.lower()) or "-".join(word.capitalize() for word in name.split("-"))
+
+def parse_headers(raw: bytes) -> ParsedHeaders:
+    """直接解析 FETCH 得到的头部字节: 展开折行、解码 encoded-word, 同名头部只保留第一个
+
+    只做一次遍历, 不构建完整的 Message 对象
+    """
+    headers: dict[str, str] = {}
+    name: bytes | None = None
+    value: list[bytes] = []
+
+    def store():
+        if name is None:
+            return
+        key = _canonical_header_name(_decode_raw(name).strip())
+        if key not in headers:
+            headers[key] = decode_encoded_words(_decode_raw(b"".join(value)).strip())
+
+    for line in raw.split(b"\n"):
+        line = line.rstrip(b"\r")
+        if not line:
+            if name is not None:
+                break
+            continue
+        if line[:1] in (b" ", b"\t"):
+            value.append(line)
+            continue
+        store()
+        name, sep, rest = line.partition(b":")
+        if not sep:
+            name = None
+            continue
+        value = [rest]
+    store()
+    return ParsedHeaders(headers.get("Date", ""), headers.get("Subject", ""), headers)
+
+def header_fetch_query(fields: Sequence[str] = FETCH_HEADER_FIELDS) -> str:
+    """构造批量获取新邮件时使用的 FETCH 数据项, `fields` 为空时获取完整头部
+
+    使用 BODY.PEEK 以免设置 \\Seen
+    """
+    section = f"HEADER.FIELDS ({' '.join(fields).upper()})" if fields else "HEADER"
+    return f"(UID FLAGS RFC822.SIZE BODYSTRUCTURE BODY.PEEK[{section}])"
+
+def parse_fetch_response(resp: Response) -> list[FetchedMail]:
+    """将一次 (UID) FETCH 的响应拆分为逐封邮件
+
+    aioimaplib 会把每个 `* n FETCH (...` 行、literal 数据(bytearray)和结尾的 `)` 分别放进 lines,
+    最后一行则是 tagged 响应的文本. 只有 BODY[...] 之后的 literal 是获取的内容 (头部或正文), 其余 literal
+    (如 BODYSTRUCTURE 中的非 ASCII 文件名) 放回 `{n}` 之后, 以便按原样解析
+    """
+    mails: list[FetchedMail] = []
+    seq: str | None = None
+    text = b""
+    literal = b""
+
+    def flush():
+        if seq is None:
+            return
+        uid = _fetch_uid_pattern.search(text)
+        if uid is None:
+            return
+        size = _fetch_size_pattern.search(text)
+        flags = _fetch_flags_pattern.search(text)
+        bodystructure = None
+        if (index := text.find(b"BODYSTRUCTURE (")) != -1:
+            try:
+                bodystructure = parse_bodystructure(text[index + len(b"BODYSTRUCTURE") :])
+            except (ValueError, IndexError):
+                bodystructure = None
+        mails.append(
+            FetchedMail(
+                seq=seq,
+                uid=int(uid.group(1)),
+                flags=flags.group(1).decode().split() if flags else [],
+                size=int(size.group(1)) if size else 0,
+                literal=literal,
+                bodystructure=bodystructure,
+            )
+        )
+
+    for line in resp.lines[:-1]:
+        if isinstance(line, bytearray):
+            if _section_literal_pattern.search(text):
+                literal = bytes(line)
+                text = text[: text.rfind(b"{")] + b"NIL"
+            else:
+                text += b"\r\n" + line
+            continue
+        if start := _fetch_start_pattern.match(line):
+            flush()
+            seq, text, literal = start.group(1).decode(), line, b""
+        else:
+            text += line
+    flush()
+    return mails
+
+def parse_search_response(resp: Response) -> list[int]:
+    """解析 (UID) SEARCH 的结果"""
+    return [
+        int(uid)
+        for line in resp.lines[:-1]
+        if isinstance(line, bytes)
+        for uid in line.split()
+        if uid.isdigit()
+    ]
+
+def format_uid_set(uids: list[int]) -> str:
+    """把升序的 UID 列表压缩成 sequence-set, 如 [1, 2, 3, 7] -> 1:3,7"""
+    ranges: list[str] = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = uid
+        prev = uid
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+def parse_status(line: bytes) -> tuple[str, dict[str, int]] | None:
+    """解析一行 STATUS 响应, 返回 (文件夹, {"UIDNEXT": n, ...})"""
+    match = _status_pattern.match(line)
+    if match is None:
+        return None
+    name = match.group(1)
+    if name.startswith(b'"'):
+        name = re.sub(rb"\\(.)", rb"\1", name[1:-1])
+    items = match.group(2).split()
+    return _decode_raw(name), {
+        key.decode().upper(): int(value) for key, value in zip(items[::2], items[1::2]) if value.isdigit()
+    }
+
+def parse_select_response(resp: Response) -> tuple[int | None, int | None]:
+    """从 SELECT/EXAMINE 响应中取出 (UIDVALIDITY, UIDNEXT)"""
+    uidvalidity = uidnext = None
+    for line in resp.lines:
+        if not isinstance(line, bytes):
+            continue
+        if match := _uidvalidity_pattern.search(line):
+            uidvalidity = int(match.group(1))
+        if match := _uidnext_pattern.search(line):
+            uidnext = int(match.group(1))
+    return uidvalidity, uidnext
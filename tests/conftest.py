@@ -17,6 +17,9 @@ def pytest_configure(config: pytest.Config) -> None:
         "smtp_host": "test.com",
         "imap_host": "test.com",
         "log_level": "TRACE",
+        "checkpoint_store": "memory",
+        "smtp_spool": "memory",
+        "part_cache_path": None,
     }
 
 
@@ -0,0 +1,568 @@
+"""本地的 IMAP/SMTP 假服务器, 供端到端测试和基准测试使用
+
+只实现适配器用到的命令: LOGIN, COMPRESS, SELECT/EXAMINE, STATUS, IDLE, (UID) FETCH, UID SEARCH (部分条件), NOOP, LOGOUT;
+命令中可以使用同步字面量;
+SMTP 则接收并记录所有邮件
+"""
+import re
+import ssl
+import time
+import zlib
+import base64
+import asyncio
+from pathlib import Path
+from typing import NamedTuple
+from email import message_from_bytes
+from email.header import decode_header, make_header
+from email.message import Message
+
+CERT_FILE = Path(__file__).parent / "data" / "localhost.pem"
+KEY_FILE = Path(__file__).parent / "data" / "localhost.key"
+
+_fetch_item_pattern = re.compile(r"(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|([A-Z0-9.]+)", re.IGNORECASE)
+_message_id_pattern = re.compile(rb"^Message-ID:\s*(\S+)", re.IGNORECASE | re.MULTILINE)
+_literal_pattern = re.compile(rb"\{(\d+)\}\r\n$")
+
+
+def server_ssl_context() -> ssl.SSLContext:
+    """使用 tests/data 中的自签名证书, 客户端需将 SSL_CERT_FILE 指向 `CERT_FILE`"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(CERT_FILE, KEY_FILE)
+    return context
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _split_header(raw: bytes) -> tuple[bytes, bytes]:
+    head, sep, body = raw.partition(b"\r\n\r\n")
+    return head + b"\r\n", body if sep else b""
+
+
+def _header_fields(raw: bytes, names: set[str]) -> bytes:
+    head, _ = _split_header(raw)
+    lines, keep = [], False
+    for line in head.split(b"\r\n"):
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.partition(b":")[0].strip().decode("latin-1").lower() in names
+        if keep:
+            lines.append(line)
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+def _payload(part: Message) -> bytes:
+    payload = part.get_payload()
+    if isinstance(payload, str):
+        return payload.encode("utf-8", "surrogateescape").replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+    return b""
+
+
+def _params(pairs: list[tuple[str, str]]) -> str:
+    return "(" + " ".join(f"{_quote(key.upper())} {_quote(value)}" for key, value in pairs) + ")" if pairs else "NIL"
+
+
+def _bodystructure(part: Message) -> str:
+    if part.is_multipart():
+        children = "".join(_bodystructure(child) for child in part.get_payload())  # type: ignore
+        boundary = part.get_boundary()
+        params = _params([("boundary", boundary)] if boundary else [])
+        return f"({children} {_quote(part.get_content_subtype().upper())} {params} NIL NIL)"
+    body = _payload(part)
+    params = _params([(key, value) for key, value in (part.get_params() or [])[1:]])
+    encoding = part.get("Content-Transfer-Encoding", "7BIT").upper()
+    fields = (
+        f"{_quote(part.get_content_maintype().upper())} {_quote(part.get_content_subtype().upper())} {params}"
+        f" NIL NIL {_quote(encoding)} {len(body)}"
+    )
+    if part.get_content_maintype() == "text":
+        fields += " " + str(body.count(b"\r\n"))
+    disposition = "NIL"
+    if part.get_content_disposition():
+        filename = part.get_param("filename", header="Content-Disposition")
+        disposition_params = _params([("filename", str(filename))] if filename else [])
+        disposition = f"({_quote(part.get_content_disposition().upper())} {disposition_params})"  # type: ignore
+    return f"({fields} NIL {disposition} NIL NIL)"
+
+
+def _section(message: Message, raw: bytes, section: str) -> bytes:
+    section = section.upper()
+    if section == "":
+        return raw
+    if section == "HEADER":
+        return _split_header(raw)[0] + b"\r\n"
+    if section.startswith("HEADER.FIELDS"):
+        names = set(section[section.index("(") + 1 : section.rindex(")")].lower().split())
+        return _header_fields(raw, names)
+    if section == "TEXT":
+        return _split_header(raw)[1]
+    part = message
+    for index in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]  # type: ignore
+        elif index != "1":
+            return b""
+    return _payload(part)
+
+
+class FakeMail:
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.raw = raw
+        self.flags: list[str] = []
+        self.message = message_from_bytes(raw)
+        self.bodystructure = _bodystructure(self.message)
+
+
+class FakeMailbox:
+    def __init__(self, uidvalidity: int):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.mails: list[FakeMail] = []
+
+
+class FakeIMAPServer:
+    """在本机监听的 IMAP 服务器, 邮件保存在内存中, `deliver` 后向正在 IDLE 的连接推送 EXISTS"""
+
+    def __init__(self, capabilities: tuple[str, ...] = ("IMAP4rev1", "IDLE", "UIDPLUS", "COMPRESS=DEFLATE")):
+        self.capabilities = capabilities
+        self.passwords: dict[str, str] = {}
+        self.mailboxes: dict[tuple[str, str], FakeMailbox] = {}
+        # Message-ID -> 投递时间, 用于统计邮件到处理器的延迟
+        self.delivered_at: dict[str, float] = {}
+        self.sessions: set["_IMAPSession"] = set()
+        self.logins = 0
+        self._server: asyncio.Server | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._uidvalidity = int(time.time())
+
+    def add_account(self, user: str, password: str, folders: tuple[str, ...] = ("INBOX",)) -> None:
+        self.passwords[user] = password
+        for folder in folders:
+            self.mailboxes.setdefault((user, folder), FakeMailbox(self._uidvalidity))
+
+    def deliver(self, user: str, raw: bytes, folder: str = "INBOX") -> int:
+        raw = re.sub(rb"\r?\n", b"\r\n", raw)
+        mailbox = self.mailboxes[(user, folder)]
+        mail = FakeMail(mailbox.uidnext, raw)
+        mailbox.uidnext += 1
+        mailbox.mails.append(mail)
+        if match := _message_id_pattern.search(raw):
+            self.delivered_at[match.group(1).decode()] = time.perf_counter()
+        for session in self.sessions:
+            if session.user == user and session.folder == folder:
+                session.notify(f"* {len(mailbox.mails)} EXISTS")
+        return mail.uid
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, ssl_context: ssl.SSLContext | None = None) -> int:
+        self._server = await asyncio.start_server(self._accept, host, port, ssl=ssl_context)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = _IMAPSession(self, reader, writer)
+        self.sessions.add(session)
+        self._tasks.add(task := asyncio.current_task())  # type: ignore
+        try:
+            await session.run()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            self._tasks.discard(task)
+            writer.close()
+
+
+class _IMAPSession:
+    def __init__(self, server: FakeIMAPServer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.user: str | None = None
+        self.folder: str | None = None
+        self.idling = False
+        # 非 IDLE 时产生的 EXISTS 在下一个命令完成前发送
+        self.pending: list[str] = []
+        # COMPRESS=DEFLATE 之后的压缩器, 以及把解压后的数据送入 reader 的任务
+        self.deflate = None
+        self._inflate_task: asyncio.Task | None = None
+
+    def write(self, *lines: str | bytes) -> None:
+        data = b"".join(line if isinstance(line, bytes) else line.encode() + b"\r\n" for line in lines)
+        if self.deflate is not None:
+            data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(data)
+
+    def compress(self) -> None:
+        raw, self.reader = self.reader, asyncio.StreamReader()
+        inflate = zlib.decompressobj(-15)
+
+        async def pump():
+            while data := await raw.read(65536):
+                self.reader.feed_data(inflate.decompress(data))
+            self.reader.feed_eof()
+
+        self.deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._inflate_task = asyncio.create_task(pump())
+
+    def notify(self, line: str) -> None:
+        if self.idling:
+            self.write(line)
+        else:
+            self.pending.append(line)
+
+    def complete(self, tag: str, text: str, result: str = "OK") -> None:
+        self.write(*self.pending, f"{tag} {result} {text}")
+        self.pending.clear()
+
+    @property
+    def mailbox(self) -> FakeMailbox:
+        return self.server.mailboxes[(self.user, self.folder)]  # type: ignore
+
+    async def run(self) -> None:
+        try:
+            await self._run()
+        finally:
+            if self._inflate_task is not None:
+                self._inflate_task.cancel()
+
+    async def _run(self) -> None:
+        self.write(f"* OK [CAPABILITY {' '.join(self.server.capabilities)}] fake IMAP ready")
+        while True:
+            line, eight_bit = await self._read_command()
+            if not line:
+                if self.reader.at_eof():
+                    return
+                continue
+            tag, _, rest = line.partition(" ")
+            command, _, args = rest.partition(" ")
+            if eight_bit:
+                # 与严格的服务器一样, 字面量之外的 8 位数据回复 BAD
+                self.complete(tag, "8-bit data must be sent as literal", "BAD")
+                await self.writer.drain()
+                continue
+            if not await self.handle(tag, command.upper(), args):
+                await self.writer.drain()
+                return
+            await self.writer.drain()
+
+    async def _read_command(self) -> tuple[str, bool]:
+        """读取一条命令, 同步字面量 ({n}) 回复 "+" 后读取并转为带引号的字符串; 同时返回字面量之外有无 8 位数据"""
+        line = await self.reader.readline()
+        command, eight_bit = "", False
+        while match := _literal_pattern.search(line):
+            self.write("+ Ready for literal data")
+            await self.writer.drain()
+            literal = (await self.reader.readexactly(int(match.group(1)))).decode()
+            escaped = literal.replace("\\", "\\\\").replace('"', '\\"')
+            eight_bit |= not line[: match.start()].isascii()
+            command += line[: match.start()].decode() + f'"{escaped}"'
+            line = await self.reader.readline()
+        eight_bit |= not line.isascii()
+        return command + line.decode().rstrip("\r\n"), eight_bit
+
+    async def handle(self, tag: str, command: str, args: str) -> bool:
+        match command:
+            case "CAPABILITY":
+                self.write(f"* CAPABILITY {' '.join(self.server.capabilities)}")
+                self.complete(tag, "CAPABILITY completed")
+            case "ID" | "NOOP" | "CHECK":
+                self.complete(tag, f"{command} completed")
+            case "LOGIN":
+                user, password = (_unquote(arg) for arg in _split_args(args)[:2])
+                if self.server.passwords.get(user) != password:
+                    self.complete(tag, "LOGIN failed", "NO")
+                else:
+                    self.user = user
+                    self.server.logins += 1
+                    self.complete(tag, f"[CAPABILITY {' '.join(self.server.capabilities)}] LOGIN completed")
+            case "COMPRESS":
+                if args.upper() != "DEFLATE" or "COMPRESS=DEFLATE" not in self.server.capabilities:
+                    self.complete(tag, "COMPRESS not supported", "BAD")
+                elif self.deflate is not None:
+                    self.complete(tag, "[COMPRESSIONACTIVE] already compressing", "NO")
+                else:
+                    self.complete(tag, "DEFLATE active")
+                    await self.writer.drain()
+                    self.compress()
+            case "LOGOUT":
+                self.write("* BYE fake IMAP logging out")
+                self.complete(tag, "LOGOUT completed")
+                return False
+            case "SELECT" | "EXAMINE":
+                folder = _unquote(args)
+                if (self.user, folder) not in self.server.mailboxes:
+                    self.complete(tag, f"{command} failed", "NO")
+                    return True
+                self.folder = folder
+                mailbox = self.mailbox
+                self.write(
+                    "* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)",
+                    f"* {len(mailbox.mails)} EXISTS",
+                    "* 0 RECENT",
+                    f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid",
+                    f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID",
+                )
+                self.complete(tag, f"[READ-WRITE] {command} completed")
+            case "STATUS":
+                name = _split_args(args)[0]
+                mailbox = self.server.mailboxes.get((self.user, _unquote(name)))  # type: ignore
+                if mailbox is None:
+                    self.complete(tag, "STATUS failed", "NO")
+                    return True
+                self.write(
+                    f"* STATUS {name} (MESSAGES {len(mailbox.mails)} UIDNEXT {mailbox.uidnext}"
+                    f" UIDVALIDITY {mailbox.uidvalidity})"
+                )
+                self.complete(tag, "STATUS completed")
+            case "IDLE":
+                self.idling = True
+                self.write(*self.pending, "+ idling")
+                self.pending.clear()
+                await self.writer.drain()
+                while (await self.reader.readline()).strip().upper() != b"DONE":
+                    if self.reader.at_eof():
+                        return False
+                self.idling = False
+                self.complete(tag, "IDLE terminated")
+            case "FETCH":
+                message_set, _, items = args.partition(" ")
+                self.fetch(tag, message_set, items, by_uid=False)
+            case "UID":
+                sub, _, rest = args.partition(" ")
+                match sub.upper():
+                    case "FETCH":
+                        message_set, _, items = rest.partition(" ")
+                        self.fetch(tag, message_set, items, by_uid=True)
+                    case "SEARCH":
+                        self.search(tag, rest)
+                    case _:
+                        self.complete(tag, f"UID {sub} not supported", "BAD")
+            case _:
+                self.complete(tag, f"{command} not supported", "BAD")
+        return True
+
+    def _resolve(self, message_set: str, by_uid: bool) -> list[tuple[int, FakeMail]]:
+        mails = self.mailbox.mails
+        if not mails:
+            return []
+        largest = mails[-1].uid if by_uid else len(mails)
+        wanted: set[int] = set()
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            low = largest if start == "*" else int(start)
+            high = low if not end else largest if end == "*" else int(end)
+            low, high = min(low, high), max(low, high)
+            wanted.update(range(low, high + 1))
+        return [
+            (seq, mail) for seq, mail in enumerate(mails, 1) if (mail.uid if by_uid else seq) in wanted
+        ]
+
+    def fetch(self, tag: str, message_set: str, items: str, by_uid: bool) -> None:
+        requested = _fetch_item_pattern.findall(items.strip().strip("()"))
+        for seq, mail in self._resolve(message_set, by_uid):
+            texts: list[str] = [f"UID {mail.uid}"] if by_uid else []
+            literals: list[tuple[str, bytes]] = []
+            for body, section, offset, length, name in requested:
+                if body:
+                    data = _section(mail.message, mail.raw, section)
+                    label = f"BODY[{section.upper()}]"
+                    if offset:
+                        data = data[int(offset) : int(offset) + int(length)]
+                        label += f"<{offset}>"
+                    literals.append((label, data))
+                    continue
+                match name.upper():
+                    case "UID":
+                        if not by_uid:
+                            texts.append(f"UID {mail.uid}")
+                    case "FLAGS":
+                        texts.append(f"FLAGS ({' '.join(mail.flags)})")
+                    case "RFC822.SIZE":
+                        texts.append(f"RFC822.SIZE {len(mail.raw)}")
+                    case "BODYSTRUCTURE":
+                        texts.append(f"BODYSTRUCTURE {mail.bodystructure}")
+                    case "RFC822":
+                        literals.append(("RFC822", mail.raw))
+            head = f"* {seq} FETCH ({' '.join(texts)}"
+            if not literals:
+                self.write(head + ")")
+                continue
+            for index, (label, data) in enumerate(literals):
+                prefix = head + " " if index == 0 else " "
+                self.write(f"{prefix}{label} {{{len(data)}}}".encode() + b"\r\n" + data)
+            self.write(")")
+        self.complete(tag, "FETCH completed")
+
+    def search(self, tag: str, criteria: str) -> None:
+        tokens = _split_args(criteria)
+        if tokens and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        keys = []
+        try:
+            while tokens:
+                keys.append(self._search_key(tokens))
+        except (IndexError, ValueError):
+            self.complete(tag, "invalid search criteria", "BAD")
+            return
+        uids = [mail.uid for mail in self.mailbox.mails if all(key(mail) for key in keys)]
+        self.write("* SEARCH" + "".join(f" {uid}" for uid in uids))
+        self.complete(tag, "SEARCH completed")
+
+    def _search_key(self, tokens: list[str]):
+        """只支持 ALL, UID, NOT, OR, FROM/TO/SUBJECT, HEADER, LARGER"""
+        name = tokens.pop(0).upper()
+        match name:
+            case "ALL":
+                return lambda mail: True
+            case "UID":
+                uids = {mail.uid for _, mail in self._resolve(tokens.pop(0), by_uid=True)}
+                return lambda mail: mail.uid in uids
+            case "NOT":
+                key = self._search_key(tokens)
+                return lambda mail: not key(mail)
+            case "OR":
+                left, right = self._search_key(tokens), self._search_key(tokens)
+                return lambda mail: left(mail) or right(mail)
+            case "FROM" | "TO" | "SUBJECT":
+                value = _unquote(tokens.pop(0)).lower()
+                return lambda mail: value in _header(mail.message, name).lower()
+            case "HEADER":
+                field, value = _unquote(tokens.pop(0)), _unquote(tokens.pop(0)).lower()
+                return lambda mail: value in _header(mail.message, field).lower()
+            case "LARGER":
+                size = int(tokens.pop(0))
+                return lambda mail: len(mail.raw) > size
+        raise ValueError(name)
+
+
+def _header(message: Message, name: str) -> str:
+    return str(make_header(decode_header(message.get(name, ""))))
+
+
+def _split_args(args: str) -> list[str]:
+    return re.findall(r'"(?:[^"\\]|\\.)*"|\S+', args)
+
+
+def _unquote(arg: str) -> str:
+    if arg.startswith('"') and arg.endswith('"'):
+        return re.sub(r"\\(.)", r"\1", arg[1:-1])
+    return arg
+
+
+class ReceivedMail(NamedTuple):
+    sender: str
+    recipients: list[str]
+    data: bytes
+    received_at: float
+
+
+class FakeSMTPServer:
+    """接收并记录所有邮件的 SMTP 服务器, 支持 PIPELINING 和 AUTH PLAIN
+
+    `refuse` 中的收件人会被拒收, `throttle` 中的收件人按剩余次数返回 450 临时错误
+    """
+
+    def __init__(self, extensions: tuple[str, ...] = ("PIPELINING", "8BITMIME", "AUTH PLAIN")):
+        self.extensions = extensions
+        self.refuse: set[str] = set()
+        self.throttle: dict[str, int] = {}
+        self.messages: list[ReceivedMail] = []
+        self.connections = 0
+        self._server: asyncio.Server | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._accept, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        self._tasks.add(task := asyncio.current_task())  # type: ignore
+        try:
+            await self._session(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        def reply(*lines: str) -> None:
+            for line in lines:
+                writer.write(line.encode() + b"\r\n")
+
+        reply("220 fake ESMTP ready")
+        sender, recipients = "", []
+        while line := await reader.readline():
+            command, _, arg = line.decode().rstrip("\r\n").partition(" ")
+            match command.upper():
+                case "EHLO":
+                    reply("250-fake", *(f"250-{extension}" for extension in self.extensions[:-1]))
+                    reply(f"250 {self.extensions[-1]}" if self.extensions else "250 fake")
+                case "HELO":
+                    reply("250 fake")
+                case "AUTH":
+                    mechanism, _, initial = arg.partition(" ")
+                    if not initial:
+                        reply("334 ")
+                        await writer.drain()
+                        initial = (await reader.readline()).decode().strip()
+                    base64.b64decode(initial)
+                    reply("235 Authentication successful")
+                case "MAIL":
+                    sender, recipients = _smtp_address(arg), []
+                    reply("250 OK")
+                case "RCPT":
+                    recipient = _smtp_address(arg)
+                    if recipient in self.refuse:
+                        reply("550 No such user")
+                    elif self.throttle.get(recipient):
+                        self.throttle[recipient] -= 1
+                        reply("450 Rate limited, try again later")
+                    else:
+                        recipients.append(recipient)
+                        reply("250 OK")
+                case "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    lines = []
+                    while (data := await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        lines.append(data[1:] if data.startswith(b"..") else data)
+                    self.messages.append(ReceivedMail(sender, recipients, b"".join(lines), time.perf_counter()))
+                    reply("250 OK queued")
+                case "RSET":
+                    sender, recipients = "", []
+                    reply("250 OK")
+                case "NOOP":
+                    reply("250 OK")
+                case "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    return
+                case _:
+                    reply("502 Command not implemented")
+            await writer.drain()
+
+
+def _smtp_address(arg: str) -> str:
+    start, end = arg.find("<"), arg.find(">")
+    return arg[start + 1 : end] if start != -1 and end != -1 else arg.partition(":")[2].strip()
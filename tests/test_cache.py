@@ -0,0 +1,65 @@
+def test_part_cache(tmp_path):
+    from nonebot.adapters.email.cache import PartCache  # type: ignore
+
+    cache = PartCache(max_memory=10, directory=tmp_path, max_disk=100, spill_size=8)
+    key = ("bot@example.com", "INBOX", 1, 1)
+    cache.put((*key, "1"), b"aaaa")
+    cache.put((*key, "2"), b"bbbbbbb")
+    # 内存超出上限, 最早的内容落盘
+    assert cache.memory_size == 7
+    assert cache.disk_size == 4
+    assert cache.get((*key, "1")) == b"aaaa"
+    # 较大的内容直接落盘, 按块读取
+    cache.put((*key, "3"), b"c" * 20)
+    assert cache.memory_size == 7
+    assert cache.disk_size == 24
+    assert list(cache.iter_chunks((*key, "3"), 8)) == [b"c" * 8, b"c" * 8, b"c" * 4]
+    # 相同内容只保存一份
+    cache.put(("other@example.com", "INBOX", 1, 5, "3"), b"c" * 20)
+    assert cache.disk_size == 24
+    assert cache.get(("bot@example.com", "INBOX", 2, 1, "1")) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    writer = cache.spill_writer((*key, "4"), 90)
+    assert writer is not None
+    writer.write(b"d" * 50)
+    writer.write(b"d" * 40)
+    writer.commit()
+    assert cache.get((*key, "4")) == b"d" * 90
+    # 磁盘超出上限, 淘汰最久未使用的内容
+    assert cache.disk_size == 90
+    assert (*key, "3") not in cache
+    assert cache.spill_writer((*key, "5"), 200) is None
+
+    directory = cache.directory
+    cache.close()
+    assert directory is not None
+    assert not directory.exists()
+
+
+def test_memory_only_part_cache():
+    from nonebot.adapters.email.cache import PartCache  # type: ignore
+
+    cache = PartCache(max_memory=10, directory=None, max_disk=100, spill_size=8)
+    cache.put(("bot@example.com", "INBOX", 1, 1, "1"), b"a" * 20)
+    assert ("bot@example.com", "INBOX", 1, 1, "1") not in cache
+    assert cache.spill_writer(("bot@example.com", "INBOX", 1, 1, "1")) is None
+
+
+def test_part_cache_evict_while_streaming(tmp_path):
+    from nonebot.adapters.email.cache import PartCache  # type: ignore
+
+    cache = PartCache(max_memory=0, directory=tmp_path, max_disk=30, spill_size=0)
+    cache.put(("bot@example.com", "INBOX", 1, 1, "1"), b"a" * 20)
+    chunks = cache.iter_chunks(("bot@example.com", "INBOX", 1, 1, "1"), 8)
+    assert chunks is not None
+    assert next(chunks) == b"a" * 8
+    # 读取期间被淘汰, 文件在读完后才关闭
+    cache.put(("bot@example.com", "INBOX", 1, 2, "1"), b"b" * 20)
+    assert ("bot@example.com", "INBOX", 1, 1, "1") not in cache
+    assert b"".join(chunks) == b"a" * 12
+    # 相同内容再次落盘不会覆盖其他文件
+    cache.put(("bot@example.com", "INBOX", 1, 1, "1"), b"a" * 20)
+    assert cache.get(("bot@example.com", "INBOX", 1, 1, "1")) == b"a" * 20
+    assert len(list(cache.directory.iterdir())) == 1
+    cache.close()
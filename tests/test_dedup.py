@@ -0,0 +1,10 @@
+def test_lru_dedup_cache():
+    from nonebot.adapters.email.dedup import LRUDedupCache  # type: ignore
+
+    cache = LRUDedupCache(max_size=2)
+    assert not cache.seen([("a", 1), ("message-id", "<x@y>")])
+    # 另一个账号收到同一封邮件
+    assert cache.seen([("b", 7), ("message-id", "<x@y>")])
+    assert cache.seen([("b", 7)])
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert len(cache) == 2
@@ -0,0 +1,356 @@
+import time
+import asyncio
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+import pytest
+import pytest_asyncio
+import nonebot
+from fake_server import CERT_FILE, FakeIMAPServer, FakeSMTPServer, server_ssl_context
+
+
+def make_mail(index: int, to: str) -> bytes:
+    mail = EmailMessage()
+    mail["From"] = "Sender <sender@example.com>"
+    mail["To"] = to
+    mail["Subject"] = f"测试邮件 {index}"
+    mail["Date"] = "Fri, 25 Aug 2023 02:53:48 +0000"
+    mail["Message-ID"] = f"<{index}@example.com>"
+    mail.set_content(f"hello {index}")
+    return bytes(mail)
+
+
+async def wait_until(predicate, timeout: float = 5):
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+@pytest_asyncio.fixture
+async def servers(monkeypatch: pytest.MonkeyPatch):
+    imap, smtp = FakeIMAPServer(), FakeSMTPServer()
+    imap.add_account("test@test.com", "test")
+    imap_port = await imap.start(ssl_context=server_ssl_context())
+    smtp_port = await smtp.start()
+    monkeypatch.setenv("SSL_CERT_FILE", str(CERT_FILE))
+
+    driver = nonebot.get_driver()
+    monkeypatch.setattr(driver.config, "imap_host", "127.0.0.1")
+    monkeypatch.setattr(driver.config, "imap_port", imap_port, raising=False)
+    monkeypatch.setattr(driver.config, "smtp_host", "127.0.0.1")
+    monkeypatch.setattr(driver.config, "smtp_port", smtp_port, raising=False)
+    monkeypatch.setattr(driver.config, "smtp_use_tls", False, raising=False)
+    try:
+        yield imap, smtp
+    finally:
+        await imap.close()
+        await smtp.close()
+
+
+@pytest.fixture
+def received(monkeypatch: pytest.MonkeyPatch):
+    from nonebot.adapters.email import Bot  # type: ignore
+
+    events = []
+
+    async def handle_event(self, event):
+        events.append(event)
+
+    monkeypatch.setattr(Bot, "handle_event", handle_event)
+    return events
+
+
+@pytest_asyncio.fixture
+async def email_adapter(servers, monkeypatch: pytest.MonkeyPatch, tmp_path):
+    from nonebot.adapters.email import Adapter  # type: ignore
+
+    imap, _ = servers
+    driver = nonebot.get_driver()
+    monkeypatch.setattr(driver.config, "smtp_retry_base_delay", 0.1, raising=False)
+    monkeypatch.setattr(driver.config, "part_cache_path", tmp_path, raising=False)
+    adapter = Adapter(driver)
+    await adapter.startup()
+    try:
+        await wait_until(lambda: any(session.idling for session in imap.sessions))
+        yield adapter
+    finally:
+        await adapter.shutdown()
+
+
+async def receive(imap: FakeIMAPServer, received: list, *indexes: int) -> list:
+    """投递后等待所有事件到达, 同步投递的邮件在同一次唤醒中获取"""
+    count = len(received) + len(indexes)
+    for index in indexes:
+        imap.deliver("test@test.com", make_mail(index, "test@test.com"))
+    await wait_until(lambda: len(received) == count)
+    return received[-len(indexes) :]
+
+
+def reply_to(event):
+    from nonebot.adapters.email import Message  # type: ignore
+
+    message = Message()
+    message.to(event.sender.addr)
+    message.subject(f"Re: {event.subject}")
+    message.set_content("pong")
+    return message
+
+
+@pytest.mark.asyncio
+async def test_receive(servers, received, email_adapter):
+    imap, _ = servers
+    events = await receive(imap, received, 1, 2)
+
+    event = events[0]
+    assert [event.subject for event in events] == ["测试邮件 1", "测试邮件 2"]
+    assert event.folder == "INBOX"
+    assert event.sender.addr == "sender@example.com"
+    assert (await event.get_body_text()).strip() == "hello 1"
+    assert "MIME-Version" not in event.headers
+    assert (await event.get_full_headers())["MIME-Version"] == "1.0"
+    assert all(session.deflate is not None for session in imap.sessions)
+
+
+@pytest.mark.asyncio
+async def test_part_cache(servers, received, email_adapter):
+    imap, _ = servers
+    events = await receive(imap, received, 1, 2)
+
+    await events[0].get_body_text()
+    # 其他处理器再次获取时使用本地缓存
+    assert (await events[0].fetch_part("1")).strip() == b"hello 1"
+    assert email_adapter.part_cache.hits == 1
+    # 流式获取的内容写入磁盘, 再次获取时从 mmap 读取
+    assert b"".join([chunk async for chunk in events[1].stream_part("1", 4)]).strip() == b"hello 2"
+    assert b"".join([chunk async for chunk in events[1].stream_part("1", 4)]).strip() == b"hello 2"
+    assert email_adapter.part_cache.hits == 2
+    assert email_adapter.part_cache.disk_size > 0
+
+
+@pytest.mark.asyncio
+async def test_spool_reply(servers, received, email_adapter):
+    imap, smtp = servers
+    (event,) = await receive(imap, received, 1)
+
+    # 发件队列: 入队即返回, 临时错误退避后重试
+    smtp.throttle["sender@example.com"] = 1
+    assert isinstance(await email_adapter.bots["test@test.com"].send(event, reply_to(event)), int)
+    await wait_until(lambda: len(smtp.messages) == 1)
+    assert [mail.recipients for mail in smtp.messages] == [["sender@example.com"]]
+    assert email_adapter.spool.retries == 1
+    reply = message_from_bytes(smtp.messages[0].data, policy=policy.default)
+    assert reply["In-Reply-To"] == reply["References"] == "<1@example.com>"
+
+
+@pytest.mark.asyncio
+async def test_thread(servers, received, email_adapter):
+    imap, smtp = servers
+    event, other = await receive(imap, received, 1, 2)
+    await email_adapter.bots["test@test.com"].send(event, reply_to(event))
+    await wait_until(lambda: len(smtp.messages) == 1)
+    reply = message_from_bytes(smtp.messages[0].data, policy=policy.default)
+
+    # 对方只写了 In-Reply-To 的回复也归入原来的会话
+    answer = EmailMessage()
+    answer["From"] = "Sender <sender@example.com>"
+    answer["To"] = "test@test.com"
+    answer["Subject"] = "Re: Re: 测试邮件 1"
+    answer["Message-ID"] = "<3@example.com>"
+    answer["In-Reply-To"] = reply["Message-ID"]
+    answer.set_content("ping")
+    imap.deliver("test@test.com", bytes(answer))
+    await wait_until(lambda: len(received) == 3)
+    assert received[2].get_session_id() == event.get_session_id() == "<1@example.com>"
+    assert other.get_session_id() == "<2@example.com>"
+
+
+@pytest.mark.asyncio
+async def test_template(servers, received, email_adapter):
+    from nonebot.adapters.email import MessageTemplate  # type: ignore
+
+    imap, smtp = servers
+    (event,) = await receive(imap, received, 1)
+    bot = email_adapter.bots["test@test.com"]
+
+    template = MessageTemplate(reply_to(event))
+    await bot.send(event, template.render(to="other@example.com", subject="模板"))
+    await wait_until(lambda: len(smtp.messages) == 1)
+    assert smtp.messages[-1].recipients == ["other@example.com"]
+    assert message_from_bytes(smtp.messages[-1].data, policy=policy.default)["Subject"] == "模板"
+    with pytest.raises(ValueError, match="mail_options"):
+        await bot.send(event, reply_to(event), mail_options=["SMTPUTF8"])
+
+
+@pytest.mark.asyncio
+async def test_send_many(email_adapter):
+    from nonebot.adapters.email import Message, MessageTemplate  # type: ignore
+    from nonebot.adapters.email.spool import TokenBucket  # type: ignore
+
+    message = Message()
+    message.set_content("pong")
+    template = MessageTemplate(message)
+    # 批量发送与发件队列共用限速
+    email_adapter.rate_buckets["127.0.0.1"] = TokenBucket(20, 1)
+    start = time.monotonic()
+    bot = email_adapter.bots["test@test.com"]
+    results = await bot.send_many([template.render(to=f"{i}@example.com", subject="批量") for i in range(3)])
+    assert all(result.ok for result in results)
+    assert time.monotonic() - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_compress_after_select(servers, received, monkeypatch: pytest.MonkeyPatch):
+    from nonemail import EmailClient
+    from nonebot.adapters.email import Adapter, adapter  # type: ignore
+
+    class SelectingClient(EmailClient):
+        """与部分 EmailClient 实现一样, 登录后立即 SELECT, COMPRESS 在 SELECTED 状态下协商"""
+
+        async def __aenter__(self):
+            await super().__aenter__()
+            await self.impl.select("INBOX")
+            return self
+
+    imap, _ = servers
+    monkeypatch.setattr(adapter, "EmailClient", SelectingClient)
+    adapter_ = Adapter(nonebot.get_driver())
+    await adapter_.startup()
+    try:
+        await wait_until(lambda: any(session.idling for session in imap.sessions))
+        assert imap.logins == 1
+        assert all(session.deflate is not None for session in imap.sessions)
+        imap.deliver("test@test.com", make_mail(1, "test@test.com"))
+        await wait_until(lambda: len(received) == 1)
+    finally:
+        await adapter_.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_prefilter(servers, received, monkeypatch: pytest.MonkeyPatch):
+    from nonebot.adapters.email import Adapter  # type: ignore
+
+    imap, _ = servers
+    driver = nonebot.get_driver()
+    # 非 ASCII 的条件以同步字面量发送, 假服务器与严格的服务器一样拒绝字面量之外的 8 位数据
+    prefilter = {"subjects": ["测试邮件 1", "测试邮件 3", "测试邮件 2"], "exclude_subjects": ["2"]}
+    monkeypatch.setattr(driver.config, "imap_prefilter", prefilter, raising=False)
+    adapter = Adapter(driver)
+    await adapter.startup()
+    try:
+        await wait_until(lambda: any(session.idling for session in imap.sessions))
+        for index in (1, 2, 3):
+            imap.deliver("test@test.com", make_mail(index, "test@test.com"))
+        await wait_until(lambda: len(received) == 2)
+
+        assert [event.uid for event in received] == [1, 3]
+        assert adapter.mailbox_states[("test@test.com", "INBOX")].last_uid == 3
+        assert adapter.metrics.prefilter_skipped.value(account="test@test.com", folder="INBOX") == 1
+    finally:
+        await adapter.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_fetch_batch(servers, received, monkeypatch: pytest.MonkeyPatch):
+    from fake_server import _IMAPSession
+    from nonebot.adapters.email import Adapter  # type: ignore
+
+    imap, _ = servers
+    driver = nonebot.get_driver()
+    monkeypatch.setattr(driver.config, "imap_fetch_batch", 2, raising=False)
+    fetched: list[int] = []
+    fetch = _IMAPSession.fetch
+
+    def record(self, tag: str, message_set: str, items: str, by_uid: bool) -> None:
+        if "HEADER.FIELDS" in items.upper():
+            fetched.append(len(self._resolve(message_set, by_uid)))
+        fetch(self, tag, message_set, items, by_uid)
+
+    monkeypatch.setattr(_IMAPSession, "fetch", record)
+    adapter = Adapter(driver)
+    await adapter.startup()
+    try:
+        await wait_until(lambda: any(session.idling for session in imap.sessions))
+        for index in range(1, 6):
+            imap.deliver("test@test.com", make_mail(index, "test@test.com"))
+        await wait_until(lambda: len(received) == 5)
+
+        assert [event.uid for event in received] == [1, 2, 3, 4, 5]
+        assert fetched
+        assert max(fetched) <= 2
+        assert adapter.mailbox_states[("test@test.com", "INBOX")].last_uid == 5
+    finally:
+        await adapter.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_shard(servers, received, monkeypatch: pytest.MonkeyPatch, tmp_path):
+    from nonebot.adapters.email import Adapter  # type: ignore
+
+    imap, _ = servers
+    imap.add_account("other@test.com", "test")
+    users = ["test@test.com", "other@test.com"]
+    driver = nonebot.get_driver()
+    monkeypatch.setattr(driver.config, "email_accounts", [{"user": users[1], "password": "test"}], raising=False)
+    monkeypatch.setattr(driver.config, "shard_lease_path", tmp_path / "lease.db", raising=False)
+    monkeypatch.setattr(driver.config, "shard_lease_ttl", 1, raising=False)
+    # 接手的 worker 从共用的断点继续
+    monkeypatch.setattr(driver.config, "checkpoint_store", "sqlite", raising=False)
+    monkeypatch.setattr(driver.config, "checkpoint_path", tmp_path / "checkpoint.db", raising=False)
+    workers = []
+    for worker in ("w1", "w2"):
+        monkeypatch.setattr(driver.config, "shard_worker_id", worker, raising=False)
+        workers.append(Adapter(driver))
+
+    def balanced():
+        idling = all(any(session.idling and session.user == user for session in imap.sessions) for user in users)
+        return idling and len(imap.sessions) == 2 and sum(len(adapter.shard.owned) for adapter in workers) == 2
+
+    for adapter in workers:
+        await adapter.startup()
+    try:
+        # 每个账号只有一个 worker 监听
+        await wait_until(balanced)
+        owned = [set(adapter.shard.owned) for adapter in workers]
+        assert sorted([*owned[0], *owned[1]]) == sorted(users)
+        for index, user in enumerate(users):
+            imap.deliver(user, make_mail(index, user))
+        await wait_until(lambda: len(received) == 2)
+        assert sorted(event.self_id for event in received) == sorted(users)
+
+        # 一个 worker 退出后, 另一个接手它的账号, 并补发无人监听期间到达的邮件
+        stopped = workers[0] if owned[0] else workers[1]
+        await stopped.shutdown()
+        workers.remove(stopped)
+        for index, user in enumerate(users, start=2):
+            imap.deliver(user, make_mail(index, user))
+        await wait_until(lambda: len(received) == 4)
+        await asyncio.sleep(0.1)
+        assert workers[0].shard.owned == set(users)
+        assert sorted(event.message_id for event in received) == [f"<{index}@example.com>" for index in range(4)]
+    finally:
+        for adapter in workers:
+            await adapter.shutdown()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extensions", [("PIPELINING", "AUTH PLAIN"), ("AUTH PLAIN",)])
+async def test_smtp_pipelining(extensions):
+    from nonebot.adapters.email.smtp import PoolKey, PooledSMTP, PipeliningSMTPProtocol  # type: ignore
+
+    smtp = FakeSMTPServer(extensions)
+    smtp.refuse.add("c@example.com")
+    port = await smtp.start()
+    conn = PooledSMTP(PoolKey("127.0.0.1", port, "bot@test.com"), "test", False)
+    try:
+        await conn.connect()
+        assert isinstance(conn.client.protocol, PipeliningSMTPProtocol)
+        recipients = [f"{name}@example.com" for name in "abcd"]
+        for _ in range(2):
+            _, refused = await conn.send_raw("bot@test.com", recipients, b"Subject: test\r\n\r\nhi\r\n")
+            assert list(refused) == ["c@example.com"]
+        assert [mail.recipients for mail in smtp.messages] == [["a@example.com", "b@example.com", "d@example.com"]] * 2
+    finally:
+        await conn.close()
+        await smtp.close()
@@ -20,3 +20,41 @@ def test_event_str():
 
     log("INFO", f"event: \n{escape_tag(str(event))}")
 
+
+def test_event_addresses():
+    from nonebot.adapters.email.event import Event, Emailer # type: ignore
+
+    event = Event.parse_obj({
+        "self_id": "email@none.bot",
+        "date": "Fri, 25 Aug 2023 02:53:48 +0000",
+        "subject": "测试邮件8",
+        "mail_id": "3125",
+        "mime_types": [],
+        "headers": {
+            "To": '"bot, mail" <Email@None.Bot>, plain@test.adp',
+            "From": "YAMB <mail@test.adp>",
+        }
+    })
+
+    assert event.sender == Emailer("YAMB", "mail@test.adp")
+    assert event.recipients == [Emailer("bot, mail", "Email@None.Bot"), Emailer("", "plain@test.adp")]
+    assert event.cc == []
+    assert event.is_tome()
+    assert not event.is_ccme()
+    assert event.get_session_id() == "mail@test.adp"
+
+
+def test_log_event():
+    from nonebot.adapters.email import Adapter  # type: ignore
+    from nonebot.adapters.email.event import Event  # type: ignore
+
+    event = Event.parse_obj({
+        "self_id": "email@none.bot",
+        "date": "Fri, 25 Aug 2023 02:53:48 +0000",
+        "subject": "测试邮件9",
+        "mail_id": "3126",
+        "mime_types": [],
+        "headers": {"From": "YAMB <mail@test.adp>"},
+    })
+    # 分发时以 DEBUG 级别输出整个事件, 不能抛出异常
+    Adapter._log_event(event)
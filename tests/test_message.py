@@ -0,0 +1,30 @@
+from email import message_from_bytes, policy
+
+
+def test_message_template():
+    from nonebot.adapters.email import Message, MessageTemplate  # type: ignore
+
+    message = Message()
+    message.from_("Bot <bot@example.com>")
+    message.subject("自动回复")
+    message.set_content("已收到")
+    message.email.add_attachment(b"data", maintype="application", subtype="octet-stream", filename="a.bin")
+    template = MessageTemplate(message, dynamic=("Subject", "In-Reply-To"))
+
+    first = template.render(to="a@example.com", in_reply_to="<1@example.com>")
+    second = template.render(to=["b@example.com", "not an address"], bcc="c@example.com")
+    assert template.compile() is template.compile()
+
+    mail = message_from_bytes(first.email.flatten(), policy=policy.default)
+    assert mail["From"] == "Bot <bot@example.com>"
+    assert mail["To"] == "a@example.com"
+    assert mail["Subject"] == "自动回复"
+    assert mail["In-Reply-To"] == "<1@example.com>"
+    assert mail.get_body().get_content().strip() == "已收到"
+    assert [part.get_filename() for part in mail.iter_attachments()] == ["a.bin"]
+
+    mail = message_from_bytes(second.email.flatten(), policy=policy.default)
+    assert mail["To"] == "b@example.com"
+    assert mail["In-Reply-To"] is None
+    assert mail["Bcc"] is None
+    assert second.email["Bcc"] == "c@example.com"
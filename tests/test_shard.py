@@ -0,0 +1,83 @@
+import time
+import sqlite3
+import asyncio
+
+import pytest
+
+
+def test_hash_ring():
+    from nonebot.adapters.email.shard import HashRing  # type: ignore
+
+    accounts = [f"user{i}@example.com" for i in range(1000)]
+    before = {account: HashRing(["w1", "w2", "w3"]).owner(account) for account in accounts}
+    assert set(before.values()) == {"w1", "w2", "w3"}
+    assert min(list(before.values()).count(worker) for worker in ("w1", "w2", "w3")) > 200
+    # 增加一个 worker 时只有分给它的账号换主
+    after = {account: HashRing(["w1", "w2", "w3", "w4"]).owner(account) for account in accounts}
+    assert all(after[account] in (before[account], "w4") for account in accounts)
+    assert HashRing([]).owner("user@example.com") is None
+
+
+@pytest.mark.asyncio
+async def test_shard_coordinator(tmp_path):
+    from nonebot.adapters.email.shard import LeaseStore, ShardCoordinator  # type: ignore
+
+    accounts = [f"user{i}@example.com" for i in range(20)]
+    watching: dict[str, set[str]] = {"w1": set(), "w2": set()}
+
+    def coordinator(worker: str) -> ShardCoordinator:
+        async def stop(account: str):
+            watching[worker].remove(account)
+
+        return ShardCoordinator(
+            LeaseStore(tmp_path / "lease.db"), worker, accounts, 0.2, 64, watching[worker].add, stop
+        )
+
+    async def rebalance(*workers: ShardCoordinator):
+        for worker in workers:
+            await worker.rebalance()
+            # 停止在后台进行
+            await asyncio.sleep(0.01)
+
+    w1, w2 = coordinator("w1"), coordinator("w2")
+    await rebalance(w1)
+    assert watching["w1"] == set(accounts)
+    # w2 加入后, w1 先释放应归 w2 的账号, w2 随后取得
+    await rebalance(w2, w1, w2)
+    assert watching["w1"]
+    assert watching["w2"]
+    assert watching["w1"] | watching["w2"] == set(accounts)
+    assert not watching["w1"] & watching["w2"]
+
+    # w2 异常退出 (不再心跳), 租约过期后由 w1 接手
+    await asyncio.sleep(0.25)
+    await rebalance(w1)
+    assert watching["w1"] == set(accounts)
+    assert w2.store.acquire(accounts[0], "w2", time.time() + 1, time.time()) is False
+    await w1.close()
+    assert not watching["w1"]
+
+
+@pytest.mark.asyncio
+async def test_shard_store_off_loop(tmp_path):
+    from nonebot.adapters.email.shard import LeaseStore, ShardCoordinator  # type: ignore
+
+    async def stop(account: str):
+        pass
+
+    store = LeaseStore(tmp_path / "lease.db", timeout=2)
+    coordinator = ShardCoordinator(store, "w1", ["user@example.com"], 1, 64, lambda account: None, stop)
+    # 其他进程持有写锁时, 等待发生在线程中, 事件循环照常运行
+    other = sqlite3.connect(tmp_path / "lease.db", isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    task = asyncio.create_task(coordinator.rebalance())
+    start = time.perf_counter()
+    await asyncio.sleep(0.2)
+    assert time.perf_counter() - start < 0.5
+    assert not task.done()
+    other.execute("ROLLBACK")
+    await task
+    assert coordinator.owned == {"user@example.com"}
+    await coordinator.close()
+    other.close()
+    store.close()
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from aiosmtplib import SMTPResponse, SMTPResponseException
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("sqlite", [False, True])
+async def test_spool_retry(sqlite, tmp_path):
+    from nonebot.adapters.email.spool import Spool, TokenBucket, MemorySpoolStore, SQLiteSpoolStore  # type: ignore
+
+    attempts: list[list[str]] = []
+
+    async def deliver(mail):
+        attempts.append(mail.recipients)
+        if len(attempts) == 1:
+            # 部分收件人被临时拒收, 只重试这些收件人
+            return mail.recipients, {"b@example.com": SMTPResponse(451, "try again")}
+        if len(attempts) == 2:
+            raise SMTPResponseException(421, "too many connections")
+        return mail.recipients, {}
+
+    store = SQLiteSpoolStore(tmp_path / "spool.db") if sqlite else MemorySpoolStore()
+    spool = Spool(store, deliver, lambda account: None, 4, 5, 0.01, 0.01)
+    spool.start()
+    await spool.put("bot@example.com", "bot@example.com", ["a@example.com", "b@example.com"], b"data", False)
+    for _ in range(100):
+        if not len(spool.store) and not spool._inflight:
+            break
+        await asyncio.sleep(0.01)
+    await spool.close()
+
+    assert attempts == [["a@example.com", "b@example.com"], ["b@example.com"], ["b@example.com"]]
+    assert spool.retries == 2
+    assert len(spool.store) == 0
+    store.close()
+
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 0.1
@@ -0,0 +1,29 @@
+def test_thread_index():
+    from nonebot.adapters.email.thread import ThreadIndex, parse_msg_ids  # type: ignore
+
+    assert parse_msg_ids("<a@x> (comment)\r\n <b@x>") == ["<a@x>", "<b@x>"]
+
+    index = ThreadIndex(max_size=3)
+    assert index.add("<a@x>") == "<a@x>"
+    assert index.add("<b@x>", "<a@x>", "<a@x>") == "<a@x>"
+    # 只有 In-Reply-To 时沿用父邮件的会话和 References
+    assert index.add("<c@x>", "<b@x>") == "<a@x>"
+    assert index.reply_headers("<c@x>") == ("<c@x>", "<a@x> <b@x> <c@x>")
+    assert index.add("<d@x>") == "<d@x>"
+    assert len(index) == 3
+    assert index.get("<a@x>") is None
+    assert index.reply_headers("<a@x>") is None
+
+
+def test_sqlite_thread_store(tmp_path):
+    from nonebot.adapters.email.thread import ThreadIndex, SQLiteThreadStore  # type: ignore
+
+    path = tmp_path / "threads.db"
+    index = ThreadIndex(max_size=1, store=SQLiteThreadStore(path, max_rows=100))
+    index.add("<a@x>")
+    index.add("<b@x>", "<a@x>")
+    index.close()
+
+    index = ThreadIndex(max_size=1, store=SQLiteThreadStore(path, max_rows=100))
+    assert index.add("<c@x>", "<b@x>") == "<a@x>"
+    index.close()
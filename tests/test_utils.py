@@ -0,0 +1,183 @@
+import pytest
+from aioimaplib import Response
+
+
+def test_parse_fetch_response():
+    from nonebot.adapters.email.utils import parse_fetch_response  # type: ignore
+
+    resp = Response(
+        "OK",
+        [
+            b"12 FETCH (UID 5 FLAGS (\\Seen) RFC822.SIZE 1234 BODY[HEADER.FIELDS (FROM)] {17}",
+            bytearray(b"From: a <a@b.c>\r\n"),
+            b")",
+            b"13 FETCH (BODY[HEADER.FIELDS (FROM)] {17}",
+            bytearray(b"From: b <b@c.d>\r\n"),
+            b" UID 6 FLAGS ())",
+            b"UID FETCH completed",
+        ],
+    )
+    mails = parse_fetch_response(resp)
+
+    assert [mail.uid for mail in mails] == [5, 6]
+    assert mails[0].flags == ["\\Seen"]
+    assert mails[0].size == 1234
+    assert mails[1].literal == b"From: b <b@c.d>\r\n"
+
+
+def test_parse_fetch_response_bodystructure_literal():
+    from nonebot.adapters.email.utils import parse_fetch_response  # type: ignore
+
+    # 非 ASCII 的文件名以 literal 返回, 其后才是头部的 literal
+    filename = "报告 {3}.pdf".encode()
+    resp = Response(
+        "OK",
+        [
+            b'7 FETCH (UID 9 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1 NIL NIL NIL)'
+            b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 100 NIL ("ATTACHMENT" ("FILENAME" {%d}' % len(filename),
+            bytearray(filename),
+            b')) NIL) "MIXED" ("BOUNDARY" "b") NIL NIL) BODY[HEADER.FIELDS (FROM)] {17}',
+            bytearray(b"From: a <a@b.c>\r\n"),
+            b" RFC822.SIZE 10)",
+            b"UID FETCH completed",
+        ],
+    )
+    (mail,) = parse_fetch_response(resp)
+
+    assert mail.literal == b"From: a <a@b.c>\r\n"
+    assert mail.size == 10
+    assert mail.bodystructure is not None
+    assert [part.filename for part in mail.bodystructure.walk()] == [None, None, "报告 {3}.pdf"]
+
+
+def test_parse_select_response():
+    from nonebot.adapters.email.utils import parse_select_response  # type: ignore
+
+    resp = Response("OK", [b"OK [UIDVALIDITY 3] UIDs valid", b"OK [UIDNEXT 45] Predicted next UID", b"[READ-WRITE]"])
+
+    assert parse_select_response(resp) == (3, 45)
+
+
+def test_parse_bodystructure():
+    from nonebot.adapters.email.bodystructure import parse_bodystructure  # type: ignore
+
+    structure = parse_bodystructure(
+        b'((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 24 1 NIL NIL NIL)'
+        b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 300 5 NIL NIL NIL)'
+        b' "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL)'
+        b'("APPLICATION" "PDF" ("NAME" "x.pdf") NIL NIL "BASE64" 20971520 NIL'
+        b' ("ATTACHMENT" ("FILENAME*" "utf-8\'\'%E6%B5%8B%E8%AF%95.pdf")) NIL)'
+        b' "MIXED" ("BOUNDARY" "b0") NIL NIL)'
+    )
+    parts = {part.section: part for part in structure.walk()}
+
+    assert structure.mimetype == "multipart/mixed"
+    assert parts["1.1"].mimetype == "text/plain"
+    assert parts["1.1"].charset == "utf-8"
+    assert parts["1.2"].encoding == "quoted-printable"
+    assert parts["2"].is_attachment
+    assert parts["2"].filename == "测试.pdf"
+
+
+def test_parse_headers():
+    from nonebot.adapters.email.utils import parse_headers  # type: ignore
+
+    raw = (
+        b"Subject: =?utf-8?b?5rWL6K+V?= with a folded\r\n"
+        b" line =?utf-8?b?5Lit?=\r\n"
+        b"\t=?utf-8?b?5paH?=\r\n"
+        b"From: =?utf-8?q?=E5=BC=A0=E4=B8=89?= <zhang@example.com>\r\n"
+        b"Message-Id: <1@example.com>\r\n"
+        b"Date: Fri, 25 Aug 2023 02:53:48 +0000\r\n"
+        b"\r\n"
+    )
+    parsed = parse_headers(raw)
+
+    assert parsed.subject == "测试 with a folded line 中文"
+    assert parsed.date == "Fri, 25 Aug 2023 02:53:48 +0000"
+    assert parsed.headers["From"] == "张三 <zhang@example.com>"
+    assert parsed.headers["Message-ID"] == "<1@example.com>"
+
+
+def test_uid_search_to_set():
+    from nonebot.adapters.email.utils import format_uid_set, parse_search_response  # type: ignore
+
+    uids = parse_search_response(Response("OK", [b"3 4 5 9 11 12", b"UID SEARCH completed"]))
+    assert uids == [3, 4, 5, 9, 11, 12]
+    assert format_uid_set(uids) == "3:5,9,11:12"
+
+
+def test_parse_status():
+    from nonebot.adapters.email.utils import parse_status  # type: ignore
+
+    assert parse_status(b'STATUS "Shared/Team A" (UIDNEXT 12 MESSAGES 3)') == (
+        "Shared/Team A",
+        {"UIDNEXT": 12, "MESSAGES": 3},
+    )
+    assert parse_status(b"Archive (UIDVALIDITY 7 UIDNEXT 5)") == ("Archive", {"UIDVALIDITY": 7, "UIDNEXT": 5})
+
+
+def test_metrics_render_prometheus():
+    from nonebot.adapters.email.metrics import Gauge, Counter, Metrics  # type: ignore
+
+    metrics = Metrics()
+    metrics.idle_wakeups.inc(account="a@b.c", folder="INBOX")
+    metrics.fetch_seconds.observe(0.03, account="a@b.c", folder="INBOX")
+    # 只增不减的值即使在采集时才取值也导出为 counter
+    metrics.register(Counter("email_spool_retries_total", "retries", function=lambda: 3))
+    metrics.register(Gauge("email_spool_size", "spool size", lambda: 2))
+    text = metrics.render_prometheus()
+
+    assert "# TYPE email_spool_retries_total counter\nemail_spool_retries_total 3\n" in text
+    assert "# TYPE email_spool_size gauge\nemail_spool_size 2\n" in text
+
+    assert 'email_idle_wakeups_total{account="a@b.c",folder="INBOX"} 1' in text
+    assert 'email_fetch_seconds_bucket{account="a@b.c",folder="INBOX",le="0.025"} 0' in text
+    assert 'email_fetch_seconds_bucket{account="a@b.c",folder="INBOX",le="0.05"} 1' in text
+    assert 'email_fetch_seconds_count{account="a@b.c",folder="INBOX"} 1' in text
+
+
+def test_compile_prefilter():
+    from nonebot.adapters.email.config import PrefilterConfig  # type: ignore
+    from nonebot.adapters.email.prefilter import compile_prefilter  # type: ignore
+
+    assert compile_prefilter(None) is None
+    assert compile_prefilter(PrefilterConfig()) is None
+
+    prefilter = PrefilterConfig(
+        from_addrs=["a@example.com", "b@example.com", "c@example.com"],
+        headers={"List-Id": "dev"},
+        larger=1024,
+        exclude_from=["noreply@"],
+        gmail_raw="has:attachment",
+    )
+    assert compile_prefilter(prefilter) == (
+        'OR FROM "a@example.com" OR FROM "b@example.com" FROM "c@example.com" '
+        'HEADER "List-Id" "dev" LARGER 1024 NOT FROM "noreply@"',
+        None,
+    )
+    assert compile_prefilter(prefilter, gmail=True).criteria.endswith('X-GM-RAW "has:attachment"')
+    # 8 位数据只能以字面量发送
+    assert compile_prefilter(PrefilterConfig(subjects=["周报"])) == ("SUBJECT {6}\r\n周报", "UTF-8")
+
+
+def test_register_command():
+    from aioimaplib import AUTH, SELECTED, Cmd, Exec, Commands
+    from nonebot.adapters.email import prefilter  # type: ignore # noqa: F401
+    from nonebot.adapters.email.utils import register_command  # type: ignore
+
+    # 已登记的兼容命令不被覆盖
+    existing = Commands["UID SEARCH"]
+    register_command(Cmd("UID SEARCH", (SELECTED,), Exec.is_sync))
+    assert Commands["UID SEARCH"] is existing
+    with pytest.raises(RuntimeError):
+        register_command(Cmd("SEARCH", (SELECTED,), Exec.is_sync))
+    with pytest.raises(RuntimeError):
+        register_command(Cmd("UID SEARCH", (AUTH, SELECTED), Exec.is_sync))
+
+
+def test_header_fetch_query():
+    from nonebot.adapters.email.utils import header_fetch_query  # type: ignore
+
+    assert header_fetch_query(["From", "List-Id"]).endswith("BODY.PEEK[HEADER.FIELDS (FROM LIST-ID)])")
+    assert header_fetch_query([]).endswith("BODY.PEEK[HEADER])")